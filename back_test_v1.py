@@ -5,6 +5,11 @@ from openpyxl import Workbook
 from openpyxl.styles import PatternFill
 from openpyxl.utils.dataframe import dataframe_to_rows
 import configparser
+import argparse
+import time
+from stock_db_utils import (connect_analysis_db, enable_query_profiling, last_query_profile, new_query_profile,
+                            partition_predicate, record_profile_phase, write_profile_report)
+from result_cache import cached_frame, open_result_cache
 
 # ========== 参数配置 ==========
 MAX_HOLDING_TRADING_DAYS = 40   # 最大持有天数40天
@@ -12,6 +17,15 @@ INITIAL_CASH = 100000         # 每股初始购买金额10万元
 BACKTEST_RESULT = {}
 # ========== 参数配置 ==========
 
+# --profile 时把各算子的耗时归到查询中命名的 CTE（DuckDB 会内联 CTE，按算子名称和 extra_info 匹配，取第一个匹配的 CTE）
+NEXT_N_DAYS_CTE_MARKERS = {
+    '输出(排序)': [r'ORDER_BY', r'adj_support_price'],
+    'LimitedRangeStockData': [r'DELIM', r'RIGHT_SEMI', r'DUMMY_SCAN', r'HASH_GROUP_BY', r'trading_day \+', r'"Conditions": "trade_date = max_close_n_days_date"', r'trading_calendar'],
+    'FilteredStockData': [r'amplitude_bucket', r'max_close_n_days \* 1\.01', r'rn > \d+'],
+    'StockWindows': [r'^WINDOW', r'SEMI', r'exchange', r'"Table": "security_master"'],
+    'AdjustedStockData': [r'ASOF_JOIN', r'"Table": "(stock_data|corporate_actions)"', r'PARQUET', r'MARK', r'COLUMN_DATA_SCAN'],
+}
+
 # 盈亏报告的字段映射
 PROFIT_LOSS_MAPPING = {
     "no": "编号",
@@ -88,17 +102,20 @@ def load_target_df():
 
 # 根据选中的突破日股票数据(结构:[{"stock_code": "AAPL"},{"stock_code": "TSM"}])
 # 获取被选股票突破日后N天的交易数据
-def get_next_N_days_data(stock_data_list, max_holding_days):
+# profile 为 new_query_profile 返回的性能分析记录，不为 None 时记录该查询各 CTE 的耗时；
+# con 为已打开的连接（如 screen_service.py 常驻内存的数据）时直接查询、不关闭，config 为 None 时读取 config.conf
+def get_next_N_days_data(stock_data_list, max_holding_days, profile=None, con=None, config=None):
     """
     Connects to DuckDB, creates/ensures stock_data table exists (for testing),
     and queries stocks satisfying specific conditions using DuckDB.
     """
 
-    # 创建 ConfigParser 对象
-    config = configparser.ConfigParser()
+    if config is None:
+        # 创建 ConfigParser 对象
+        config = configparser.ConfigParser()
 
-    # 读取 .conf 文件
-    config.read('./config.conf')
+        # 读取 .conf 文件
+        config.read('./config.conf')
     earliest_time_limit=config['settings']['earliest_time_limit']                                   # 交易日期的最早时限，该日前的交易数据，不会被纳入选择
     cond1_and_cond3=config['settings']['cond1_and_cond3']                                           # 条件1和条件3的配置项。
     cond2=config['settings']['cond2']                                                               # 条件2：前N个交易日内有涨幅（大于等于5%）的K线
@@ -117,12 +134,6 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     use_cond_1_1_or_cond_1_2=config['settings']['use_cond_1_1_or_cond_1_2']                         # 使用条件1.1还是1.2进行筛选：1.1，使用条件1.1; 1.2, 使用条件1.2。
     range_days_of_cond_1_2=config['settings']['range_days_of_cond_1_2']                             # 使用条件1.2时，其后N个交易日设定值
 
-    cond2_sql_where_clause = ''
-    if apply_cond2_or_not == 'yes':
-        cond2_sql_where_clause = 'AND has_gain_5_percent = 1'
-    if apply_cond2_or_not == 'no':
-        cond2_sql_where_clause = '-- AND has_gain_5_percent = 1'
-
     cond5_sql_where_clause = ''
     if apply_cond5_or_not == 'yes':
         cond5_sql_where_clause = f'AND net_profit_yoy >= {net_profit_growth_rate} AND revenue_yoy >= {total_revenue_growth_rate}'
@@ -132,66 +143,41 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     # Connect to DuckDB database file
     # Ensure 'stock_data.duckdb' exists and contains data,
     # or uncomment the data generation part below for testing.
-    con = duckdb.connect(database='stock_data.duckdb', read_only=False)
-    print("连接到数据库: stock_data.duckdb")
+    # 数据源由 config.conf 中的 data_source 决定：duckdb 数据库文件，或导出的 Parquet 数据集
+    close_connection = con is None
+    if close_connection:
+        con = connect_analysis_db(config)
+    enable_query_profiling(con, profile)
     
-    stock_code_list = ", ".join(f"'{item['stock_code']}'" for item in stock_data_list)
+    stock_codes = [item['stock_code'] for item in stock_data_list]
     days_limit = 41 if max_holding_days is None else (int(max_holding_days) + 1)
 
+    # 配置值以参数绑定，不再拼接进 SQL；N 是 ROWS BETWEEN 中的常量，仍写在 SQL 里
+    query_parameters = {
+        'earliest_time_limit': datetime.strptime(earliest_time_limit, '%Y-%m-%d %H:%M:%S').date(),
+        'main_board_amplitude_threshold': float(main_board_amplitude_threshold),
+        'non_main_board_amplitude_threshold': float(non_main_board_amplitude_threshold),
+        'cond2': float(cond2),
+        'apply_cond2_or_not': apply_cond2_or_not,
+        'min_market_capitalization': float(min_market_capitalization),
+        'max_market_capitalization': float(max_market_capitalization),
+        'days_limit': days_limit,
+    }
+    # 每支股票一个参数：IN 列表的每一项仍是常量，DuckDB 能按 stock_code 跳过无关的数据块（绑定整个列表则不能）
+    stock_code_parameters = {f"stock_code_{i}": stock_code for i, stock_code in enumerate(stock_codes)}
+    query_parameters.update(stock_code_parameters)
+
     # Main Query SQL (optimized for DuckDB)
     # The SQL is mostly the same as DuckDB handles window functions efficiently.
     query_sql = f"""
     -- 📝 计算符合条件的股票交易日窗口
-    WITH DeduplicatedStockData AS (
-        -- ✅ 去掉 stock_data 中完全重复的行
-        SELECT DISTINCT stock_code, stock_name, trade_date, open_price, close_price, high_price, low_price, prev_close_price, market_cap, total_market_cap, industry_level1, industry_level2, industry_level3 
-        FROM stock_data
-        -- 🔧 限定 stock_code 范围，只查询给定股票列表
-        WHERE stock_code IN (
-            -- ⚠️ 这里的 stock_code_list 可以是 Python 格式 ['AAPL','TSM'] 转换成 SQL 字符串 'AAPL','TSM'
-            {stock_code_list}
-        )
-    ),
-    StockWithRiseFall AS (
-        -- ✅ 计算复权涨跌幅，公式: 复权涨跌幅 = 收盘价 / 前收盘价 - 1
-        SELECT *,
-            (close_price / NULLIF(prev_close_price, 0)) - 1 AS rise_fall
-        FROM DeduplicatedStockData
-    ),
-    AdjustmentFactorComputed AS (
-        -- ✅ 计算复权因子, 公式: 复权因子 = (1 + 复权涨跌幅).cumprod()
-        SELECT *,
-            EXP(SUM(LN(1 + rise_fall)) OVER (PARTITION BY stock_code ORDER BY trade_date)) AS adjustment_factor
-        FROM StockWithRiseFall
-    ),
-    LastRecordComputed AS (
-        -- ✅ 获取每个 stock_code 的最后一条记录的收盘价和复权因子
-        SELECT 
-            t.stock_code,
-            t.close_price AS last_close_price,
-            t.adjustment_factor AS last_adjustment_factor
-        FROM (
-            SELECT 
-                stock_code,
-                close_price,
-                adjustment_factor,
-                ROW_NUMBER() OVER (PARTITION BY stock_code ORDER BY trade_date DESC) AS rn
-            FROM AdjustmentFactorComputed
-        ) t
-        WHERE t.rn = 1
-    ),
-    AdjustedStockData AS (
-        SELECT 
-            a.*,
-            -- ✅ 计算前复权收盘价, 公式: 前复权收盘价 = 复权因子 * (最后一条数据的收盘价 / 最后一条数据的复权因子)
-            a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0)) AS adj_close_price,
-            -- ✅ 前复权其他价格
-            (a.open_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_open_price,
-            (a.high_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_high_price,
-            (a.low_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_low_price,
-            (a.prev_close_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_prev_close_price
-        FROM AdjustmentFactorComputed a
-        LEFT JOIN LastRecordComputed l ON a.stock_code = l.stock_code
+    WITH AdjustedStockData AS (
+        -- ✅ 前复权价格来自共享视图 adjusted_stock_data：导入程序把除权除息日写入 corporate_actions 表，
+        --    前复权价格 = 价格 * 该日之后所有除权事件复权因子的乘积（ASOF 连接），无需逐行计算 EXP(SUM(LN()))
+        SELECT * FROM adjusted_stock_data
+        -- 🔧 限定 stock_code 范围，只查询给定股票列表；使用 Parquet 数据集时按板块和年份分区裁剪
+        WHERE {partition_predicate(config, earliest_time_limit, stock_codes)}
+        AND stock_code IN ({', '.join('$' + name for name in stock_code_parameters)})
     ),
     StockWindows AS (
         SELECT
@@ -245,7 +231,7 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
             ) AS open_price_of_first_day_of_n_days,
             -- ✅ N个交易日内是否存在单日涨幅 ≥ 5%
             MAX(CASE
-                WHEN (t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0) >= {cond2} THEN 1
+                WHEN (t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0) >= $cond2 THEN 1
                 ELSE 0
             END) OVER (
                 PARTITION BY t.stock_code
@@ -260,10 +246,10 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
         FROM
             AdjustedStockData t
         WHERE
-            -- ✅ 排除北交所股票
-            t.stock_code NOT LIKE 'bj%' AND
+            -- ✅ 排除北交所股票（security_master 中 exchange = 'bj'）
+            t.stock_code IN (SELECT stock_code FROM security_master WHERE exchange <> 'bj') AND
             -- ✅ 排除2022年1月1号之前的交易数据
-            t.trade_date >= '{earliest_time_limit}'
+            t.trade_date >= $earliest_time_limit
     ),
     FilteredStockData AS (
         SELECT
@@ -283,44 +269,46 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
             sw.industry_level3
         FROM
             StockWindows AS sw
+        -- ✅ 条件3的振幅阈值按 security_master 中的板块分类
+        JOIN security_master sm ON sm.stock_code = sw.stock_code
         WHERE
             -- 📌 条件0：窗口内至少有N个交易日数据
             sw.rn > {history_trading_days}
             -- 📌 条件1：当日收盘价大于前N个交易日的最高收盘价的101%
             AND sw.adj_close_price > (sw.max_close_n_days * 1.01)
             -- 📌 条件2：前N个交易日内有涨幅（大于等于5%）的K线
-            {cond2_sql_where_clause}
+            AND ($apply_cond2_or_not <> 'yes' OR sw.has_gain_5_percent = 1)
             -- 📌 条件3：前N个交易日的股票价格振幅度，上证和深证股票小于等于25%(30%, 35%)，创业板和科创板股票小于等于35%(40%, 40%)
             AND (
-                -- ✅ 根据股票代码板块（前缀）确定振幅阈值
                 CASE
                     WHEN sw.open_price_of_first_day_of_n_days > 0
                     THEN (sw.max_high_n_days - sw.min_low_n_days) * 1.0 / sw.open_price_of_first_day_of_n_days * 100
                     ELSE 999999 -- 避免除零错误
                 END
             ) <= (
-                CASE
-                    -- ✅ 创业板（以300，301，302开头）或科创板（以688开头），小于等于35%(40%, 40%)
-                    WHEN sw.stock_code LIKE 'sz300%' OR sw.stock_code LIKE 'sz301%' OR sw.stock_code LIKE 'sz302%' OR sw.stock_code LIKE 'sh688%' THEN {non_main_board_amplitude_threshold}
-                    -- ✅ 上证主板（以600，601，603，605开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sh600%' OR sw.stock_code LIKE 'sh601%' OR sw.stock_code LIKE 'sh603%' OR sw.stock_code LIKE 'sh605%' THEN {main_board_amplitude_threshold}
-                    -- ✅ 深证主板（以000，001，002，003开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sz000%' OR sw.stock_code LIKE 'sz001%' OR sw.stock_code LIKE 'sz002%' OR sw.stock_code LIKE 'sz003%' THEN {main_board_amplitude_threshold}
+                CASE sm.amplitude_bucket
+                    -- ✅ 创业板（300，301，302）和科创板（688），小于等于35%(40%, 40%)
+                    WHEN 'growth' THEN $non_main_board_amplitude_threshold
+                    -- ✅ 上证主板（600，601，603，605）和深证主板（000，001，002，003），小于等于25%(30%, 35%)
+                    WHEN 'main' THEN $main_board_amplitude_threshold
                     ELSE 1000
                 END
             )
             -- 📌 条件4：流通市值在30亿至500亿之间
-            AND sw.market_cap_of_100_million BETWEEN {min_market_capitalization} AND {max_market_capitalization}
+            AND sw.market_cap_of_100_million BETWEEN $min_market_capitalization AND $max_market_capitalization
     ),
     LimitedRangeStockData AS (
-        -- 🔧 限定范围：每支股票从其 max_close_n_days_date 起，往后取 {days_limit} 个交易日数据
-        SELECT *
+        -- 🔧 限定范围：每支股票从其 max_close_n_days_date 起，往后取 days_limit 个交易日数据
+        --    按 trading_calendar 中的交易日序号比较（N 个交易日后 = 序号 + N，节假日不计入），而不是 DATE_ADD 的自然日
+        SELECT w.*
         FROM StockWindows w
+        JOIN trading_calendar wc ON wc.trade_date = w.trade_date
         WHERE EXISTS (
             SELECT 1
             FROM FilteredStockData f
+            JOIN trading_calendar fc ON fc.trade_date = f.max_close_n_days_date
             WHERE f.stock_code = w.stock_code
-            AND w.trade_date BETWEEN f.max_close_n_days_date AND DATE_ADD(f.max_close_n_days_date, INTERVAL {days_limit} DAY)
+            AND wc.trading_day BETWEEN fc.trading_day AND fc.trading_day + $days_limit
         )
     )
     -- ✅ 最终输出
@@ -340,10 +328,18 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     """
     
     # 获取查询结果
-    results_df = con.execute(query_sql).fetchdf()
+    # 查询结果按 SQL、参数和数据版本缓存在 result_cache 中（见 config.conf 的 [cache]）；
+    # 开启性能分析，或由调用方提供连接（常驻服务，数据已在内存中）时不使用缓存
+    cache = open_result_cache(config, con) if close_connection and profile is None else None
+    start_time = time.time()
+    results_df = cached_frame(cache, 'next_n_days_data', {'sql': query_sql, 'parameters': query_parameters},
+                              lambda: con.execute(query_sql, query_parameters).fetchdf())
+    record_profile_phase(profile, 'sql:next_n_days_data', start_time,
+                         [last_query_profile(profile, 'next_n_days_data', NEXT_N_DAYS_CTE_MARKERS)])
     
     # 关闭连接
-    con.close()
+    if close_connection:
+        con.close()
 
     #返回查询结果
     return results_df
@@ -401,13 +397,19 @@ def update_position(stock_code, stock_name, support_date, support_price, trade_t
             stock_data["profit_percent"] = 0.00
             BACKTEST_RESULT[stock_code] = stock_data
 
-def do_back_test():
+# profile_path 不为空时开启 DuckDB 性能分析，把查询、回测循环、导出各阶段的耗时写入该 JSON 文件。
+# target_df 为 None 时从 xlsx 文件加载回测目标；con、config 传给 get_next_N_days_data；
+# export_excel 为 False 时不导出 Excel（screen_service.py 直接返回结果）。返回组合盈亏报告（含汇总行）
+def do_back_test(profile_path=None, target_df=None, con=None, config=None, export_excel=True):
     global BACKTEST_RESULT
     BACKTEST_RESULT.clear()
+    profile = new_query_profile(profile_path)
     # 获取数据
-    target_df = load_target_df()
+    if target_df is None:
+        target_df = load_target_df()
     stock_data_list = target_df[['stock_code', 'stock_name']].to_dict('records')
-    stock_df = get_next_N_days_data(stock_data_list, MAX_HOLDING_TRADING_DAYS)
+    stock_df = get_next_N_days_data(stock_data_list, MAX_HOLDING_TRADING_DAYS, profile, con, config)
+    start_time = time.time()
 
     # 转换日期类型
     stock_df['trade_date'] = pd.to_datetime(stock_df['trade_date'])
@@ -415,6 +417,8 @@ def do_back_test():
 
     # 按stock_code和trade_date进行排序
     stock_df = stock_df.sort_values(['stock_code', 'trade_date'])
+    # 按股票一次拆分，每个回测目标按代码直接取出该股票的数据，不再对整张表做布尔筛选
+    stock_groups = {code: stock_group.reset_index(drop=True) for code, stock_group in stock_df.groupby('stock_code', sort=False)}
 
     # results = []
     # stock_to_remaining = {}
@@ -426,11 +430,11 @@ def do_back_test():
         support_date = target['trade_date']
         breakthrough_date = target['breakthrough_date']
         
-        group = stock_df[stock_df['stock_code'] == stock_code].reset_index(drop=True)
-        if group.empty:
+        group = stock_groups.get(stock_code)
+        if group is None:
             continue
 
-        support_price = stock_df.loc[stock_df['stock_code'] == stock_code, 'adj_support_price'].iloc[0]
+        support_price = group['adj_support_price'].iloc[0]
         
         # 找到突破日的后一日
         next_days = group[group['trade_date'] > breakthrough_date]
@@ -719,6 +723,12 @@ def do_back_test():
     # 准备导出数据
     final_export_df = pd.concat([merged_df, total_row], ignore_index=True)
 
+    record_profile_phase(profile, 'post_filter:back_test', start_time)
+    if not export_excel:
+        write_profile_report(profile, script='back_test_v1.py', targets=len(target_df), max_holding_trading_days=MAX_HOLDING_TRADING_DAYS)
+        return final_export_df
+    start_time = time.time()
+
     # 设置导出回测结果文件名称
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"组合盈亏报告_{timestamp}.xlsx"
@@ -770,6 +780,16 @@ def do_back_test():
                     cell.number_format = '0'
 
     wb.save(filename)
+    record_profile_phase(profile, 'export:excel', start_time)
+    write_profile_report(profile, script='back_test_v1.py', targets=len(target_df), max_holding_trading_days=MAX_HOLDING_TRADING_DAYS)
+    return final_export_df
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="回测 Table.xlsx 中的突破股票，输出组合盈亏报告。")
+    parser.add_argument('--profile', nargs='?', const=f"profile_back_test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        help="开启 DuckDB 性能分析，把查询、回测循环、导出各阶段及各 CTE 的耗时写入 JSON 报告（默认 profile_back_test_时间戳.json）。")
+    return parser.parse_args()
 
 if __name__ == '__main__':
-    do_back_test()
\ No newline at end of file
+    args = parse_args()
+    do_back_test(profile_path=args.profile)
\ No newline at end of file
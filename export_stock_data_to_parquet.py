@@ -0,0 +1,133 @@
+import duckdb
+import argparse
+import os
+import shutil
+import time # Import time for performance measurement
+from stock_db_utils import BOARD_SQL, STOCK_DB_PATH
+
+def export_adjusted_bars(con, output_dir):
+    """
+    Writes the adjusted daily bars of adjusted_stock_data as Parquet, partitioned by
+    board (sh60x/sz00x/sz30x/sh688/...) and year, each file sorted by stock_code and
+    trade_date so the row group statistics also prune stock and date filters.
+
+    Args:
+        con: An open DuckDB connection to stock_data.duckdb.
+        output_dir (str): Directory the adjusted_stock_data partitions are written into.
+
+    Returns:
+        int: Number of rows written.
+    """
+    return con.execute(f"""
+        COPY (
+            SELECT *, {BOARD_SQL} AS board, YEAR(trade_date) AS year
+            FROM adjusted_stock_data
+            ORDER BY stock_code, trade_date
+        ) TO '{os.path.join(output_dir, 'adjusted_stock_data')}'
+        (FORMAT parquet, PARTITION_BY (board, year), COMPRESSION zstd);
+    """).fetchone()[0]
+
+def export_trading_calendar(con, output_dir):
+    """
+    Writes the trading_calendar table, which maps trade dates to trading-day ordinals,
+    into a single Parquet file.
+
+    Returns:
+        int: Number of rows written.
+    """
+    return con.execute(f"""
+        COPY (SELECT * FROM trading_calendar ORDER BY trade_date)
+        TO '{os.path.join(output_dir, 'trading_calendar.parquet')}' (FORMAT parquet, COMPRESSION zstd);
+    """).fetchone()[0]
+
+def export_security_master(con, output_dir):
+    """
+    Writes the security_master table, the board and condition 3 amplitude bucket of
+    every stock, into a single Parquet file.
+
+    Returns:
+        int: Number of rows written.
+    """
+    return con.execute(f"""
+        COPY (SELECT * FROM security_master ORDER BY stock_code)
+        TO '{os.path.join(output_dir, 'security_master.parquet')}' (FORMAT parquet, COMPRESSION zstd);
+    """).fetchone()[0]
+
+# Finance tables copied into the dataset next to the adjusted bars
+FINANCE_TABLES = ['stock_finance_hot', 'fundamentals_quarterly']
+
+def export_finance_table(con, output_dir, table_name):
+    """
+    Writes a finance table (stock_finance_hot, or fundamentals_quarterly which the
+    screener needs for condition 5) into a single Parquet file.
+
+    Returns:
+        int: Number of rows written, 0 if the table does not exist.
+    """
+    exists = con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]
+    ).fetchone()[0]
+    if not exists:
+        print(f"Table '{table_name}' not found, run import_stock_finance_data_to_duckdb.py to export finance data.")
+        return 0
+    return con.execute(f"""
+        COPY (SELECT * FROM {table_name} ORDER BY stock_code, report_date)
+        TO '{os.path.join(output_dir, table_name + '.parquet')}' (FORMAT parquet, COMPRESSION zstd);
+    """).fetchone()[0]
+
+def refresh_parquet_dataset(duckdb_path, output_dir):
+    """
+    Exports stock_data.duckdb into a fresh Parquet dataset and swaps it in place of
+    output_dir. The new dataset is written next to the old one first, so readers only
+    ever see a complete dataset and a failed export leaves the old one untouched.
+
+    Args:
+        duckdb_path (str): Path of the DuckDB database file.
+        output_dir (str): Directory of the Parquet dataset.
+    """
+    output_dir = os.path.abspath(output_dir)
+    writing_dir = output_dir + '.writing'
+    old_dir = output_dir + '.old'
+    shutil.rmtree(writing_dir, ignore_errors=True)
+    os.makedirs(writing_dir)
+
+    con = duckdb.connect(database=duckdb_path, read_only=True)
+    print(f"Connected to DuckDB database: {duckdb_path}")
+    try:
+        start_time = time.time()
+        bar_rows = export_adjusted_bars(con, writing_dir)
+        print(f"Exported {bar_rows} adjusted daily bars in {time.time() - start_time:.2f} seconds.")
+        print(f"Exported {export_trading_calendar(con, writing_dir)} trading days.")
+        print(f"Exported {export_security_master(con, writing_dir)} stocks of the security master.")
+        for table_name in FINANCE_TABLES:
+            start_time = time.time()
+            finance_rows = export_finance_table(con, writing_dir, table_name)
+            print(f"Exported {finance_rows} rows of '{table_name}' in {time.time() - start_time:.2f} seconds.")
+    except Exception:
+        shutil.rmtree(writing_dir, ignore_errors=True)
+        raise
+    finally:
+        con.close()
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(writing_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Parquet dataset refreshed in '{output_dir}'.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the adjusted daily bars of stock_data.duckdb as a Hive-partitioned Parquet dataset.")
+    parser.add_argument('--output-dir', default='./stock_parquet',
+                        help="Directory of the Parquet dataset, set parquet_dir in config.conf to the same path.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not os.path.isfile(STOCK_DB_PATH):
+        print(f"Error: DuckDB database '{STOCK_DB_PATH}' not found. Run import_stock_data_to_duckdb.py first.")
+        return
+    refresh_parquet_dataset(STOCK_DB_PATH, args.output_dir)
+
+if __name__ == '__main__':
+    main()
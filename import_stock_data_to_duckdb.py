@@ -1,8 +1,128 @@
 import duckdb
+import argparse
+import codecs
 import csv
 import os
+import shutil
+import tempfile
 import pandas as pd
 import time # Import time for performance measurement
+from concurrent.futures import ProcessPoolExecutor
+from stock_db_utils import BOARD_SQL, parallel_load, record_manifest, select_changed_files
+from price_cube import configured_cube_dir, refresh_price_cube
+
+STAGING_TABLE = 'stock_data_staging'
+CORPORATE_ACTIONS_TABLE = 'corporate_actions'
+TRADING_CALENDAR_TABLE = 'trading_calendar'
+SECURITY_MASTER_TABLE = 'security_master'
+ADJUSTED_VIEW = 'adjusted_stock_data'
+# Per-row factor tables of earlier versions, replaced by corporate_actions
+LEGACY_FACTOR_TABLES = ['stock_adjustment_factor', 'stock_latest_factor']
+# Amplitude bucket of condition 3: growth boards (ChiNext sz300/sz301/sz302, STAR sh688)
+# use the non-main-board threshold, the Shanghai and Shenzhen main boards the main one
+AMPLITUDE_BUCKET_SQL = """CASE
+        WHEN LEFT(stock_code, 5) IN ('sz300', 'sz301', 'sz302', 'sh688') THEN 'growth'
+        WHEN LEFT(stock_code, 5) IN ('sh600', 'sh601', 'sh603', 'sh605', 'sz000', 'sz001', 'sz002', 'sz003') THEN 'main'
+        ELSE NULL
+    END"""
+
+# Define the mapping from CSV header names to desired column names and types
+# This mapping ensures consistent column names for the DuckDB table
+HEADER_MAPPING = {
+    '股票代码': 'stock_code',
+    '股票名称': 'stock_name',
+    '交易日期': 'trade_date',
+    '开盘价': 'open_price',
+    '最高价': 'high_price',
+    '最低价': 'low_price',
+    '收盘价': 'close_price',
+    '前收盘价': 'prev_close_price',
+    '成交量': 'volume',
+    '成交额': 'turnover',
+    '流通市值': 'market_cap',
+    '总市值': 'total_market_cap',
+    '净利润TTM': 'net_profit_ttm',
+    '现金流TTM': 'cash_flow_ttm',
+    '净资产': 'net_assets',
+    '总资产': 'total_assets',
+    '总负债': 'total_liabilities',
+    '净利润(当季)': 'net_profit_quarter',
+    '中户资金买入额': 'mid_investor_buy',
+    '中户资金卖出额': 'mid_investor_sell',
+    '大户资金买入额': 'large_investor_buy',
+    '大户资金卖出额': 'large_investor_sell',
+    '散户资金买入额': 'retail_investor_buy',
+    '散户资金卖出额': 'retail_investor_sell',
+    '机构资金买入额': 'institutional_buy',
+    '机构资金卖出额': 'institutional_sell',
+    '沪深300成分股': 'hs300_component',
+    '上证50成分股': 'sse50_component',
+    '中证500成分股': 'csi500_component',
+    '中证1000成分股': 'csi1000_component',
+    '中证2000成分股': 'csi2000_component',
+    '创业板指成分股': 'gem_component',
+    '新版申万一级行业名称': 'industry_level1',
+    '新版申万二级行业名称': 'industry_level2',
+    '新版申万三级行业名称': 'industry_level3',
+    '09:35收盘价': 'price_0935',
+    '09:45收盘价': 'price_0945',
+    '09:55收盘价': 'price_0955'
+}
+
+FLOAT_COLUMNS = {
+    'open_price', 'high_price', 'low_price', 'close_price',
+    'prev_close_price', 'volume', 'turnover', 'market_cap',
+    'total_market_cap', 'net_profit_ttm', 'cash_flow_ttm',
+    'net_assets', 'total_assets', 'total_liabilities',
+    'net_profit_quarter', 'mid_investor_buy', 'mid_investor_sell',
+    'large_investor_buy', 'large_investor_sell', 'retail_investor_buy',
+    'retail_investor_sell', 'institutional_buy', 'institutional_sell',
+    'price_0935', 'price_0945', 'price_0955'
+}
+
+FLAG_COLUMNS = {
+    'hs300_component', 'sse50_component', 'csi500_component',
+    'csi1000_component', 'csi2000_component', 'gem_component'
+}
+
+# Schemas of stock_data:
+#   standard: VARCHAR text, INTEGER flags and DOUBLE numbers, as the CSV files are parsed.
+#   compact: BOOLEAN flags.
+#   compact-float: compact plus FLOAT for the intraday price snapshots.
+# Code, name and industries stay VARCHAR in every schema: new listings and renames arrive
+# with most daily imports, and DuckDB already dictionary-compresses repeated strings.
+SCHEMAS = ['standard', 'compact', 'compact-float']
+
+# ENUM types earlier versions of the compact schemas used for the text columns,
+# dropped when such a table is converted
+LEGACY_ENUM_TYPES = ['stock_code_enum', 'stock_name_enum', 'industry_enum']
+
+INTRADAY_PRICE_COLUMNS = {'price_0935', 'price_0945', 'price_0955'}
+
+def stock_data_column_definitions(schema='standard'):
+    """
+    Builds the column definitions of the stock_data table from HEADER_MAPPING.
+
+    Args:
+        schema (str): One of SCHEMAS.
+
+    Returns:
+        list: Column definitions such as "open_price DOUBLE", in HEADER_MAPPING order.
+    """
+    column_definitions = []
+    for db_column in HEADER_MAPPING.values():
+        if db_column in FLOAT_COLUMNS:
+            if schema == 'compact-float' and db_column in INTRADAY_PRICE_COLUMNS:
+                column_definitions.append(f"{db_column} FLOAT")
+            else:
+                column_definitions.append(f"{db_column} DOUBLE")
+        elif db_column in FLAG_COLUMNS:
+            column_definitions.append(f"{db_column} {'INTEGER' if schema == 'standard' else 'BOOLEAN'}")
+        elif db_column == 'trade_date':
+            column_definitions.append(f"{db_column} DATE") # Use DATE type for trade_date
+        else:
+            column_definitions.append(f"{db_column} VARCHAR") # Default to VARCHAR for text fields
+    return column_definitions
 
 def convert_and_read_csv(file_path):
     """
@@ -17,48 +137,6 @@ def convert_and_read_csv(file_path):
         list: A list of dictionaries, where each dictionary represents a row of data.
     """
     data = []
-    # Define the mapping from CSV header names to desired column names and types
-    # This mapping ensures consistent column names for the DuckDB table
-    header_mapping = {
-        '股票代码': 'stock_code',
-        '股票名称': 'stock_name',
-        '交易日期': 'trade_date',
-        '开盘价': 'open_price',
-        '最高价': 'high_price',
-        '最低价': 'low_price',
-        '收盘价': 'close_price',
-        '前收盘价': 'prev_close_price',
-        '成交量': 'volume',
-        '成交额': 'turnover',
-        '流通市值': 'market_cap',
-        '总市值': 'total_market_cap',
-        '净利润TTM': 'net_profit_ttm',
-        '现金流TTM': 'cash_flow_ttm',
-        '净资产': 'net_assets',
-        '总资产': 'total_assets',
-        '总负债': 'total_liabilities',
-        '净利润(当季)': 'net_profit_quarter',
-        '中户资金买入额': 'mid_investor_buy',
-        '中户资金卖出额': 'mid_investor_sell',
-        '大户资金买入额': 'large_investor_buy',
-        '大户资金卖出额': 'large_investor_sell',
-        '散户资金买入额': 'retail_investor_buy',
-        '散户资金卖出额': 'retail_investor_sell',
-        '机构资金买入额': 'institutional_buy',
-        '机构资金卖出额': 'institutional_sell',
-        '沪深300成分股': 'hs300_component',
-        '上证50成分股': 'sse50_component',
-        '中证500成分股': 'csi500_component',
-        '中证1000成分股': 'csi1000_component',
-        '中证2000成分股': 'csi2000_component',
-        '创业板指成分股': 'gem_component',
-        '新版申万一级行业名称': 'industry_level1',
-        '新版申万二级行业名称': 'industry_level2',
-        '新版申万三级行业名称': 'industry_level3',
-        '09:35收盘价': 'price_0935',
-        '09:45收盘价': 'price_0945',
-        '09:55收盘价': 'price_0955'
-    }
 
     encodings = ['utf-8', 'gb2312']
     for encoding in encodings:
@@ -74,7 +152,7 @@ def convert_and_read_csv(file_path):
                 # Check if all required headers are present after mapping
                 # This helps in debugging if a file has unexpected headers
                 missing_headers = [
-                    csv_h for csv_h, db_h in header_mapping.items() 
+                    csv_h for csv_h, db_h in HEADER_MAPPING.items() 
                     if csv_h not in reader.fieldnames
                 ]
                 if missing_headers:
@@ -85,21 +163,13 @@ def convert_and_read_csv(file_path):
                 #    and process them as data rows
                 for row in reader:
                     processed_row = {}
-                    for csv_header, db_column in header_mapping.items():
+                    for csv_header, db_column in HEADER_MAPPING.items():
                         value = row.get(csv_header) # Use .get() to avoid KeyError if header is truly missing
 
                         # Convert values to appropriate types, handle None for empty strings
-                        if db_column in ['open_price', 'high_price', 'low_price', 'close_price',
-                                         'prev_close_price', 'volume', 'turnover', 'market_cap',
-                                         'total_market_cap', 'net_profit_ttm', 'cash_flow_ttm',
-                                         'net_assets', 'total_assets', 'total_liabilities',
-                                         'net_profit_quarter', 'mid_investor_buy', 'mid_investor_sell',
-                                         'large_investor_buy', 'large_investor_sell', 'retail_investor_buy',
-                                         'retail_investor_sell', 'institutional_buy', 'institutional_sell',
-                                         'price_0935', 'price_0945', 'price_0955']:
+                        if db_column in FLOAT_COLUMNS:
                             processed_row[db_column] = float(value) if value else None
-                        elif db_column in ['hs300_component', 'sse50_component', 'csi500_component',
-                                           'csi1000_component', 'csi2000_component', 'gem_component']:
+                        elif db_column in FLAG_COLUMNS:
                             processed_row[db_column] = 1 if value and value.lower() == 'true' else 0
                         else:
                             processed_row[db_column] = value
@@ -113,118 +183,459 @@ def convert_and_read_csv(file_path):
     # If no encoding worked, return empty list
     return []
 
-def main():
-    duckdb_path = "./stock_data.duckdb"
-    if os.path.exists(duckdb_path):
-        os.remove(duckdb_path)
-    
-    # Connect to DuckDB (creates a file-based database 'stock_data.duckdb' if not exists)
-    # Using a file-based database persists data across runs.
-    # For in-memory database: con = duckdb.connect(database=':memory:')
-    con = duckdb.connect(database=duckdb_path, read_only=False)
-    print(f"Connected to DuckDB database: {duckdb_path}")
+def create_stock_data_table(con, table_name='stock_data', schema='standard'):
+    """
+    Creates the stock_data table if it does not exist. (stock_code, trade_date) is the
+    primary key, so every stock has at most one row per trading day and queries can
+    read the table directly instead of de-duplicating it with SELECT DISTINCT.
+    """
+    con.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(stock_data_column_definitions(schema))}, PRIMARY KEY (stock_code, trade_date));")
 
-    data_dir = f'F:\股票数据\stock-trading-data-pro-2025-08-19'
-    
-    # Ensure the directory exists
-    if not os.path.isdir(data_dir):
-        print(f"Error: Data directory '{data_dir}' not found. Please create it and place CSV files inside.")
+def current_schema(con):
+    """
+    Detects the schema of the existing stock_data table from its column types.
+
+    Returns:
+        str: One of SCHEMAS, or None if stock_data does not exist.
+    """
+    column_types = dict(con.execute(
+        "SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = 'stock_data'"
+    ).fetchall())
+    if not column_types:
+        return None
+    if column_types['hs300_component'] != 'BOOLEAN':
+        return 'standard'
+    return 'compact-float' if column_types['price_0935'] == 'FLOAT' else 'compact'
+
+def has_enum_columns(con):
+    """
+    Checks whether stock_data still stores text columns as ENUM, as earlier versions of
+    the compact schemas did.
+    """
+    return con.execute(
+        "SELECT COUNT(*) FROM duckdb_columns() WHERE table_name = 'stock_data' AND data_type LIKE 'ENUM%'"
+    ).fetchone()[0] > 0
+
+def rebuild_stock_data(con, schema):
+    """
+    Rewrites stock_data in the given schema, sorted by (stock_code, trade_date).
+    The rows are parked in a temporary table with standard types first, so the ENUM
+    types of an earlier compact table can be dropped once no table uses them.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        schema (str): One of SCHEMAS.
+    """
+    columns = ", ".join(HEADER_MAPPING.values())
+    standard_columns = ", ".join(
+        f"CAST({definition.split(' ')[0]} AS {definition.split(' ')[1]}) AS {definition.split(' ')[0]}"
+        for definition in stock_data_column_definitions()
+    )
+    con.execute("BEGIN TRANSACTION;")
+    con.execute(f"CREATE OR REPLACE TEMP TABLE stock_data_rebuild AS SELECT {standard_columns} FROM stock_data;")
+    con.execute("DROP TABLE stock_data;")
+    for type_name in LEGACY_ENUM_TYPES:
+        con.execute(f"DROP TYPE IF EXISTS {type_name};")
+    create_stock_data_table(con, 'stock_data', schema)
+    con.execute(f"""
+        INSERT INTO stock_data ({columns})
+        SELECT {columns} FROM stock_data_rebuild
+        ORDER BY stock_code, trade_date;
+    """)
+    con.execute("DROP TABLE stock_data_rebuild;")
+    con.execute("COMMIT;")
+    # Views keep the column types they were created with, recreate adjusted_stock_data
+    create_corporate_actions_table(con)
+
+def migrate_schema(con, schema):
+    """
+    Converts stock_data to the requested schema if it uses a different one, printing
+    the database size before and after. A table with the ENUM text columns of earlier
+    compact schemas is converted to VARCHAR once, keeping its schema when none is given.
+    """
+    previous_schema = current_schema(con)
+    if previous_schema is None:
+        return
+    if has_enum_columns(con):
+        schema = schema or previous_schema
+        previous_schema += ' (ENUM text columns)'
+    elif schema is None or schema == previous_schema:
         return
+    con.execute("CHECKPOINT;")
+    size_before = con.execute("SELECT used_blocks * block_size FROM pragma_database_size()").fetchone()[0]
+    print(f"Converting stock_data from the {previous_schema} schema to the {schema} schema...")
+    start_time = time.time()
+    rebuild_stock_data(con, schema)
+    con.execute("CHECKPOINT;")
+    size_after = con.execute("SELECT used_blocks * block_size FROM pragma_database_size()").fetchone()[0]
+    print(f"Schema converted in {time.time() - start_time:.2f} seconds, "
+          f"database size {size_before / 1024 / 1024:,.1f} MB -> {size_after / 1024 / 1024:,.1f} MB.")
 
-    csv_files = [f for f in os.listdir(data_dir) if f.endswith('.csv')]
-    
-    if not csv_files:
-        print(f"No CSV files found in '{data_dir}'. Please ensure your CSV files are in this directory.")
+def report_key_conflicts(con, source, label):
+    """
+    Prints how many rows of source share a (stock_code, trade_date) key with another row.
+    Exact duplicates are harmless and only counted; keys whose rows differ in any column
+    are conflicts and a few of them are listed, since only one version can be kept.
+
+    Args:
+        con: An open DuckDB connection.
+        source (str): Table or subquery holding the stock_data columns.
+        label (str): Name used in the printed report.
+
+    Returns:
+        int: Number of conflicting keys.
+    """
+    columns = ", ".join(HEADER_MAPPING.values())
+    total_rows, distinct_rows = con.execute(f"""
+        SELECT (SELECT COUNT(*) FROM {source}), (SELECT COUNT(*) FROM (SELECT DISTINCT {columns} FROM {source}))
+    """).fetchone()
+    conflicts = con.execute(f"""
+        SELECT stock_code, trade_date, COUNT(*) AS versions
+        FROM (SELECT DISTINCT {columns} FROM {source})
+        GROUP BY stock_code, trade_date
+        HAVING COUNT(*) > 1
+        ORDER BY stock_code, trade_date
+    """).fetchall()
+    if total_rows > distinct_rows or conflicts:
+        print(f"{label}: {total_rows - distinct_rows} exact duplicate rows dropped, "
+              f"{len(conflicts)} (stock_code, trade_date) keys with conflicting values.")
+        for stock_code, trade_date, versions in conflicts[:10]:
+            print(f"  Conflict: {stock_code} {trade_date} has {versions} different versions, keeping one.")
+        if len(conflicts) > 10:
+            print(f"  ... and {len(conflicts) - 10} more conflicting keys.")
+    return len(conflicts)
+
+def ensure_stock_data_primary_key(con):
+    """
+    Makes sure stock_data exists with its (stock_code, trade_date) primary key.
+    Databases created before the key was introduced may hold duplicate rows: they are
+    de-duplicated into a new table with the key, which then replaces the old table.
+    For conflicting keys the most recently inserted row is kept, the same way a
+    re-import replaces older rows. Rows without stock_code or trade_date are dropped.
+    """
+    exists = con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'stock_data'"
+    ).fetchone()[0]
+    if not exists:
+        create_stock_data_table(con)
+        return
+    has_primary_key = con.execute(
+        "SELECT COUNT(*) FROM duckdb_constraints() WHERE table_name = 'stock_data' AND constraint_type = 'PRIMARY KEY'"
+    ).fetchone()[0]
+    if has_primary_key:
         return
 
-    # Define the column mapping and types for explicit table creation
-    header_mapping_for_schema = {
-        '股票代码': 'stock_code',
-        '股票名称': 'stock_name',
-        '交易日期': 'trade_date',
-        '开盘价': 'open_price',
-        '最高价': 'high_price',
-        '最低价': 'low_price',
-        '收盘价': 'close_price',
-        '前收盘价': 'prev_close_price',
-        '成交量': 'volume',
-        '成交额': 'turnover',
-        '流通市值': 'market_cap',
-        '总市值': 'total_market_cap',
-        '净利润TTM': 'net_profit_ttm',
-        '现金流TTM': 'cash_flow_ttm',
-        '净资产': 'net_assets',
-        '总资产': 'total_assets',
-        '总负债': 'total_liabilities',
-        '净利润(当季)': 'net_profit_quarter',
-        '中户资金买入额': 'mid_investor_buy',
-        '中户资金卖出额': 'mid_investor_sell',
-        '大户资金买入额': 'large_investor_buy',
-        '大户资金卖出额': 'large_investor_sell',
-        '散户资金买入额': 'retail_investor_buy',
-        '散户资金卖出额': 'retail_investor_sell',
-        '机构资金买入额': 'institutional_buy',
-        '机构资金卖出额': 'institutional_sell',
-        '沪深300成分股': 'hs300_component',
-        '上证50成分股': 'sse50_component',
-        '中证500成分股': 'csi500_component',
-        '中证1000成分股': 'csi1000_component',
-        '中证2000成分股': 'csi2000_component',
-        '创业板指成分股': 'gem_component',
-        '新版申万一级行业名称': 'industry_level1',
-        '新版申万二级行业名称': 'industry_level2',
-        '新版申万三级行业名称': 'industry_level3',
-        '09:35收盘价': 'price_0935',
-        '09:45收盘价': 'price_0945',
-        '09:55收盘价': 'price_0955'
-    }
+    print("Table 'stock_data' has no primary key yet, de-duplicating it on (stock_code, trade_date)...")
+    columns = ", ".join(HEADER_MAPPING.values())
+    report_key_conflicts(con, 'stock_data', "stock_data migration")
+    before_rows = con.execute("SELECT COUNT(*) FROM stock_data").fetchone()[0]
+    con.execute("BEGIN TRANSACTION;")
+    con.execute("DROP TABLE IF EXISTS stock_data_dedup;")
+    create_stock_data_table(con, 'stock_data_dedup')
+    con.execute(f"""
+        INSERT INTO stock_data_dedup ({columns})
+        SELECT {columns} FROM stock_data
+        WHERE stock_code IS NOT NULL AND trade_date IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY stock_code, trade_date ORDER BY rowid DESC) = 1;
+    """)
+    con.execute("DROP TABLE stock_data;")
+    con.execute("ALTER TABLE stock_data_dedup RENAME TO stock_data;")
+    con.execute("COMMIT;")
+    after_rows = con.execute("SELECT COUNT(*) FROM stock_data").fetchone()[0]
+    print(f"Table 'stock_data' de-duplicated: {before_rows} rows -> {after_rows} rows.")
 
-    # Define schema for the stock_data table based on header_mapping
-    column_definitions = []
-    for csv_header, db_column in header_mapping_for_schema.items():
-        if db_column in ['open_price', 'high_price', 'low_price', 'close_price',
-                         'prev_close_price', 'volume', 'turnover', 'market_cap',
-                         'total_market_cap', 'net_profit_ttm', 'cash_flow_ttm',
-                         'net_assets', 'total_assets', 'total_liabilities',
-                         'net_profit_quarter', 'mid_investor_buy', 'mid_investor_sell',
-                         'large_investor_buy', 'large_investor_sell', 'retail_investor_buy',
-                         'retail_investor_sell', 'institutional_buy', 'institutional_sell',
-                         'price_0935', 'price_0945', 'price_0955']:
-            column_definitions.append(f"{db_column} DOUBLE")
-        elif db_column in ['hs300_component', 'sse50_component', 'csi500_component',
-                           'csi1000_component', 'csi2000_component', 'gem_component']:
-            column_definitions.append(f"{db_column} INTEGER")
-        elif db_column == 'trade_date':
-            column_definitions.append(f"{db_column} DATE") # Use DATE type for trade_date
-        else:
-            column_definitions.append(f"{db_column} VARCHAR") # Default to VARCHAR for text fields
-    
-    # Create the stock table if it does not exist. This ensures existing data is not deleted.
-    try:
-        create_table_sql = f"CREATE TABLE IF NOT EXISTS stock_data ({', '.join(column_definitions)});"
-        con.execute(create_table_sql)
-        print("Table 'stock_data' ensured to exist with defined schema (or created if new).")
-    except Exception as e:
-        print(f"Error ensuring table 'stock_data' exists: {e}")
-        con.close()
+def create_corporate_actions_table(con):
+    """
+    Creates the corporate_actions table and the adjusted_stock_data view shared by
+    the screener, the backtest and the dip finder.
+
+    corporate_actions holds one row per ex-rights/ex-dividend day, the days where
+    prev_close_price differs from the close of the previous trading day:
+      factor: prev_close_price / previous close, the price change caused by the event.
+      cumulative_factor: product of the factors of this and all later events of the stock.
+    The forward-adjusted price of a day is its price times the cumulative_factor of the
+    first event after it, found with an ASOF join, so adjusting needs no per-row
+    LN/EXP and only a few thousand event rows besides stock_data.
+    A missing or zero prev_close_price counts as no price change that day, as in the
+    EXP(SUM(LN(1 + rise_fall))) factor the query scripts used to compute.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CORPORATE_ACTIONS_TABLE} (
+            stock_code VARCHAR,
+            ex_date DATE,
+            factor DOUBLE,
+            cumulative_factor DOUBLE,
+            PRIMARY KEY (stock_code, ex_date)
+        );
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {ADJUSTED_VIEW} AS
+        SELECT
+            s.stock_code, s.stock_name, s.trade_date, s.open_price, s.close_price, s.high_price, s.low_price, s.prev_close_price,
+            s.market_cap, s.total_market_cap, s.industry_level1, s.industry_level2, s.industry_level3,
+            COALESCE(c.cumulative_factor, 1) AS adjust_multiplier,
+            s.close_price * COALESCE(c.cumulative_factor, 1) AS adj_close_price,
+            (s.open_price / NULLIF(s.close_price, 0)) * (s.close_price * COALESCE(c.cumulative_factor, 1)) AS adj_open_price,
+            (s.high_price / NULLIF(s.close_price, 0)) * (s.close_price * COALESCE(c.cumulative_factor, 1)) AS adj_high_price,
+            (s.low_price / NULLIF(s.close_price, 0)) * (s.close_price * COALESCE(c.cumulative_factor, 1)) AS adj_low_price,
+            (s.prev_close_price / NULLIF(s.close_price, 0)) * (s.close_price * COALESCE(c.cumulative_factor, 1)) AS adj_prev_close_price
+        FROM stock_data s
+        ASOF LEFT JOIN {CORPORATE_ACTIONS_TABLE} c ON s.stock_code = c.stock_code AND s.trade_date < c.ex_date;
+    """)
+
+def create_trading_calendar_table(con):
+    """
+    Creates the trading_calendar table: every date with at least one row in stock_data
+    and its trading_day, the 1-based ordinal of that date among all trading dates.
+    "N trading days later" is then trading_day + N, holidays included. The query
+    scripts join it to the rows that need an ordinal after filtering, which is cheaper
+    than carrying the ordinal through the adjusted_stock_data view.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TRADING_CALENDAR_TABLE} (
+            trade_date DATE PRIMARY KEY,
+            trading_day INTEGER
+        );
+    """)
+
+def refresh_trading_calendar(con):
+    """
+    Rebuilds trading_calendar from the distinct trade dates of stock_data. The whole
+    table is renumbered, since a date loaded out of order shifts every later ordinal;
+    it only holds one row per trading date, so this takes milliseconds.
+    """
+    con.execute(f"DELETE FROM {TRADING_CALENDAR_TABLE};")
+    con.execute(f"""
+        INSERT INTO {TRADING_CALENDAR_TABLE}
+        SELECT trade_date, ROW_NUMBER() OVER (ORDER BY trade_date)
+        FROM (SELECT DISTINCT trade_date FROM stock_data WHERE trade_date IS NOT NULL)
+        ORDER BY trade_date;
+    """)
+
+def ensure_trading_calendar(con):
+    """
+    Fills trading_calendar when it does not match the trade dates of stock_data, e.g.
+    for a database imported before the table existed.
+    """
+    create_trading_calendar_table(con)
+    calendar_days, stock_days = con.execute(f"""
+        SELECT (SELECT COUNT(*) FROM {TRADING_CALENDAR_TABLE}),
+               (SELECT COUNT(DISTINCT trade_date) FROM stock_data)
+    """).fetchone()
+    if calendar_days == stock_days:
         return
-    
-    # Create the finance table if it does not exist
-    try:
-        create_table_sql = f'CREATE TABLE stock_finance_data(stock_code VARCHAR, statement_format VARCHAR, report_date VARCHAR, publish_date VARCHAR, "抓取时间" VARCHAR, B_currency_fund DOUBLE, B_settle_reserves DOUBLE, B_lending_fund DOUBLE, B_tradable_fnncl_assets DOUBLE, B_derivative_fnncl_assets DOUBLE, B_bill_receivable DOUBLE, B_account_receivable DOUBLE, B_bill_and_account_receivable DOUBLE, B_receivable_financing DOUBLE, B_prepays DOUBLE, B_premium_receivable DOUBLE, B_rein_account_receivable DOUBLE, B_rein_contract_reserve DOUBLE, B_interest_receivable DOUBLE, B_dividend_receivable DOUBLE, B_other_receivables DOUBLE, B_other_receivables_sum DOUBLE, B_buy_resale_fnncl_assets DOUBLE, B_inventory DOUBLE, B_contract_asset DOUBLE, B_divided_into_asset_for_sale DOUBLE, B_noncurrent_asset_due_within1y DOUBLE, B_other_cunrren_assets DOUBLE, B_flow_assets_diff_sri DOUBLE, B_flow_assets_diff_tbi DOUBLE, B_total_current_assets DOUBLE, B_loans_and_payments DOUBLE, B_fa_calc_by_amortized_cost DOUBLE, B_other_compre_fa_by_fv DOUBLE, B_saleable_finacial_assets DOUBLE, B_held_to_maturity_invest DOUBLE, B_debt_right_invest DOUBLE, B_other_debt_right_invest DOUBLE, B_lt_receivable DOUBLE, B_lt_equity_invest DOUBLE, B_other_ei_invest DOUBLE, B_other_uncurrent_fa DOUBLE, B_invest_property DOUBLE, B_fixed_asset DOUBLE, B_fixed_asset_sum DOUBLE, B_construction_in_process DOUBLE, B_construction_in_process_sum DOUBLE, B_project_goods_and_material DOUBLE, B_fixed_assets_disposal DOUBLE, B_productive_biological_assets DOUBLE, B_oil_and_gas_asset DOUBLE, B_right_of_use_assets DOUBLE, B_intangible_assets DOUBLE, B_dev_expenditure DOUBLE, B_goodwill DOUBLE, B_lt_deferred_expense DOUBLE, B_dt_assets DOUBLE, B_othr_noncurrent_assets DOUBLE, B_noncurrent_assets_diff_sri DOUBLE, B_noncurrent_assets_diff_tbi DOUBLE, B_total_noncurrent_assets DOUBLE, B_asset_diff_sri DOUBLE, B_asset_diff_tbi DOUBLE, B_total_assets DOUBLE, B_st_borrow DOUBLE, B_loan_from_central_bank DOUBLE, B_saving_and_interbank_deposit DOUBLE, B_borrowing_funds DOUBLE, B_tradable_fnncl_liab DOUBLE, B_derivative_fnncl_liab DOUBLE, B_bill_payable DOUBLE, B_accounts_payable DOUBLE, B_bill_and_account_payable DOUBLE, B_advance_payment DOUBLE, B_contract_liab DOUBLE, B_fnncl_assets_sold_for_repur DOUBLE, B_charge_and_commi_payable DOUBLE, B_payroll_payable DOUBLE, B_tax_payable DOUBLE, B_interest_payable DOUBLE, B_dividend_payable DOUBLE, B_other_payables DOUBLE, B_other_payables_sum DOUBLE, B_rein_payable DOUBLE, B_insurance_contract_reserve DOUBLE, B_acting_td_sec DOUBLE, B_act_underwriting_sec DOUBLE, B_divided_into_liab_for_sale DOUBLE, B_noncurrent_liab_due_in1y DOUBLE, B_differed_income_current_liab DOUBLE, B_st_bond_payable DOUBLE, B_other_current_liab DOUBLE, B_flow_debt_diff_sri DOUBLE, B_flow_debt_diff_tbi DOUBLE, B_total_current_liab DOUBLE, B_lt_loan DOUBLE, B_bond_payable DOUBLE, B_perpetual_capital_sec DOUBLE, B_preferred DOUBLE, B_lease_libilities DOUBLE, B_lt_payable DOUBLE, B_lt_payable_sum DOUBLE, B_lt_staff_salary_payable DOUBLE, B_special_payable DOUBLE, B_estimated_liab DOUBLE, B_dt_liab DOUBLE, B_differed_incomencl DOUBLE, B_othr_noncurrent_liab DOUBLE, B_noncurrent_liab_diff_sri DOUBLE, B_noncurrent_liab_diff_sbi DOUBLE, B_total_noncurrent_liab DOUBLE, B_liab_diff_sri DOUBLE, B_liab_diff_tbi DOUBLE, B_total_liab DOUBLE, B_actual_received_capital DOUBLE, B_capital_reserve DOUBLE, B_treasury DOUBLE, B_bs_other_compre_income DOUBLE, B_other_equity_instruments DOUBLE, B_preferred_shares DOUBLE, B_appropriative_reserve DOUBLE, B_earned_surplus DOUBLE, B_general_risk_provision DOUBLE, B_undstrbtd_profit DOUBLE, B_frgn_currency_convert_diff DOUBLE, B_total_equity_atoopc DOUBLE, B_minority_equity DOUBLE, B_holder_equity_diff_sri DOUBLE, B_equity_right_diff_tbi DOUBLE, B_total_owner_equity DOUBLE, B_liab_and_equity_diff_sri DOUBLE, B_liab_and_equity_diff_tbi DOUBLE, B_total_liab_and_owner_equity DOUBLE, R_operating_total_revenue DOUBLE, R_revenue DOUBLE, R_interest_income DOUBLE, R_earned_premium DOUBLE, R_fee_and_commi_income DOUBLE, R_operating_revenuediff_sri DOUBLE, R_operating_revenuediff_tbi DOUBLE, R_operating_total_cost DOUBLE, R_operating_cost DOUBLE, R_interest_payout DOUBLE, R_charge_and_commi_expenses DOUBLE, R_refunded_premium DOUBLE, R_compensate_net_pay DOUBLE, R_extract_ic_reserve_net_amt DOUBLE, R_commi_on_insurance_policy DOUBLE, R_rein_expenditure DOUBLE, R_operating_taxes_and_surcharge DOUBLE, R_sales_fee DOUBLE, R_manage_fee DOUBLE, R_rad_cost_sum DOUBLE, R_financing_expenses DOUBLE, R_interest_fee DOUBLE, R_fc_interest_income DOUBLE, R_asset_impairment_loss DOUBLE, R_credit_impairment_loss DOUBLE, R_operating_cost_diff_sri DOUBLE, R_operating_cost_diff_tbi DOUBLE, R_fv_chg_income DOUBLE, R_invest_income DOUBLE, R_ii_from_jc_etc DOUBLE, R_amortized_cost_fnncl_ass_cfrm DOUBLE, R_net_open_hedge_income DOUBLE, R_exchange_gain DOUBLE, R_asset_disposal_gain DOUBLE, R_other_income DOUBLE, R_op_diff_sri DOUBLE, R_op_diff_tbi DOUBLE, R_op DOUBLE, R_non_operating_income DOUBLE, R_noncurrent_asset_dispose_gain DOUBLE, R_nonoperating_cost DOUBLE, R_noncurrent_asset_dispose_loss DOUBLE, R_total_profit_diff_sri DOUBLE, R_total_profit_diff_tbi DOUBLE, R_total_profit DOUBLE, R_income_tax_cost DOUBLE, R_np_diff_sri DOUBLE, R_np_diff_tbi DOUBLE, R_np DOUBLE, R_continued_operating_np DOUBLE, R_stop_operating_np DOUBLE, R_np_atoopc DOUBLE, R_minority_gal DOUBLE, R_basic_eps DOUBLE, R_dlt_earnings_per_share DOUBLE, R_othrcompre_income_atoopc DOUBLE, R_cannt_reclass_to_gal DOUBLE, R_asset_change_due_to_remeasure DOUBLE, R_cannt_reclass_gal_equity_law DOUBLE, R_other_not_reclass_to_gal DOUBLE, R_other_equity_invest_fvc DOUBLE, R_corp_credit_risk_fvc DOUBLE, R_reclass_to_gal DOUBLE, R_reclass_togal_in_equity_law DOUBLE, R_saleable_fv_chg_gal DOUBLE, R_reclass_and_salable_gal DOUBLE, R_cf_hedging_gal_valid_part DOUBLE, R_fc_convert_diff DOUBLE, R_other_reclass_to_gal DOUBLE, R_other_debt_right_invest_fvc DOUBLE, R_fa_reclassi_amt DOUBLE, R_other_debt_right_invest_ir DOUBLE, R_cash_flow_hedge_reserve DOUBLE, R_othrcompre_income_atms DOUBLE, R_total_compre_income DOUBLE, R_total_compre_income_atsopc DOUBLE, R_total_compre_income_atms DOUBLE, C_effect_of_exchange_chg_on_cce DOUBLE, C_cce_net_add_amt_diff_sri_dm DOUBLE, C_cce_net_add_amt_diff_tbi_dm DOUBLE, C_cash_received_of_sales_service DOUBLE, C_deposit_and_interbank_net_add DOUBLE, C_borrowing_net_add_central_bank DOUBLE, C_lending_net_add_other_org DOUBLE, C_cash_received_from_orig_ic DOUBLE, C_net_cash_received_from_rein DOUBLE, C_naaassured_saving_and_invest DOUBLE, C_naa_of_disposal_fnncl_assets DOUBLE, C_cash_received_of_interest_etc DOUBLE, C_borrowing_net_increase_amt DOUBLE, C_net_add_in_repur_capital DOUBLE, C_refund_of_tax_and_levies DOUBLE, C_cash_received_of_other_oa DOUBLE, C_oa_cash_inflow_diff_sri DOUBLE, C_oa_cash_inflow_diff_tbi DOUBLE, C_sub_total_of_ci_from_oa DOUBLE, C_goods_buy_and_service_cash_pay DOUBLE, C_loan_and_advancenet_add DOUBLE, C_naa_of_cb_and_interbank DOUBLE, C_cash_of_orig_ic_indemnity DOUBLE, C_cash_paid_for_interests_etc DOUBLE, C_cash_paid_for_pd DOUBLE, C_cash_paid_to_staff_etc DOUBLE, C_payments_of_all_taxes DOUBLE, C_other_cash_paid_related_to_oa DOUBLE, C_oa_cash_outflow_diff_sri DOUBLE, C_oa_cash_outflow_diff_tbi DOUBLE, C_sub_total_of_cos_from_oa DOUBLE, C_ncf_diff_of_oa_sri DOUBLE, C_ncf_diff_of_oa_tbi DOUBLE, C_ncf_from_oa DOUBLE, C_cash_received_of_dspsl_invest DOUBLE, C_invest_income_cash_received DOUBLE, C_net_cash_of_disposal_assets DOUBLE, C_net_cash_of_disposal_branch DOUBLE, C_cash_received_of_other_fa DOUBLE, C_ia_cash_inflow_diff_sri DOUBLE, C_ia_cash_inflow_diff_tbi DOUBLE, C_sub_total_of_ci_from_ia DOUBLE, C_cash_paid_for_assets DOUBLE, C_invest_paid_cash DOUBLE, C_net_add_in_pledge_loans DOUBLE, C_net_cash_amt_from_branch DOUBLE, C_other_cash_paid_related_to_ia DOUBLE, C_ia_cash_outflow_diff_sri DOUBLE, C_ia_cash_outflow_diff_tbi DOUBLE, C_sub_total_of_cos_from_ia DOUBLE, C_ncf_diff_from_ia_sri DOUBLE, C_ncf_diff_from_ia_tbi DOUBLE, C_ncf_from_ia DOUBLE, C_cash_received_of_absorb_invest DOUBLE, C_cr_from_minority_holders DOUBLE, C_cash_received_of_borrowing DOUBLE, C_cash_received_from_bond_issue DOUBLE, C_cash_received_of_othr_fa DOUBLE, C_fa_cash_in_flow_diff_sri DOUBLE, C_fa_cash_in_flow_diff_tbi DOUBLE, C_sub_total_of_ci_from_fa DOUBLE, C_cash_pay_for_debt DOUBLE, C_cash_paid_of_distribution DOUBLE, C_dap_paid_to_minority_holder DOUBLE, C_othrcash_paid_relating_to_fa DOUBLE, C_fa_cash_out_flow_diff_sri DOUBLE, C_fa_cash_out_flow_diff_tbi DOUBLE, C_sub_total_of_cos_from_fa DOUBLE, C_ncf_diff_from_fa_sri DOUBLE, C_ncf_diff_from_fa_tbi DOUBLE, C_ncf_from_fa DOUBLE, C_net_increase_in_cce DOUBLE, C_initial_cce_balance DOUBLE, C_final_balance_of_cce DOUBLE, C_np_cfs DOUBLE, C_asset_impairment_reserve DOUBLE, C_depreciation_etc DOUBLE, C_intangible_assets_amortized DOUBLE, C_lt_deferred_expenses_amrtzt DOUBLE, C_loss_of_disposal_assets DOUBLE, C_fixed_assets_scrap_loss DOUBLE, C_loss_from_fv_chg DOUBLE, C_finance_cost_cfs DOUBLE, C_invest_loss DOUBLE, C_dt_assets_decrease DOUBLE, C_dt_liab_increase DOUBLE, C_inventory_decrease DOUBLE, C_operating_items_decrease DOUBLE, C_increase_of_operating_item DOUBLE, C_si_other DOUBLE, C_ncf_diff_from_oa_im_sri DOUBLE, C_ncf_diff_from_oa_im_tbi DOUBLE, C_ncf_from_oa_im DOUBLE, C_debt_tranfer_to_capital DOUBLE, C_cb_due_within1y DOUBLE, C_finance_lease_fixed_assets DOUBLE, C_ending_balance_of_cash DOUBLE, C_initial_balance_of_cash DOUBLE, C_si_final_balance_of_cce DOUBLE, C_initial_balance_of_cce DOUBLE, C_cce_net_add_diff_im_sri DOUBLE, C_cce_net_add_diff_im_tbi DOUBLE, C_net_increase_in_cce_im DOUBLE);'
-        con.execute(create_table_sql)
-        print("Table 'stock_finance_data' ensured to exist with defined schema (or created if new).")
-    except Exception as e:
-        print(f"Error ensuring table 'stock_finance_data' exists: {e}")
-        con.close()
+    con.execute("BEGIN TRANSACTION;")
+    refresh_trading_calendar(con)
+    con.execute("COMMIT;")
+    print(f"Trading calendar rebuilt with {stock_days} trading days.")
+
+def create_security_master_table(con):
+    """
+    Creates the security_master table, one row per stock:
+      exchange: sh, sz or bj, the code prefix.
+      board: the board the Parquet dataset is partitioned by (sh60x, sz00x, sz30x, sh688, bj, other).
+      amplitude_bucket: main or growth, which condition 3 threshold applies; NULL for
+                        other boards, which never pass condition 3.
+      listing_date / last_trade_date: first and last trade date in stock_data.
+      stock_name, industry_level1-3: as of the last trade date.
+    The query scripts join it instead of classifying every row by code prefix.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SECURITY_MASTER_TABLE} (
+            stock_code VARCHAR PRIMARY KEY,
+            exchange VARCHAR,
+            board VARCHAR,
+            amplitude_bucket VARCHAR,
+            listing_date DATE,
+            last_trade_date DATE,
+            stock_name VARCHAR,
+            industry_level1 VARCHAR,
+            industry_level2 VARCHAR,
+            industry_level3 VARCHAR
+        );
+    """)
+
+def refresh_security_master(con, stocks_sql=None):
+    """
+    Rebuilds the security_master rows of the given stocks from stock_data.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        stocks_sql (str): Query returning the stock_code values to refresh.
+                          When None, every stock is rebuilt.
+    """
+    if stocks_sql is None:
+        stock_filter = "TRUE"
+    else:
+        stock_filter = f"stock_code IN ({stocks_sql})"
+    con.execute(f"DELETE FROM {SECURITY_MASTER_TABLE} WHERE {stock_filter};")
+    con.execute(f"""
+        INSERT INTO {SECURITY_MASTER_TABLE}
+        SELECT
+            stock_code,
+            LEFT(stock_code, 2) AS exchange,
+            {BOARD_SQL} AS board,
+            {AMPLITUDE_BUCKET_SQL} AS amplitude_bucket,
+            MIN(trade_date) AS listing_date,
+            MAX(trade_date) AS last_trade_date,
+            CAST(arg_max(stock_name, trade_date) AS VARCHAR) AS stock_name,
+            CAST(arg_max(industry_level1, trade_date) AS VARCHAR) AS industry_level1,
+            CAST(arg_max(industry_level2, trade_date) AS VARCHAR) AS industry_level2,
+            CAST(arg_max(industry_level3, trade_date) AS VARCHAR) AS industry_level3
+        FROM stock_data
+        WHERE {stock_filter}
+        GROUP BY stock_code
+        ORDER BY stock_code;
+    """)
+
+def ensure_security_master(con):
+    """
+    Fills security_master when it does not list every stock of stock_data, e.g. for a
+    database imported before the table existed.
+    """
+    create_security_master_table(con)
+    master_stocks, stock_count = con.execute(f"""
+        SELECT (SELECT COUNT(*) FROM {SECURITY_MASTER_TABLE}),
+               (SELECT COUNT(DISTINCT stock_code) FROM stock_data)
+    """).fetchone()
+    if master_stocks == stock_count:
+        return
+    con.execute("BEGIN TRANSACTION;")
+    refresh_security_master(con)
+    con.execute("COMMIT;")
+    print(f"Security master rebuilt with {stock_count} stocks.")
+
+def refresh_corporate_actions(con, stocks_sql=None):
+    """
+    Detects the corporate actions of the given stocks in one vectorized pass over
+    stock_data, comparing prev_close_price with the previous close, and replaces their
+    events. All events of a stock are rewritten, because a new event changes the
+    cumulative_factor of every earlier one.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        stocks_sql (str): Query returning the stock_code values to refresh.
+                          When None, the events of every stock are rebuilt.
+    """
+    if stocks_sql is None:
+        con.execute(f"DROP TABLE IF EXISTS {CORPORATE_ACTIONS_TABLE};")
+        create_corporate_actions_table(con)
+        stock_filter = "TRUE"
+    else:
+        stock_filter = f"stock_code IN ({stocks_sql})"
+        con.execute(f"DELETE FROM {CORPORATE_ACTIONS_TABLE} WHERE {stock_filter};")
+    con.execute(f"""
+        INSERT INTO {CORPORATE_ACTIONS_TABLE} (stock_code, ex_date, factor, cumulative_factor)
+        WITH Events AS (
+            SELECT
+                stock_code,
+                trade_date AS ex_date,
+                COALESCE(NULLIF(prev_close_price, 0), close_price)
+                    / NULLIF(LAG(close_price) OVER (PARTITION BY stock_code ORDER BY trade_date), 0) AS factor
+            FROM stock_data
+            WHERE {stock_filter}
+            QUALIFY factor <> 1
+        )
+        SELECT stock_code, ex_date, factor,
+            PRODUCT(factor) OVER (PARTITION BY stock_code ORDER BY ex_date DESC) AS cumulative_factor
+        FROM Events
+        ORDER BY stock_code, ex_date;
+    """)
+
+def ensure_corporate_actions(con):
+    """
+    Creates the corporate_actions table and the adjusted view, detecting the events of
+    all stocks when the table is new, e.g. for a database imported before it existed.
+    """
+    exists = con.execute(
+        f"SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = '{CORPORATE_ACTIONS_TABLE}'"
+    ).fetchone()[0]
+    if exists:
+        create_corporate_actions_table(con)
         return
+    print("Detecting corporate actions of all stocks...")
+    start_time = time.time()
+    con.execute("BEGIN TRANSACTION;")
+    refresh_corporate_actions(con)
+    for table_name in LEGACY_FACTOR_TABLES:
+        con.execute(f"DROP TABLE IF EXISTS {table_name};")
+    con.execute("COMMIT;")
+    event_count = con.execute(f"SELECT COUNT(*) FROM {CORPORATE_ACTIONS_TABLE}").fetchone()[0]
+    print(f"Found {event_count} corporate actions in {time.time() - start_time:.2f} seconds.")
 
+def create_staging_table(con):
+    """
+    Creates the temporary staging table that new or changed files are loaded into
+    before they are upserted into stock_data. It has the stock_data columns plus
+    source_file, the base name of the CSV file each row came from.
+    """
+    con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ({', '.join(stock_data_column_definitions())}, source_file VARCHAR);")
+
+def upsert_staging(con):
+    """
+    Moves the staged rows into stock_data, replacing existing rows with the same
+    (stock_code, trade_date), updates the corporate actions and security master rows
+    of the staged stocks and the trading calendar, then empties the staging table.
+    Staged rows are de-duplicated on the key first and conflicting duplicates are
+    reported; rows without stock_code or trade_date cannot be keyed and are dropped.
+    Each CSV file holds the whole history of a stock, so staged rows identical to the
+    stored ones are left alone: only new or changed rows are written, and corporate
+    actions are only re-detected for stocks with such rows.
+
+    Returns:
+        tuple: (dict of the number of staged rows per source file base name,
+                number of new or changed rows written to stock_data)
+    """
+    columns = ", ".join(HEADER_MAPPING.values())
+    row_counts = dict(con.execute(f"SELECT source_file, COUNT(*) FROM {STAGING_TABLE} GROUP BY source_file").fetchall())
+    report_key_conflicts(con, STAGING_TABLE, "Staged batch")
+    schema = current_schema(con)
+    # Cast staged rows to the stored types, so unchanged rows compare equal
+    typed_columns = ", ".join(
+        f"CAST({definition.split(' ')[0]} AS {definition.split(' ')[1]}) AS {definition.split(' ')[0]}"
+        for definition in stock_data_column_definitions(schema)
+    )
+    con.execute("BEGIN TRANSACTION;")
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE stock_data_changed AS
+        SELECT {typed_columns} FROM (
+            SELECT {columns} FROM {STAGING_TABLE}
+            WHERE stock_code IS NOT NULL AND trade_date IS NOT NULL
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY stock_code, trade_date ORDER BY source_file) = 1
+        )
+        EXCEPT
+        SELECT {columns} FROM stock_data
+        WHERE stock_code IN (SELECT DISTINCT stock_code FROM {STAGING_TABLE});
+    """)
+    changed_rows = con.execute(f"INSERT OR REPLACE INTO stock_data ({columns}) SELECT {columns} FROM stock_data_changed;").fetchone()[0]
+    print(f"{changed_rows} of {sum(row_counts.values())} staged rows are new or changed.")
+    # Re-detect the corporate actions of the stocks with new or changed rows
+    refresh_corporate_actions(con, "SELECT DISTINCT stock_code FROM stock_data_changed")
+    refresh_security_master(con, "SELECT DISTINCT stock_code FROM stock_data_changed")
+    refresh_trading_calendar(con)
+    con.execute("DROP TABLE stock_data_changed;")
+    con.execute(f"DELETE FROM {STAGING_TABLE};")
+    con.execute("COMMIT;")
+    return row_counts, changed_rows
+
+def row_import_csv_files(con, file_paths):
+    """
+    Loads the CSV files row by row through convert_and_read_csv (the original import path)
+    into the staging table.
+
+    Args:
+        con: An open DuckDB connection with the staging table created.
+        file_paths (list): Paths of the CSV files to load.
+
+    Returns:
+        int: Number of records loaded.
+    """
+    column_definitions = stock_data_column_definitions()
     total_records_inserted = 0
     
-    print(f"Found {len(csv_files)} CSV files to process.")
-    for i, csv_file in enumerate(csv_files):
-        file_path = os.path.join(data_dir, csv_file)
-        print(f"Processing file {i+1}/{len(csv_files)}: {file_path}")
+    for i, file_path in enumerate(file_paths):
+        csv_file = os.path.basename(file_path)
+        print(f"Processing file {i+1}/{len(file_paths)}: {file_path}")
         
         processed_data_from_file = convert_and_read_csv(file_path)
         
@@ -235,20 +646,366 @@ def main():
             try:
                 # Ensure the DataFrame columns match the table schema for append
                 # This handles cases where a CSV might be missing a column
-                # It's crucial that all columns defined in header_mapping_for_schema
+                # It's crucial that all columns defined in HEADER_MAPPING
                 # are present in df_current_file before appending, even if they are None.
                 # Reindex df_current_file to match the exact columns of the DuckDB table.
                 df_current_file = df_current_file.reindex(columns=[col.split(' ')[0] for col in column_definitions], fill_value=None)
+                df_current_file['source_file'] = csv_file
                 
-                con.append("stock_data", df_current_file)
+                con.append(STAGING_TABLE, df_current_file)
                 total_records_inserted += len(df_current_file)
-                print(f"Successfully inserted {len(df_current_file)} records from {csv_file}. Total inserted: {total_records_inserted}")
+                print(f"Successfully loaded {len(df_current_file)} records from {csv_file}. Total loaded: {total_records_inserted}")
             except Exception as e:
                 print(f"Error appending data from {csv_file} to DuckDB: {e}")
         else:
             print(f"Skipped {csv_file} due to processing issues or no valid data found.")
+    return total_records_inserted
+
+def _prepare_utf8_source(file_path, tmp_dir):
+    """
+    Makes a CSV file readable by DuckDB's read_csv, which only understands UTF-8 here.
+    UTF-8 files are used in place; GB2312 files are transcoded into tmp_dir.
+    The header line (second line) is checked against HEADER_MAPPING.
+
+    Args:
+        file_path (str): The path to the CSV file.
+        tmp_dir (str): Directory for transcoded copies.
+
+    Returns:
+        str: Path of a UTF-8 version of the file, or None if it cannot be used.
+    """
+    for encoding in ['utf-8', 'gb2312']:
+        try:
+            with open(file_path, 'r', encoding=encoding) as file:
+                next(file)
+                headers = next(file).strip().split(',')
+                missing_headers = [csv_h for csv_h in HEADER_MAPPING if csv_h not in headers]
+                if missing_headers:
+                    print(f"Warning: Missing expected headers in {file_path} for encoding {encoding}: {missing_headers}. Skipping this file.")
+                    continue
+                if encoding == 'utf-8':
+                    # Validate the rest of the file without building Python strings for each row
+                    decoder = codecs.getincrementaldecoder('utf-8')()
+                    with open(file_path, 'rb') as raw:
+                        for chunk in iter(lambda: raw.read(1 << 20), b''):
+                            decoder.decode(chunk)
+                        decoder.decode(b'', final=True)
+                    return file_path
+                file.seek(0)
+                utf8_path = os.path.join(tmp_dir, os.path.basename(file_path))
+                with open(utf8_path, 'w', encoding='utf-8') as out:
+                    shutil.copyfileobj(file, out, 1 << 20)
+                return utf8_path
+        except (UnicodeDecodeError, StopIteration):
+            continue
+    return None
+
+def _bulk_select_sql():
+    """
+    Builds the SELECT list that maps the CSV headers of read_csv(all_varchar=true)
+    onto the typed stock_data columns.
+    """
+    select_list = []
+    for csv_header, db_column in HEADER_MAPPING.items():
+        if db_column in FLOAT_COLUMNS:
+            select_list.append(f'TRY_CAST("{csv_header}" AS DOUBLE) AS {db_column}')
+        elif db_column in FLAG_COLUMNS:
+            select_list.append(f'CASE WHEN lower("{csv_header}") = \'true\' THEN 1 ELSE 0 END AS {db_column}')
+        elif db_column == 'trade_date':
+            select_list.append(f'CAST("{csv_header}" AS DATE) AS {db_column}')
+        else:
+            select_list.append(f'"{csv_header}" AS {db_column}')
+    return ", ".join(select_list)
+
+def bulk_import_csv_files(con, file_paths):
+    """
+    Loads the CSV files into the staging table with DuckDB's columnar read_csv instead of
+    Python row loops. All files go through one read_csv call over a list of paths,
+    skipping the junk first line and typing every column in SQL.
+    If that fails, the files are retried one by one so a single bad file does not
+    abort the whole batch.
+
+    Args:
+        con: An open DuckDB connection with the staging table created.
+        file_paths (list): Paths of the CSV files to load.
+
+    Returns:
+        int: Number of records loaded.
+    """
+    select_sql = _bulk_select_sql()
+    columns = ", ".join(HEADER_MAPPING.values())
+    insert_sql = f"""
+        INSERT INTO {STAGING_TABLE} ({columns}, source_file)
+        SELECT {select_sql}, parse_filename(filename)
+        FROM read_csv(?, skip=1, header=true, all_varchar=true, union_by_name=true, filename=true, delim=',', quote='"')
+    """
+    total_records_inserted = 0
+    tmp_dir = tempfile.mkdtemp(prefix='stock_csv_utf8_')
+    try:
+        sources = []
+        for file_path in file_paths:
+            utf8_path = _prepare_utf8_source(file_path, tmp_dir)
+            if utf8_path is None:
+                print(f"Skipped {os.path.basename(file_path)} due to processing issues or no valid data found.")
+            else:
+                sources.append(utf8_path)
+        if not sources:
+            return 0
+        try:
+            total_records_inserted = con.execute(insert_sql, [sources]).fetchone()[0]
+        except Exception as e:
+            print(f"Batch read failed ({e}), retrying {len(sources)} files one by one.")
+            for source in sources:
+                try:
+                    total_records_inserted += con.execute(insert_sql, [[source]]).fetchone()[0]
+                except Exception as file_error:
+                    print(f"Error appending data from {os.path.basename(source)} to DuckDB: {file_error}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return total_records_inserted
+
+def parse_csv_to_frame(file_path):
+    """
+    Parses one CSV file into a typed DataFrame with the staging table columns.
+    Used by the process pool in --workers mode: pandas parses whole columns at once
+    and the typed frame is cheap to send back to the writer process.
+
+    Args:
+        file_path (str): The path to the CSV file.
+
+    Returns:
+        pandas.DataFrame: The typed rows, or None if the file cannot be read.
+    """
+    for encoding in ['utf-8', 'gb2312']:
+        try:
+            df = pd.read_csv(
+                file_path, skiprows=1, encoding=encoding, dtype=str,
+                keep_default_na=False, na_values=[''],
+            )
+        except (UnicodeDecodeError, ValueError, pd.errors.ParserError):
+            continue
+        missing_headers = [csv_h for csv_h in HEADER_MAPPING if csv_h not in df.columns]
+        if missing_headers:
+            print(f"Warning: Missing expected headers in {file_path} for encoding {encoding}: {missing_headers}. Skipping this file.")
+            continue
+        df = df[list(HEADER_MAPPING)].rename(columns=HEADER_MAPPING)
+        for db_column in HEADER_MAPPING.values():
+            if db_column in FLOAT_COLUMNS:
+                df[db_column] = pd.to_numeric(df[db_column], errors='coerce')
+            elif db_column in FLAG_COLUMNS:
+                df[db_column] = df[db_column].str.lower().eq('true').astype('int32')
+            elif db_column == 'trade_date':
+                df[db_column] = pd.to_datetime(df[db_column]).dt.date
+        df['source_file'] = os.path.basename(file_path)
+        return df
+    return None
+
+def import_csv_files(con, entries, mode, workers=1, batch_size=500):
+    """
+    Imports new or changed CSV files in batches: load a batch into the staging table,
+    upsert it into stock_data, then record its files in the manifest.
+    A crash therefore only loses the current batch, which the next run picks up again.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        entries (list): Manifest entries returned by select_changed_files.
+        mode (str): 'bulk' or 'row', see bulk_import_csv_files and row_import_csv_files.
+                    Ignored when workers > 1.
+        workers (int): When greater than 1, files are parsed by parse_csv_to_frame in a pool
+                       of this many processes and appended by a single writer thread.
+        batch_size (int): Number of files per batch.
+
+    Returns:
+        tuple: (number of rows parsed from the files, number of new or changed rows
+                written to stock_data)
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    if executor is not None:
+        def import_func(con, file_paths):
+            return parallel_load(con, STAGING_TABLE, file_paths, parse_csv_to_frame, executor, queue_size=workers * 2)
+    else:
+        import_func = bulk_import_csv_files if mode == 'bulk' else row_import_csv_files
+    create_staging_table(con)
+    total_records_parsed = 0
+    total_records_upserted = 0
+    try:
+        for batch_start in range(0, len(entries), batch_size):
+            batch = entries[batch_start:batch_start + batch_size]
+            import_func(con, [entry['source_path'] for entry in batch])
+            row_counts, changed_rows = upsert_staging(con)
+            record_manifest(con, 'stock_data', batch, row_counts)
+            total_records_parsed += sum(row_counts.values())
+            total_records_upserted += changed_rows
+            print(f"Processed files {batch_start + 1}-{batch_start + len(batch)}/{len(entries)}. "
+                  f"Total parsed: {total_records_parsed}, upserted: {total_records_upserted}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return total_records_parsed, total_records_upserted
+
+def benchmark_import_modes(file_paths):
+    """
+    Loads the same files with the row path and the bulk path into in-memory databases
+    and prints the rows/sec of both, so the gain can be checked on real data.
+    """
+    results = {}
+    for mode, import_func in [('row', row_import_csv_files), ('bulk', bulk_import_csv_files)]:
+        bench_con = duckdb.connect(database=':memory:')
+        create_staging_table(bench_con)
+        start_time = time.time()
+        rows = import_func(bench_con, file_paths)
+        results[mode] = (rows, time.time() - start_time)
+        bench_con.close()
+
+    print("\n---------- Import benchmark ----------")
+    for mode, (rows, elapsed) in results.items():
+        print(f"{mode:>5} mode: {rows} rows in {elapsed:.2f} seconds, {rows / max(elapsed, 1e-9):,.0f} rows/sec")
+    row_elapsed, bulk_elapsed = results['row'][1], results['bulk'][1]
+    print(f"Bulk mode speedup: {row_elapsed / max(bulk_elapsed, 1e-9):.1f}x")
+    print("--------------------------------------")
+
+def time_layout_probes(con, repeat=3):
+    """
+    Times two probe scans of stock_data whose speed depends on how the table is laid
+    out on disk: a stock_code IN (...) filter and a trade_date range filter. They are
+    the filter shapes the backtest, the dip finder and the screener push down, not
+    those queries themselves, which also read adjusted_stock_data and the analysis
+    tables. A fixed sample of stock codes and the last year of data are used, and the
+    best of repeat runs is reported to reduce noise.
+
+    Returns:
+        dict: Best elapsed seconds per query name.
+    """
+    columns = "stock_code, stock_name, trade_date, open_price, close_price, high_price, low_price, prev_close_price, market_cap, total_market_cap, industry_level1, industry_level2, industry_level3"
+    stock_codes = [row[0] for row in con.execute(
+        "SELECT stock_code FROM (SELECT DISTINCT stock_code FROM stock_data) ORDER BY hash(stock_code) LIMIT 20"
+    ).fetchall()]
+    latest_date = con.execute("SELECT MAX(trade_date) FROM stock_data").fetchone()[0]
+    if not stock_codes or latest_date is None:
+        return {}
+    stock_code_list = ", ".join(f"'{stock_code}'" for stock_code in stock_codes)
+    queries = {
+        'stock_code IN (sample)': f"SELECT {columns} FROM stock_data WHERE stock_code IN ({stock_code_list})",
+        'trade_date >= last year': f"SELECT {columns} FROM stock_data WHERE trade_date >= DATE '{latest_date}' - INTERVAL 1 YEAR",
+    }
+    timings = {}
+    for name, query in queries.items():
+        best = None
+        for _ in range(repeat):
+            start_time = time.time()
+            con.execute(query).fetchall()
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+def compact_stock_data(con):
+    """
+    Rewrites stock_data sorted by (stock_code, trade_date). Files are imported in
+    directory order and re-imports append at the end of the table, so without this the
+    min/max zonemaps of the row groups overlap and filters on stock_code or trade_date
+    cannot skip them. The times of the probe scans (see time_layout_probes) are
+    printed before and after the rewrite.
+    """
+    before = time_layout_probes(con)
+    start_time = time.time()
+    rebuild_stock_data(con, current_schema(con))
+    # Write the new row groups to disk and release the blocks of the old table
+    con.execute("CHECKPOINT;")
+    print(f"\nTable 'stock_data' compacted in {time.time() - start_time:.2f} seconds.")
+    after = time_layout_probes(con)
+
+    print("---------- Probe scan times before/after compaction ----------")
+    for name in before:
+        print(f"{name:>25}: {before[name]:.3f}s -> {after[name]:.3f}s ({before[name] / max(after[name], 1e-9):.1f}x)")
+    print("--------------------------------------------------------------")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import per-stock trading CSV files into DuckDB.")
+    parser.add_argument('--data-dir', default=f'F:\股票数据\stock-trading-data-pro-2025-08-19',
+                        help="Directory holding the per-stock trading CSV files.")
+    parser.add_argument('--mode', choices=['bulk', 'row'], default='bulk',
+                        help="bulk: columnar DuckDB read_csv (default); row: the original csv.DictReader path.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Parse files in N processes and append them from a single writer thread.")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Also import the files with both modes into in-memory databases and report rows/sec.")
+    parser.add_argument('--compact', action='store_true',
+                        help="After importing, rewrite stock_data sorted by stock_code and trade_date.")
+    parser.add_argument('--compact-only', action='store_true',
+                        help="Only rewrite stock_data sorted by stock_code and trade_date, without importing.")
+    parser.add_argument('--schema', choices=SCHEMAS,
+                        help="Convert stock_data to this schema: standard, compact (BOOLEAN flags) "
+                             "or compact-float (also FLOAT intraday prices). By default the current schema is kept.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    duckdb_path = "./stock_data.duckdb"
+    
+    # Connect to DuckDB (creates a file-based database 'stock_data.duckdb' if not exists)
+    # Using a file-based database persists data across runs.
+    # For in-memory database: con = duckdb.connect(database=':memory:')
+    con = duckdb.connect(database=duckdb_path, read_only=False)
+    print(f"Connected to DuckDB database: {duckdb_path}")
+
+    if args.compact_only:
+        ensure_stock_data_primary_key(con)
+        migrate_schema(con, args.schema)
+        ensure_corporate_actions(con)
+        ensure_trading_calendar(con)
+        ensure_security_master(con)
+        compact_stock_data(con)
+        refresh_price_cube(con, configured_cube_dir())
+        con.close()
+        print("\nDuckDB connection closed.")
+        return
+
+    data_dir = args.data_dir
+    
+    # Ensure the directory exists
+    if not os.path.isdir(data_dir):
+        print(f"Error: Data directory '{data_dir}' not found. Please create it and place CSV files inside.")
+        return
+
+    csv_files = [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir)) if f.endswith('.csv')]
+    
+    if not csv_files:
+        print(f"No CSV files found in '{data_dir}'. Please ensure your CSV files are in this directory.")
+        return
+
+    # Create the stock table if it does not exist. This ensures existing data is not deleted.
+    # Older tables without the (stock_code, trade_date) primary key are de-duplicated first.
+    try:
+        ensure_stock_data_primary_key(con)
+        migrate_schema(con, args.schema)
+        ensure_corporate_actions(con)
+        ensure_trading_calendar(con)
+        ensure_security_master(con)
+        print("Table 'stock_data' ensured to exist with defined schema (or created if new).")
+    except Exception as e:
+        print(f"Error ensuring table 'stock_data' exists: {e}")
+        con.close()
+        return
     
-    print(f"\nTotal records inserted into DuckDB: {total_records_inserted}")
+    print(f"Found {len(csv_files)} CSV files in '{data_dir}'.")
+    # Only new or changed files are imported, see stock_db_utils.select_changed_files
+    changed_entries = select_changed_files(con, 'stock_data', csv_files)
+    start_import_time = time.time()
+    total_records_parsed, total_records_upserted = import_csv_files(con, changed_entries, args.mode, workers=args.workers)
+    elapsed = time.time() - start_import_time
+    import_mode = f"{args.workers} workers" if args.workers > 1 else f"{args.mode} mode"
+    print(f"\nTotal records upserted into DuckDB: {total_records_upserted} new or changed of {total_records_parsed} parsed")
+    print(f"Import ({import_mode}) completed in {elapsed:.2f} seconds, {total_records_parsed / max(elapsed, 1e-9):,.0f} parsed rows/sec.")
+
+    if args.compact:
+        compact_stock_data(con)
+
+    # Rebuild the memory-mapped price cube in price_cube_dir of config.conf, if one was built with price_cube.py
+    refresh_price_cube(con, configured_cube_dir())
+
+    if args.benchmark:
+        benchmark_import_modes(csv_files)
 
     # Example query: Fetch closing price and volume for a specific date range
     start_date = '2023-06-01'
@@ -1,14 +1,44 @@
 import duckdb
+import argparse
 import csv
+import glob
 import os
+import shutil
+import tempfile
 import pandas as pd
 import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from stock_db_utils import parallel_load, record_manifest, select_changed_files
+
+STAGING_TABLE = 'stock_finance_staging'
+HOT_TABLE = 'stock_finance_hot'
+FUNDAMENTALS_TABLE = 'fundamentals_quarterly'
+TEXT_COLUMNS = ['stock_code', 'statement_format', 'report_date', 'publish_date', '抓取时间']
+# Columns kept in the narrow hot table; the full statements only live in the Parquet archive
+HOT_COLUMNS = [
+    'stock_code', 'statement_format', 'report_date', 'publish_date',
+    'R_np', 'R_operating_total_revenue', 'R_np_atoopc',
+    'B_total_assets', 'B_total_liab', 'B_total_owner_equity',
+    'C_ncf_from_oa'
+]
+# Rows without stock_code or report_date cannot be keyed in the hot table and are dropped
+KEYED_ROW_FILTER = "WHERE stock_code IS NOT NULL AND report_date IS NOT NULL"
+# Keeps one row per (stock_code, report_date): the most recently published, then crawled
+LATEST_ROW_QUALIFY = """
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY stock_code, report_date
+        ORDER BY publish_date DESC NULLS LAST, "抓取时间" DESC NULLS LAST
+    ) = 1
+"""
 
 def convert_and_read_csv(file_path):
     """
     Reads a CSV file, skipping the first row and using the second row as headers.
     It attempts to read with GB2312 encoding first, then falls back to UTF-8.
     It processes data types, handles missing values, and cleans field names by removing '@xbx'.
+    Only used to find the headers of a new database; the rows are imported with
+    parse_finance_csv_to_frame.
 
     Args:
         file_path (str): The path to the CSV file.
@@ -44,7 +74,7 @@ def convert_and_read_csv(file_path):
                         value = row.get(csv_header)
                         
                         # Convert values to appropriate types, handle None for empty strings
-                        if db_column in ['stock_code', 'statement_format', 'report_date', 'publish_date', '抓取时间']:
+                        if db_column in TEXT_COLUMNS:
                             processed_row[db_column] = value if value else None
                         else:
                             try:
@@ -60,12 +90,304 @@ def convert_and_read_csv(file_path):
     # If no encoding worked, return empty list and empty headers
     return [], []
 
+def parse_finance_csv_to_frame(file_path, table_columns):
+    """
+    Parses one finance CSV file into a typed DataFrame with the staging table columns.
+    Used by the import loop and by the process pool in --workers mode: pandas converts
+    whole columns at once instead of running a try: float() per cell.
+
+    Args:
+        file_path (str): The path to the CSV file.
+        table_columns (list): Columns of the stock_finance_data table.
+
+    Returns:
+        pandas.DataFrame: The typed rows, or None if the file cannot be read.
+    """
+    for encoding in ['gb2312', 'utf-8']:
+        try:
+            df = pd.read_csv(
+                file_path, skiprows=1, encoding=encoding, dtype=str,
+                keep_default_na=False, na_values=[''],
+            )
+        except (UnicodeDecodeError, ValueError, pd.errors.ParserError) as e:
+            print(f"Error reading {file_path} with encoding {encoding}: {e}")
+            continue
+        df.columns = [h.replace('@xbx', '') for h in df.columns]
+        df = df.reindex(columns=table_columns)
+        numeric_columns = [column for column in table_columns if column not in TEXT_COLUMNS]
+        df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric, errors='coerce')
+        return df.assign(source_file=os.path.basename(file_path))
+    return None
+
+def create_hot_table(con):
+    """
+    Creates the narrow stock_finance_hot table read by the screener, unique per
+    (stock_code, report_date).
+    """
+    column_definitions = [
+        f"{column} VARCHAR" if column in TEXT_COLUMNS else f"{column} DOUBLE"
+        for column in HOT_COLUMNS
+    ]
+    con.execute(f"CREATE TABLE IF NOT EXISTS {HOT_TABLE} ({', '.join(column_definitions)}, PRIMARY KEY (stock_code, report_date));")
+
+def create_fundamentals_table(con):
+    """
+    Creates the fundamentals_quarterly table read by condition 5 of the screener, one row
+    per (stock_code, report_date) with the report and publish dates typed as DATE and the
+    year-over-year growth of net profit and total revenue already computed.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {FUNDAMENTALS_TABLE} (
+            stock_code VARCHAR,
+            report_date DATE,
+            publish_date DATE,
+            R_np DOUBLE,
+            R_operating_total_revenue DOUBLE,
+            last_year_report_date DATE,
+            last_year_R_np DOUBLE,
+            last_year_R_operating_total_revenue DOUBLE,
+            net_profit_yoy DOUBLE,
+            revenue_yoy DOUBLE,
+            PRIMARY KEY (stock_code, report_date)
+        );
+    """)
+
+def refresh_fundamentals(con, stocks_sql=None):
+    """
+    Recomputes the fundamentals_quarterly rows of the given stocks from stock_finance_hot.
+    The growth rates compare each report with the report of the same quarter one year
+    earlier, rounded to two decimals; they are NULL when that report is missing or its
+    value is 0.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        stocks_sql (str): Query returning the stock_code values to refresh.
+                          When None, the table is rebuilt for every stock.
+    """
+    if stocks_sql is None:
+        con.execute(f"DROP TABLE IF EXISTS {FUNDAMENTALS_TABLE};")
+        create_fundamentals_table(con)
+        stock_filter = "TRUE"
+    else:
+        stock_filter = f"stock_code IN ({stocks_sql})"
+        con.execute(f"DELETE FROM {FUNDAMENTALS_TABLE} WHERE {stock_filter};")
+    con.execute(f"""
+        INSERT INTO {FUNDAMENTALS_TABLE}
+        WITH Reports AS (
+            SELECT
+                stock_code,
+                CAST(TRY_STRPTIME(report_date, '%Y%m%d') AS DATE) AS report_date,
+                CAST(TRY_STRPTIME(publish_date, '%Y%m%d') AS DATE) AS publish_date,
+                R_np,
+                R_operating_total_revenue
+            FROM {HOT_TABLE}
+            WHERE {stock_filter}
+        )
+        SELECT
+            r.stock_code,
+            r.report_date,
+            r.publish_date,
+            r.R_np,
+            r.R_operating_total_revenue,
+            p.report_date,
+            p.R_np,
+            p.R_operating_total_revenue,
+            CASE WHEN p.R_np != 0 THEN ROUND((r.R_np - p.R_np) / p.R_np * 100, 2) END,
+            CASE WHEN p.R_operating_total_revenue != 0
+                THEN ROUND((r.R_operating_total_revenue - p.R_operating_total_revenue) / p.R_operating_total_revenue * 100, 2)
+            END
+        FROM Reports r
+        LEFT JOIN Reports p
+            ON p.stock_code = r.stock_code
+            AND p.report_date = CAST(r.report_date - INTERVAL 1 YEAR AS DATE)
+        WHERE r.report_date IS NOT NULL
+        ORDER BY r.stock_code, r.report_date;
+    """)
+
+def ensure_fundamentals(con):
+    """
+    Creates fundamentals_quarterly and fills it from stock_finance_hot when it is new,
+    e.g. for a database imported before the table existed.
+    """
+    exists = con.execute(
+        f"SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = '{FUNDAMENTALS_TABLE}'"
+    ).fetchone()[0]
+    if exists:
+        return
+    start_time = time.time()
+    con.execute("BEGIN TRANSACTION;")
+    refresh_fundamentals(con)
+    con.execute("COMMIT;")
+    row_count = con.execute(f"SELECT COUNT(*) FROM {FUNDAMENTALS_TABLE}").fetchone()[0]
+    print(f"Built '{FUNDAMENTALS_TABLE}' with {row_count} reports in {time.time() - start_time:.2f} seconds.")
+
+def _hot_select_sql(table_columns):
+    # Hot columns missing from the source files are filled with NULL
+    return ", ".join(
+        f'"{column}"' if column in table_columns else f"NULL AS {column}"
+        for column in HOT_COLUMNS
+    )
+
+def _sql_string_list(values):
+    return "[" + ", ".join("'" + value.replace("'", "''") + "'" for value in values) + "]"
+
+def write_archive(con, rows_sql, archive_dir):
+    """
+    Writes finance rows to the Parquet archive, one zstd-compressed partition per stock_code.
+    Every stock present in rows_sql gets its partition replaced as a whole: the rows are
+    first written to a hidden temporary directory and then moved into place.
+
+    Args:
+        con: An open DuckDB connection.
+        rows_sql (str): A query returning the complete rows of every stock to (re)write.
+        archive_dir (str): Root directory of the archive.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.writing_', dir=archive_dir)
+    try:
+        con.execute(f"""
+            COPY ({rows_sql}) TO '{tmp_dir}'
+            (FORMAT parquet, PARTITION_BY (stock_code), COMPRESSION zstd, OVERWRITE_OR_IGNORE);
+        """)
+        for partition in os.listdir(tmp_dir):
+            target = os.path.join(archive_dir, partition)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.replace(os.path.join(tmp_dir, partition), target)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def create_archive_view(con, archive_dir):
+    """
+    Exposes the Parquet archive as the stock_finance_data view, so ad-hoc queries on the
+    full statements keep working after the wide table is gone. The view stores the
+    absolute path of the archive, so it also resolves from another working directory.
+    """
+    archive_dir = os.path.abspath(archive_dir)
+    if not glob.glob(os.path.join(archive_dir, '*', '*.parquet')):
+        return
+    archive_glob = os.path.join(archive_dir, '*', '*.parquet').replace("'", "''")
+    con.execute(f"""
+        CREATE OR REPLACE VIEW stock_finance_data AS
+        SELECT * FROM read_parquet('{archive_glob}', hive_partitioning=true, union_by_name=true);
+    """)
+
+def migrate_wide_table(con, archive_dir):
+    """
+    Moves an existing wide stock_finance_data table (from older versions of the importers)
+    into the hot table and the Parquet archive, then drops it.
+
+    Returns:
+        list: (column, type) pairs of the dropped table, or None if there was nothing to migrate.
+    """
+    table_type = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = 'stock_finance_data'"
+    ).fetchone()
+    if table_type is None or table_type[0] != 'BASE TABLE':
+        return None
+
+    table_schema = con.execute(
+        "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'stock_finance_data' ORDER BY ordinal_position"
+    ).fetchall()
+    table_columns = [column for column, _ in table_schema]
+    row_count = con.execute("SELECT COUNT(*) FROM stock_finance_data").fetchone()[0]
+    print(f"Migrating {row_count} rows of the wide 'stock_finance_data' table into '{HOT_TABLE}' and '{archive_dir}'...")
+    if row_count:
+        report_unkeyed_rows(con, 'stock_finance_data')
+        latest_rows_sql = f"SELECT * FROM stock_finance_data {KEYED_ROW_FILTER} {LATEST_ROW_QUALIFY}"
+        con.execute(f"INSERT OR REPLACE INTO {HOT_TABLE} SELECT {_hot_select_sql(table_columns)} FROM ({latest_rows_sql});")
+        write_archive(con, latest_rows_sql, archive_dir)
+    con.execute("DROP TABLE stock_finance_data;")
+    return table_schema
+
+def report_unkeyed_rows(con, table_name):
+    """
+    Prints how many rows of table_name have no stock_code or report_date; they are
+    dropped when the rows are moved into the hot table and the archive.
+
+    Returns:
+        int: Number of such rows.
+    """
+    unkeyed_rows = con.execute(
+        f"SELECT COUNT(*) FROM {table_name} WHERE stock_code IS NULL OR report_date IS NULL"
+    ).fetchone()[0]
+    if unkeyed_rows:
+        print(f"{table_name}: {unkeyed_rows} rows without stock_code or report_date dropped.")
+    return unkeyed_rows
+
+def upsert_staging(con, table_columns, archive_dir):
+    """
+    Moves the staged rows into the hot table and the Parquet archive, replacing existing
+    rows with the same (stock_code, report_date), recomputes fundamentals_quarterly for
+    the staged stocks, then empties the staging table.
+    When a key appears more than once in the staged rows, the most recently published
+    (then most recently crawled) row wins. Rows without stock_code or report_date are
+    dropped and reported.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        table_columns (list): Columns of the finance data.
+        archive_dir (str): Root directory of the Parquet archive.
+
+    Returns:
+        dict: Number of staged rows per source file base name.
+    """
+    columns = ", ".join(f'"{column}"' for column in table_columns)
+    row_counts = dict(con.execute(f"SELECT source_file, COUNT(*) FROM {STAGING_TABLE} GROUP BY source_file").fetchall())
+    report_unkeyed_rows(con, STAGING_TABLE)
+    staged_rows_sql = f"SELECT {columns} FROM {STAGING_TABLE} {KEYED_ROW_FILTER} {LATEST_ROW_QUALIFY}"
+
+    con.execute("BEGIN TRANSACTION;")
+    con.execute(f"""
+        DELETE FROM {HOT_TABLE}
+        USING (SELECT DISTINCT stock_code, report_date FROM {STAGING_TABLE}) s
+        WHERE {HOT_TABLE}.stock_code = s.stock_code AND {HOT_TABLE}.report_date = s.report_date;
+    """)
+    con.execute(f"INSERT INTO {HOT_TABLE} SELECT {_hot_select_sql(table_columns)} FROM ({staged_rows_sql});")
+    refresh_fundamentals(con, f"SELECT DISTINCT stock_code FROM {STAGING_TABLE}")
+    con.execute("COMMIT;")
+
+    # Rewrite the archive partition of every staged stock: its archived rows that were
+    # not restaged, plus the staged rows
+    stock_codes = [row[0] for row in con.execute(f"SELECT DISTINCT stock_code FROM ({staged_rows_sql})").fetchall()]
+    archived_files = [
+        path for stock_code in stock_codes
+        for path in glob.glob(os.path.join(archive_dir, f"stock_code={stock_code}", '*.parquet'))
+    ]
+    archive_rows_sql = staged_rows_sql
+    if archived_files:
+        archive_rows_sql = f"""
+            SELECT a.* FROM read_parquet({_sql_string_list(archived_files)}, hive_partitioning=true, union_by_name=true) a
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {STAGING_TABLE} s
+                WHERE s.stock_code = a.stock_code AND s.report_date = a.report_date
+            )
+            UNION ALL BY NAME
+            ({staged_rows_sql})
+        """
+    if stock_codes:
+        write_archive(con, archive_rows_sql, archive_dir)
+
+    con.execute(f"DELETE FROM {STAGING_TABLE};")
+    return row_counts
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import per-stock finance CSV files into DuckDB.")
+    parser.add_argument('--data-dir', default='./stock-fin-data-xbx-2025-06-25',
+                        help="Directory holding one sub-directory of finance CSV files per stock.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Parse files in N processes and append them from a single writer thread.")
+    parser.add_argument('--archive-dir', default='./finance_archive',
+                        help="Directory of the Parquet archive holding the full statements.")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
     # Connect to DuckDB
     con = duckdb.connect(database='stock_data.duckdb', read_only=False)
     print("Connected to DuckDB database: stock_data.duckdb")
 
-    data_dir = './stock-fin-data-xbx-2025-06-25'
+    data_dir = args.data_dir
     
     # Ensure the directory exists
     if not os.path.isdir(data_dir):
@@ -87,66 +409,81 @@ def main():
         con.close()
         return
 
-    # Get headers from the first valid CSV file to define the schema
-    first_valid_file = None
-    cleaned_headers = []
-    for stock_code, csv_file in csv_files:
-        data, headers = convert_and_read_csv(csv_file)
-        if data and headers:
-            first_valid_file = csv_file
-            cleaned_headers = headers
-            break
-    
-    if not cleaned_headers:
-        print("No valid CSV files found to determine schema. Aborting.")
-        con.close()
-        return
+    # Move a wide stock_finance_data table left by older versions into the new layout
+    create_hot_table(con)
+    table_schema = migrate_wide_table(con, args.archive_dir)
+    ensure_fundamentals(con)
+    if table_schema is None:
+        # Reuse the columns of the archive view, which may predate the current headers
+        table_schema = con.execute(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'stock_finance_data' ORDER BY ordinal_position"
+        ).fetchall()
 
-    # Define schema for the stock_finance_data table
-    column_definitions = []
-    for header in cleaned_headers:
-        if header in ['stock_code', 'statement_format', 'report_date', 'publish_date', '抓取时间']:
-            column_definitions.append(f"{header} VARCHAR")
-        elif header == 'report_date':
-            column_definitions.append(f"{header} DATE")
-        else:
-            column_definitions.append(f"{header} DOUBLE")
-    
-    # Create the table if it does not exist
-    try:
-        create_table_sql = f"CREATE TABLE IF NOT EXISTS stock_finance_data ({', '.join(column_definitions)});"
-        con.execute(create_table_sql)
-        print("Table 'stock_finance_data' ensured to exist with defined schema (or created if new).")
-    except Exception as e:
-        print(f"Error ensuring table 'stock_finance_data' exists: {e}")
-        con.close()
-        return
+    if not table_schema:
+        # Get headers from the first valid CSV file to define the schema
+        cleaned_headers = []
+        for stock_code, csv_file in csv_files:
+            data, headers = convert_and_read_csv(csv_file)
+            if data and headers:
+                cleaned_headers = headers
+                break
+        
+        if not cleaned_headers:
+            print("No valid CSV files found to determine schema. Aborting.")
+            con.close()
+            return
 
+        table_schema = [
+            (header, 'VARCHAR' if header in TEXT_COLUMNS else 'DOUBLE')
+            for header in cleaned_headers
+        ]
+
+    # Stage rows with the full finance columns; only HOT_COLUMNS stay in DuckDB
+    table_columns = [column for column, _ in table_schema]
+    staging_columns = ", ".join(f'"{column}" {column_type}' for column, column_type in table_schema)
+    con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ({staging_columns}, source_file VARCHAR);")
+
+    print(f"Found {len(csv_files)} CSV files.")
+    # Only new or changed files are imported, see stock_db_utils.select_changed_files
+    changed_entries = select_changed_files(con, 'stock_finance_data', [csv_file for _, csv_file in csv_files])
+
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    parse_func = partial(parse_finance_csv_to_frame, table_columns=table_columns)
     total_records_inserted = 0
-    
-    print(f"Found {len(csv_files)} CSV files to process.")
-    for i, (stock_code, csv_file) in enumerate(csv_files):
-        print(f"Processing file {i+1}/{len(csv_files)}: {csv_file}")
-        
-        processed_data_from_file, _ = convert_and_read_csv(csv_file)
-        
-        if processed_data_from_file:
-            # Convert current file's data to DataFrame
-            df_current_file = pd.DataFrame(processed_data_from_file)
-            
-            try:
-                # Ensure DataFrame columns match the table schema
-                df_current_file = df_current_file.reindex(columns=cleaned_headers, fill_value=None)
-                
-                con.append("stock_finance_data", df_current_file)
-                total_records_inserted += len(df_current_file)
-                print(f"Successfully inserted {len(df_current_file)} records from {csv_file}. Total inserted: {total_records_inserted}")
-            except Exception as e:
-                print(f"Error appending data from {csv_file} to DuckDB: {e}")
+    batch_size = 500
+    start_import_time = time.time()
+    for batch_start in range(0, len(changed_entries), batch_size):
+        batch = changed_entries[batch_start:batch_start + batch_size]
+        if executor is not None:
+            parallel_load(con, STAGING_TABLE, [entry['source_path'] for entry in batch], parse_func, executor, queue_size=args.workers * 2)
         else:
-            print(f"Skipped {csv_file} due to processing issues or no valid data found.")
+            for i, entry in enumerate(batch):
+                csv_file = entry['source_path']
+                print(f"Processing file {batch_start + i + 1}/{len(changed_entries)}: {csv_file}")
+                
+                # Typed DataFrame with the table columns, parsed column by column as in --workers mode
+                df_current_file = parse_func(csv_file)
+                
+                if df_current_file is not None and not df_current_file.empty:
+                    try:
+                        con.append(STAGING_TABLE, df_current_file)
+                        print(f"Successfully loaded {len(df_current_file)} records from {csv_file}.")
+                    except Exception as e:
+                        print(f"Error appending data from {csv_file} to DuckDB: {e}")
+                else:
+                    print(f"Skipped {csv_file} due to processing issues or no valid data found.")
+
+        row_counts = upsert_staging(con, table_columns, args.archive_dir)
+        record_manifest(con, 'stock_finance_data', batch, row_counts)
+        total_records_inserted += sum(row_counts.values())
+        print(f"Upserted files {batch_start + 1}-{batch_start + len(batch)}/{len(changed_entries)}. Total upserted: {total_records_inserted}")
+    if executor is not None:
+        executor.shutdown()
+    elapsed = time.time() - start_import_time
+    print(f"Import completed in {elapsed:.2f} seconds, {total_records_inserted / max(elapsed, 1e-9):,.0f} rows/sec.")
+    create_archive_view(con, args.archive_dir)
     
-    print(f"\nTotal records inserted into DuckDB: {total_records_inserted}")
+    print(f"\nTotal records upserted into DuckDB: {total_records_inserted}")
 
     # Example query: Fetch some financial metrics for a specific date range
     start_date = '20230601'
@@ -0,0 +1,262 @@
+import duckdb
+import argparse
+import configparser
+import json
+import os
+import shutil
+import time # Import time for performance measurement
+import numpy as np
+from datetime import datetime
+from stock_db_utils import STOCK_DB_PATH
+from stock_window_engine import PRICE_COLUMNS
+
+# Directory of the price cube, set price_cube_dir in config.conf when it is moved
+PRICE_CUBE_DIR = './price_cube'
+
+def configured_cube_dir(config_path='./config.conf'):
+    """
+    Returns price_cube_dir from the [settings] section of config_path, the directory the
+    screener reads the cube from, or PRICE_CUBE_DIR when it is not set.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return config.get('settings', 'price_cube_dir', fallback=PRICE_CUBE_DIR)
+
+def cube_data_checksum(con, since, until=None):
+    """
+    Returns a checksum of the raw bars from since onwards, which the adjusted prices of
+    the cube are computed from. The corporate actions are derived from the same bars, so
+    a re-import that changes a bar or re-adjusts the history changes the checksum. The
+    columns are cast to VARCHAR and DOUBLE, so it is the same for every stock_data schema
+    and for the Parquet dataset.
+
+    Args:
+        con: An open DuckDB connection with a stock_data table or view.
+        since (datetime.date): The first trade date in the cube.
+        until (datetime.date): The last trade date included, or None for all bars.
+
+    Returns:
+        str: Row count and the XOR of the row hashes.
+    """
+    query_parameters = {'since': since}
+    until_sql = ""
+    if until is not None:
+        until_sql = "AND trade_date <= $until"
+        query_parameters['until'] = until
+    row_count, row_hashes = con.execute(f"""
+        SELECT COUNT(*), bit_xor(hash(stock_code::VARCHAR, trade_date, open_price::DOUBLE, high_price::DOUBLE,
+                                      low_price::DOUBLE, close_price::DOUBLE, prev_close_price::DOUBLE))
+        FROM stock_data
+        WHERE trade_date >= $since {until_sql}
+    """, query_parameters).fetchone()
+    return f"{row_count}:{row_hashes}"
+
+def build_price_cube(con, cube_dir, since):
+    """
+    Writes the adjusted daily bars from since onwards into a price cube in cube_dir:
+      prices.npy: float64 array of shape (stocks, trading days, fields), NaN where a
+                  stock has no bar or a NULL price, with fields PRICE_COLUMNS.
+      has_bar.npy: bool array of shape (stocks, trading days), True where stock_data
+                   has a bar, so suspended days are told apart from NULL prices.
+      stock_codes.npy: the stock code of every row, sorted (the security_master codes).
+      trade_dates.npy: the trade date of every column, every trading_calendar date
+                       from since onwards.
+      meta.json: the fields, since, the newest trade date, the build time and the
+                 cube_data_checksum of the bars the cube was built from.
+    The arrays are .npy files, so readers map them with np.load(mmap_mode='r') and share
+    the pages through the OS page cache. The cube is written next to cube_dir first and
+    swapped in, so readers only ever see a complete cube.
+
+    Args:
+        con: An open DuckDB connection to stock_data.duckdb.
+        cube_dir (str): Directory of the cube.
+        since (datetime.date): The first trade date in the cube.
+
+    Returns:
+        int: Number of bars written.
+    """
+    cube_dir = os.path.abspath(cube_dir)
+    writing_dir = cube_dir + '.writing'
+    old_dir = cube_dir + '.old'
+    shutil.rmtree(writing_dir, ignore_errors=True)
+    os.makedirs(writing_dir)
+
+    try:
+        stock_codes = np.array([row[0] for row in con.execute(
+            "SELECT stock_code FROM security_master ORDER BY stock_code"
+        ).fetchall()], dtype=str)
+        calendar = con.execute(
+            "SELECT trade_date, trading_day FROM trading_calendar WHERE trade_date >= $since ORDER BY trade_date",
+            {'since': since}
+        ).fetchall()
+        trade_dates = np.array([row[0] for row in calendar], dtype='datetime64[D]')
+        first_trading_day = calendar[0][1] if calendar else 0
+
+        prices = np.lib.format.open_memmap(os.path.join(writing_dir, 'prices.npy'), mode='w+', dtype=np.float64,
+                                           shape=(len(stock_codes), len(trade_dates), len(PRICE_COLUMNS)))
+        prices[:] = np.nan
+        has_bar = np.lib.format.open_memmap(os.path.join(writing_dir, 'has_bar.npy'), mode='w+', dtype=np.bool_,
+                                            shape=(len(stock_codes), len(trade_dates)))
+        has_bar[:] = False
+
+        # A single scan, read back in chunks of about 200k bars so memory stays bounded
+        result = con.execute(f"""
+            SELECT s.stock_index, c.trading_day - $first_trading_day AS date_index, {', '.join('b.' + column for column in PRICE_COLUMNS)}
+            FROM adjusted_stock_data b
+            JOIN (SELECT stock_code, (ROW_NUMBER() OVER (ORDER BY stock_code) - 1)::INTEGER AS stock_index FROM security_master) s
+                ON s.stock_code = b.stock_code
+            JOIN trading_calendar c ON c.trade_date = b.trade_date
+            WHERE b.trade_date >= $since
+        """, {'since': since, 'first_trading_day': first_trading_day})
+        bar_count = 0
+        while True:
+            chunk = result.fetch_df_chunk(100)
+            if chunk.empty:
+                break
+            stock_index = chunk['stock_index'].to_numpy()
+            date_index = chunk['date_index'].to_numpy()
+            prices[stock_index, date_index, :] = chunk[PRICE_COLUMNS].to_numpy(dtype=np.float64, na_value=np.nan)
+            has_bar[stock_index, date_index] = True
+            bar_count += len(chunk)
+        prices.flush()
+        has_bar.flush()
+        del prices, has_bar
+
+        np.save(os.path.join(writing_dir, 'stock_codes.npy'), stock_codes)
+        np.save(os.path.join(writing_dir, 'trade_dates.npy'), trade_dates)
+        with open(os.path.join(writing_dir, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump({
+                'fields': PRICE_COLUMNS,
+                'since': str(since),
+                'last_trade_date': str(trade_dates[-1]) if len(trade_dates) else None,
+                'bar_count': bar_count,
+                'data_checksum': cube_data_checksum(con, since),
+                'built_at': datetime.now().isoformat(timespec='seconds'),
+            }, meta_file, indent=2)
+    except Exception:
+        shutil.rmtree(writing_dir, ignore_errors=True)
+        raise
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(cube_dir):
+        os.rename(cube_dir, old_dir)
+    os.rename(writing_dir, cube_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return bar_count
+
+def refresh_price_cube(con, cube_dir=PRICE_CUBE_DIR):
+    """
+    Rebuilds an existing price cube from the same since date when the bars it was built
+    from or the stocks in security_master changed, so it follows the newly imported bars
+    and corporate actions. Does nothing when cube_dir holds no cube; build one with
+    `python price_cube.py --since YYYY-MM-DD` first.
+    """
+    meta_path = os.path.join(cube_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return
+    with open(meta_path, encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    since = datetime.strptime(meta['since'], '%Y-%m-%d').date()
+    stock_codes = [row[0] for row in con.execute("SELECT stock_code FROM security_master ORDER BY stock_code").fetchall()]
+    if meta.get('data_checksum') == cube_data_checksum(con, since) \
+            and np.load(os.path.join(cube_dir, 'stock_codes.npy')).tolist() == stock_codes:
+        print(f"Price cube '{cube_dir}' is up to date.")
+        return
+    start_time = time.time()
+    bar_count = build_price_cube(con, cube_dir, since)
+    print(f"Price cube '{cube_dir}' refreshed with {bar_count} bars since {since} in {time.time() - start_time:.2f} seconds.")
+
+def open_price_cube(cube_dir=PRICE_CUBE_DIR):
+    """
+    Maps a price cube read-only. Only the small index files are read; the price pages
+    are loaded by the OS on first access and shared with other processes.
+
+    Returns:
+        dict: prices and has_bar (read-only memmaps), stock_codes, trade_dates, fields,
+              since, last_trade_date and data_checksum (None for cubes built before it
+              was recorded) from meta.json, and stock_rows, the row of every stock code.
+              None when cube_dir holds no cube.
+    """
+    meta_path = os.path.join(cube_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    stock_codes = np.load(os.path.join(cube_dir, 'stock_codes.npy'))
+    return {
+        'prices': np.load(os.path.join(cube_dir, 'prices.npy'), mmap_mode='r'),
+        'has_bar': np.load(os.path.join(cube_dir, 'has_bar.npy'), mmap_mode='r'),
+        'stock_codes': stock_codes,
+        'trade_dates': np.load(os.path.join(cube_dir, 'trade_dates.npy')),
+        'fields': meta['fields'],
+        'since': datetime.strptime(meta['since'], '%Y-%m-%d').date(),
+        'last_trade_date': datetime.strptime(meta['last_trade_date'], '%Y-%m-%d').date() if meta['last_trade_date'] else None,
+        'data_checksum': meta.get('data_checksum'),
+        'stock_rows': {stock_code: row for row, stock_code in enumerate(stock_codes.tolist())},
+    }
+
+def date_column(cube, trade_date):
+    """
+    Returns the column of trade_date in the cube, or None when it is not a trading day
+    covered by the cube.
+    """
+    trade_date = np.datetime64(trade_date, 'D')
+    column = int(np.searchsorted(cube['trade_dates'], trade_date))
+    if column < len(cube['trade_dates']) and cube['trade_dates'][column] == trade_date:
+        return column
+    return None
+
+def cube_price_arrays(cube, stock_codes, since):
+    """
+    Gathers the bars of stock_codes from since onwards in the layout of
+    stock_window_engine.load_price_arrays, without querying the database.
+
+    Args:
+        cube (dict): A cube returned by open_price_cube.
+        stock_codes (list): Stock codes, all present in the cube; stock_index refers to
+                            positions in this list.
+        since (datetime.date): The first trade date, not before the cube's since.
+
+    Returns:
+        dict: The same arrays load_price_arrays returns.
+    """
+    rows = np.array([cube['stock_rows'][stock_code] for stock_code in stock_codes], dtype=np.int64)
+    first_column = int(np.searchsorted(cube['trade_dates'], np.datetime64(since, 'D')))
+    # np.nonzero walks the (stocks, days) mask row by row: bars come out by stock, then date
+    stock_index, columns = np.nonzero(cube['has_bar'][rows, first_column:])
+    columns += first_column
+    bars = cube['prices'][rows[stock_index], columns, :]
+    arrays = {
+        'stock_index': stock_index,
+        'trade_date': cube['trade_dates'][columns].astype('datetime64[us]'),
+    }
+    for field_index, column in enumerate(cube['fields']):
+        arrays[column] = np.ascontiguousarray(bars[:, field_index])
+    starts = np.flatnonzero(np.r_[True, stock_index[1:] != stock_index[:-1]]) if len(stock_index) else np.array([], dtype=np.int64)
+    arrays['offsets'] = np.r_[starts, len(stock_index)].astype(np.int64)
+    return arrays
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped price cube of the adjusted daily bars in stock_data.duckdb.")
+    parser.add_argument('--cube-dir', default=configured_cube_dir(),
+                        help="Directory of the price cube (default: price_cube_dir in config.conf, or ./price_cube).")
+    parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(), required=True,
+                        help="First trade date (YYYY-MM-DD) in the cube; keep it at or before earliest_time_limit in config.conf.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not os.path.isfile(STOCK_DB_PATH):
+        print(f"Error: DuckDB database '{STOCK_DB_PATH}' not found. Run import_stock_data_to_duckdb.py first.")
+        return
+    con = duckdb.connect(database=STOCK_DB_PATH, read_only=True)
+    print(f"Connected to DuckDB database: {STOCK_DB_PATH}")
+    try:
+        start_time = time.time()
+        bar_count = build_price_cube(con, args.cube_dir, args.since)
+        print(f"Price cube '{args.cube_dir}' built with {bar_count} bars since {args.since} in {time.time() - start_time:.2f} seconds.")
+    finally:
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import duckdb
+import hashlib
+import json
+import os
+import pandas as pd
+from stock_db_utils import ANALYSIS_TABLES, MANIFEST_TABLE
+
+# Directory of the result cache, set cache_dir in the [cache] section of config.conf to move it
+RESULT_CACHE_DIR = './result_cache'
+# Size bound of the result cache in MB, set max_size_mb in the [cache] section to change it
+RESULT_CACHE_MAX_MB = 1024
+# Part of every cache key: bump it when a cached stage computes its output differently,
+# so entries written by the old code are never read back
+RESULT_CACHE_VERSION = 1
+
+def open_result_cache(config, con=None):
+    """
+    Returns the result cache set in the [cache] section of config.conf, or None when
+    enabled = no, so callers pass the result around unconditionally:
+      cache_dir: directory the entries are written to (default ./result_cache).
+      max_size_mb: once the entries take more than this, the least recently used
+                   ones are removed (default 1024).
+    When con is given, the data version of the database or Parquet dataset it reads
+    (see data_fingerprint) becomes part of every key, so entries are only read back
+    while the data is unchanged.
+
+    Args:
+        config: The ConfigParser read from config.conf.
+        con: An open connection from connect_analysis_db, or None for stages whose
+             parameters already identify their input (see frame_fingerprint).
+
+    Returns:
+        dict: The cache directory, size bound and data version, or None.
+    """
+    if not config.getboolean('cache', 'enabled', fallback=True):
+        return None
+    cache_dir = config.get('cache', 'cache_dir', fallback=RESULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return {
+        'cache_dir': cache_dir,
+        'max_bytes': config.getint('cache', 'max_size_mb', fallback=RESULT_CACHE_MAX_MB) * 1024 * 1024,
+        'data_version': data_fingerprint(con, config) if con is not None else None,
+    }
+
+def data_fingerprint(con, config):
+    """
+    Returns a hash identifying the data con reads: the row count and newest trade date
+    of stock_data, the row counts of the ANALYSIS_TABLES, and
+      duckdb: the import manifest (source file, content hash and row count of every
+              imported file), which changes whenever an import changes any data;
+      parquet: the size and modification time of every file in the dataset, which
+               export_stock_data_to_parquet.py rewrites on every export.
+
+    Args:
+        con: An open connection from connect_analysis_db.
+        config: The ConfigParser holding the [settings] section.
+
+    Returns:
+        str: Hex digest.
+    """
+    parts = {'stock_data': con.execute("SELECT COUNT(*), MAX(trade_date) FROM stock_data").fetchone()}
+    for table_name in ANALYSIS_TABLES:
+        parts[table_name] = con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    settings = config['settings']
+    if settings.get('data_source', 'duckdb') == 'parquet':
+        parquet_files = []
+        for directory, _, file_names in os.walk(settings.get('parquet_dir', './stock_parquet')):
+            for file_name in file_names:
+                if file_name.endswith('.parquet'):
+                    file_stat = os.stat(os.path.join(directory, file_name))
+                    parquet_files.append([os.path.join(directory, file_name), file_stat.st_size, file_stat.st_mtime_ns])
+        parts['parquet_files'] = sorted(parquet_files)
+    elif con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE database_name = current_database() AND table_name = $table_name",
+        {'table_name': MANIFEST_TABLE}
+    ).fetchone()[0] > 0:
+        parts[MANIFEST_TABLE] = con.execute(f"""
+            SELECT COUNT(*), md5(string_agg(concat_ws('|', table_name, source_path, content_hash, row_count), ','
+                                            ORDER BY table_name, source_path))
+            FROM {MANIFEST_TABLE}
+        """).fetchone()
+    return hashlib.sha256(json.dumps(parts, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+
+def frame_fingerprint(df):
+    """
+    Returns a hash of the columns, dtypes and values of df, for stages whose input is
+    a frame an earlier stage returned.
+    """
+    digest = hashlib.sha256(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def cache_entry(cache, stage, parameters, extension):
+    """
+    Returns the entry of a stage output, keyed by the stage, its normalized parameters
+    and the data version of the cache, or None when cache is None.
+
+    Args:
+        cache (dict): A cache returned by open_result_cache, or None.
+        stage (str): Name of the stage, the prefix of the entry's file name.
+        parameters (dict): Everything the output depends on; serialized as JSON with
+                           sorted keys, dates and other values as str.
+        extension (str): File extension of the entry.
+
+    Returns:
+        dict: stage, key, path (the entry) and writing_path (where the output is
+              written before store_entry moves it to path), or None.
+    """
+    if cache is None:
+        return None
+    key = hashlib.sha256(json.dumps({
+        'version': RESULT_CACHE_VERSION,
+        'stage': stage,
+        'parameters': parameters,
+        'data_version': cache['data_version'],
+    }, default=str, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    path = os.path.join(cache['cache_dir'], f"{stage}_{key}.{extension}")
+    return {
+        'cache': cache,
+        'stage': stage,
+        'key': key,
+        'path': path,
+        'writing_path': f"{path}.{os.getpid()}.writing",
+    }
+
+def lookup_entry(entry):
+    """
+    Returns True and marks the entry as used when it is in the cache. Prints the hit
+    or miss. Returns False when entry is None.
+    """
+    if entry is None:
+        return False
+    if os.path.isfile(entry['path']):
+        # The modification time is the last use, eviction removes the oldest first
+        os.utime(entry['path'])
+        print(f"结果缓存命中: {entry['stage']} ({entry['key'][:12]})")
+        return True
+    print(f"结果缓存未命中: {entry['stage']} ({entry['key'][:12]})")
+    return False
+
+def store_entry(entry):
+    """
+    Moves the output written to the entry's writing_path into the cache, then evicts
+    the least recently used entries above the size bound. Does nothing when entry is None.
+    """
+    if entry is None:
+        return
+    os.replace(entry['writing_path'], entry['path'])
+    evict_entries(entry['cache'])
+
+def evict_entries(cache):
+    """
+    Removes the least recently used entries until the cache is within its size bound.
+    Entries another process removes at the same time are skipped.
+    """
+    entries = []
+    for file_name in os.listdir(cache['cache_dir']):
+        if file_name.endswith('.writing'):
+            continue
+        path = os.path.join(cache['cache_dir'], file_name)
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((file_stat.st_mtime_ns, file_stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total_bytes <= cache['max_bytes']:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    if evicted:
+        print(f"结果缓存超过 {cache['max_bytes'] // (1024 * 1024)}MB，已删除最久未使用的 {evicted} 项.")
+
+def cached_frame(cache, stage, parameters, compute):
+    """
+    Returns the DataFrame of a stage from the cache, or computes it with compute() and
+    stores it. With cache None, just returns compute().
+    Frames are stored as Parquet written and read by DuckDB: unlike a pickle, reading
+    an entry never runs code, whoever can write to the cache directory. Empty frames
+    are not cached: their object columns have no values DuckDB could infer a type
+    from, so they would come back with other dtypes.
+
+    Args:
+        cache (dict): A cache returned by open_result_cache, or None.
+        stage (str): Name of the stage.
+        parameters (dict): Everything the frame depends on, see cache_entry.
+        compute: Callable without arguments returning the DataFrame.
+
+    Returns:
+        pandas.DataFrame: The frame.
+    """
+    entry = cache_entry(cache, stage, parameters, 'parquet')
+    if lookup_entry(entry):
+        with duckdb.connect() as con:
+            return con.execute("SELECT * FROM read_parquet($path)", {'path': entry['path']}).fetchdf()
+    df = compute()
+    if entry is not None and not df.empty:
+        with duckdb.connect() as con:
+            con.register('frame', df)
+            con.execute(f"COPY frame TO '{entry['writing_path']}' (FORMAT parquet, COMPRESSION zstd)")
+        store_entry(entry)
+    return df
@@ -0,0 +1,321 @@
+import duckdb
+import argparse
+import configparser
+import json
+import os
+import time # Import time for performance measurement
+import traceback
+import pandas as pd
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from stock_db_utils import ANALYSIS_TABLES, STOCK_DB_PATH, create_parquet_views, duckdb_settings, require_analysis_tables
+import stock_chooser_duckdb as chooser
+import stock_chooser_duckdb_dip as dip
+import back_test_v1 as back_test
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+
+def data_version(config):
+    """
+    Returns the size and modification time of every file the data comes from: the
+    database file and its WAL, or the files of the Parquet dataset. It changes whenever
+    an import or an export writes new data, and is cheap enough to check per request.
+    """
+    settings = config['settings']
+    if settings.get('data_source', 'duckdb') == 'parquet':
+        paths = []
+        for directory, _, file_names in os.walk(settings.get('parquet_dir', './stock_parquet')):
+            paths.extend(os.path.join(directory, file_name) for file_name in file_names if file_name.endswith('.parquet'))
+    else:
+        paths = [STOCK_DB_PATH, STOCK_DB_PATH + '.wal']
+    version = []
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            version.append([path, stat.st_size, stat.st_mtime_ns])
+    return version
+
+def load_working_set(config, since):
+    """
+    Copies the adjusted daily bars from since onwards and the ANALYSIS_TABLES into an
+    in-memory DuckDB, so requests never rebuild the adjusted prices and the database
+    file is only locked while copying: imports can run while the service is up.
+    stock_data is a view over the adjusted bars, as with the Parquet dataset.
+
+    Args:
+        config: The ConfigParser read from config.conf.
+        since (datetime.date): The first trade date kept in memory.
+
+    Returns:
+        dict: con (the in-memory connection), created_macros, since, data_version,
+              loaded_at, bar_count and candidates (the screener's window pass kept in
+              breakout_candidates, see ensure_breakout_candidates).
+    """
+    version = data_version(config)
+    start_time = time.time()
+    con = duckdb.connect(database=':memory:', config=duckdb_settings(config))
+    settings = config['settings']
+    try:
+        if settings.get('data_source', 'duckdb') == 'parquet':
+            source_name = settings.get('parquet_dir', './stock_parquet')
+            con.execute("CREATE SCHEMA source;")
+            create_parquet_views(con, source_name, 'source')
+        else:
+            source_name = STOCK_DB_PATH
+            con.execute(f"ATTACH '{STOCK_DB_PATH}' AS source (READ_ONLY);")
+        require_analysis_tables(con, 'source', source_name)
+        con.execute("CREATE TABLE adjusted_stock_data AS SELECT * FROM source.adjusted_stock_data WHERE trade_date >= $since ORDER BY stock_code, trade_date",
+                    {'since': since})
+        for table_name in ANALYSIS_TABLES:
+            con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM source.{table_name}")
+        if settings.get('data_source', 'duckdb') == 'parquet':
+            con.execute("DROP SCHEMA source CASCADE;")
+        else:
+            con.execute("DETACH source;")
+        con.execute("CREATE VIEW stock_data AS SELECT * FROM adjusted_stock_data")
+    except Exception:
+        con.close()
+        raise
+    bar_count = con.execute("SELECT COUNT(*) FROM adjusted_stock_data").fetchone()[0]
+    print(f"Loaded {bar_count} adjusted bars since {since} into memory in {time.time() - start_time:.2f} seconds.")
+    return {
+        'con': con,
+        'created_macros': {},
+        'since': since,
+        'data_version': version,
+        'loaded_at': datetime.now().isoformat(timespec='seconds'),
+        'bar_count': bar_count,
+        'candidates': None,
+    }
+
+def ensure_working_set(service, config, since):
+    """
+    Reloads the working set when the data version changed or a request needs bars
+    before its since date. While an import holds the database file the reload fails;
+    the previous working set keeps serving and the next request tries again.
+    """
+    working_set = service.get('working_set')
+    if working_set is not None and working_set['data_version'] == data_version(config) and working_set['since'] <= since:
+        return working_set
+    try:
+        new_working_set = load_working_set(config, since if working_set is None else min(since, working_set['since']))
+    except duckdb.IOException as e:
+        if working_set is None or working_set['since'] > since:
+            raise
+        print(f"Data changed but could not be reloaded yet, serving the loaded data: {e}")
+        return working_set
+    if working_set is not None:
+        working_set['con'].close()
+    service['working_set'] = new_working_set
+    return new_working_set
+
+def ensure_breakout_candidates(working_set, config, screen_engine, earliest_date, history_trading_days):
+    """
+    Keeps the screener's window pass resident in the temp table breakout_candidates.
+    It is rebuilt only when the earliest trade date or the engine changes, or when a
+    request uses a new N; it then covers every N requested so far, as in a sweep.
+    """
+    candidates = working_set['candidates']
+    if (candidates is not None and candidates['earliest_date'] == earliest_date and candidates['screen_engine'] == screen_engine
+            and history_trading_days in candidates['history_trading_days_list']):
+        return
+    history_trading_days_list = [history_trading_days]
+    if candidates is not None and candidates['earliest_date'] == earliest_date and candidates['screen_engine'] == screen_engine:
+        history_trading_days_list = sorted(set(candidates['history_trading_days_list']) | {history_trading_days}, key=int)
+    start_time = time.time()
+    chooser.create_breakout_candidates(working_set['con'], working_set['created_macros'], config, screen_engine,
+                                       earliest_date, earliest_date, history_trading_days_list, False)
+    working_set['candidates'] = {
+        'earliest_date': earliest_date,
+        'screen_engine': screen_engine,
+        'history_trading_days_list': history_trading_days_list,
+    }
+    print(f"Window pass for N = {', '.join(history_trading_days_list)} ({screen_engine} engine) done in {time.time() - start_time:.2f} seconds.")
+
+def request_config(config, overrides):
+    """
+    Returns a copy of config with the [settings] values in overrides replaced. Only
+    settings that exist in config.conf can be overridden.
+    """
+    unknown = sorted(set(overrides) - set(config['settings']))
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+    request = configparser.ConfigParser()
+    request.read_dict(config)
+    for name, value in overrides.items():
+        request['settings'][name] = str(value)
+    return request
+
+def earliest_trade_date(config):
+    return datetime.strptime(config['settings']['earliest_time_limit'], '%Y-%m-%d %H:%M:%S').date()
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def run_screen(service, config, body):
+    """
+    Screens one parameter set like stock_chooser_duckdb.py: conditions 0-5 from the
+    resident breakout_candidates, then condition 1.1 or 1.2. Nothing is written to
+    screen_state.duckdb or to result files.
+    The body may hold settings (config.conf [settings] overrides, e.g.
+    cond1_and_cond3, cond2, apply_cond5_or_not) and since (YYYY-MM-DD), the first
+    trade date returned; all results are returned by default.
+    """
+    settings = config['settings']
+    earliest_date = earliest_trade_date(config)
+    screen_engine = settings.get('screen_engine', 'duckdb')
+    if screen_engine not in ('duckdb', 'numpy'):
+        raise ValueError(f"screen_engine must be duckdb or numpy, got {screen_engine}")
+    finance_lookup_date = settings.get('finance_lookup_date', 'report_date')
+    if finance_lookup_date not in ('report_date', 'publish_date'):
+        raise ValueError(f"finance_lookup_date must be report_date or publish_date, got {finance_lookup_date}")
+    history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold = settings['cond1_and_cond3'].split('_')
+    combination = (history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, settings['cond2'])
+
+    working_set = ensure_working_set(service, config, earliest_date)
+    ensure_breakout_candidates(working_set, config, screen_engine, earliest_date, history_trading_days)
+    con = working_set['con']
+    chooser.create_screen_table(con, working_set['created_macros'], history_trading_days, finance_lookup_date,
+                                chooser.build_screen_parameters(settings, earliest_date, combination), 'screen_results')
+    chooser.apply_cond_1_1_or_cond_1_2(con, settings['use_cond_1_1_or_cond_1_2'], settings['range_days_of_cond_1_2'])
+    try:
+        first_screen_date = parse_date(body['since']) if body.get('since') else earliest_date
+        return con.execute(chooser.SCREEN_OUTPUT_SQL, {'first_screen_date': first_screen_date}).fetchdf()
+    finally:
+        con.unregister('kept_screen_rows')
+
+def run_dip(service, config, body):
+    """
+    Finds the support price and dip dates like stock_chooser_duckdb_dip.py. The body
+    holds targets, a list of {stock_code, stock_name, breakthrough_date (YYYY-MM-DD)},
+    and optionally max_holding_days (default 40) and settings overrides.
+    """
+    targets = [dict(target, breakthrough_date=pd.to_datetime(target['breakthrough_date'])) for target in body['targets']]
+    working_set = ensure_working_set(service, config, earliest_trade_date(config))
+    limited_df = dip.get_next_N_days_data(targets, int(body.get('max_holding_days', 40)), con=working_set['con'], config=config)
+    return dip.find_support_and_dip_dates(limited_df, targets)
+
+def run_back_test(service, config, body):
+    """
+    Backtests like back_test_v1.py and returns the profit and loss report with its
+    total row, without writing the Excel file. The body holds targets, a list of
+    {stock_code, stock_name, trade_date (support date), breakthrough_date}, both dates
+    as YYYY-MM-DD, and optionally settings overrides.
+    """
+    target_df = pd.DataFrame(body['targets'], columns=['trade_date', 'breakthrough_date', 'stock_code', 'stock_name'])
+    working_set = ensure_working_set(service, config, earliest_trade_date(config))
+    return back_test.do_back_test(target_df=target_df, con=working_set['con'], config=config, export_excel=False)
+
+REQUEST_HANDLERS = {
+    '/screen': run_screen,
+    '/dip': run_dip,
+    '/backtest': run_back_test,
+}
+
+def service_status(service):
+    working_set = service.get('working_set')
+    if working_set is None:
+        return {'loaded': False}
+    return {
+        'loaded': True,
+        'since': str(working_set['since']),
+        'loaded_at': working_set['loaded_at'],
+        'bar_count': working_set['bar_count'],
+        'data_files': len(working_set['data_version']),
+        'data_modified_at': datetime.fromtimestamp(max(entry[2] for entry in working_set['data_version']) / 1e9).isoformat(timespec='seconds')
+                            if working_set['data_version'] else None,
+        'candidates': working_set['candidates'],
+        'requests': service['requests'],
+    }
+
+class ScreenRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /status describes the loaded data. POST /screen, /dip and /backtest take a JSON
+    body (see run_screen, run_dip and run_back_test) and answer with the result rows as
+    JSON records; POST /reload reloads the data. Requests run one at a time on the
+    service's single in-memory connection.
+    """
+
+    def send_json(self, status, payload, rows_json=None):
+        body = json.dumps(payload, ensure_ascii=False, default=str)
+        if rows_json is not None:
+            # The rows are already JSON from DataFrame.to_json, splice them in instead of parsing them again
+            body = body[:-1] + ', "rows": ' + rows_json + '}'
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        self.send_json(200, service_status(self.server.service))
+
+    def do_POST(self):
+        service = self.server.service
+        start_time = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            config = request_config(self.server.config, body.get('settings', {}))
+            if self.path == '/reload':
+                if service['working_set'] is not None:
+                    service['working_set']['data_version'] = None
+                ensure_working_set(service, config, earliest_trade_date(config))
+                self.send_json(200, service_status(service))
+                return
+            if self.path not in REQUEST_HANDLERS:
+                self.send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            results_df = REQUEST_HANDLERS[self.path](service, config, body)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': f"{type(e).__name__}: {e}"})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {'error': f"{type(e).__name__}: {e}"})
+            return
+        service['requests'] += 1
+        self.send_json(200, {
+            'count': len(results_df),
+            'seconds': round(time.time() - start_time, 6),
+            'data_loaded_at': service['working_set']['loaded_at'],
+        }, results_df.to_json(orient='records', date_format='iso', date_unit='s', force_ascii=False))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve screen, dip and backtest requests from data kept in memory.")
+    parser.add_argument('--host', default=SERVICE_HOST, help="Address to listen on; keep it local, there is no authentication.")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help="Port to listen on.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read('./config.conf')
+
+    service = {'working_set': None, 'requests': 0}
+    # Load the data and run the window pass of the configured N up front, so the first request is fast too
+    earliest_date = earliest_trade_date(config)
+    working_set = ensure_working_set(service, config, earliest_date)
+    ensure_breakout_candidates(working_set, config, config['settings'].get('screen_engine', 'duckdb'), earliest_date,
+                               config['settings']['cond1_and_cond3'].split('_')[0])
+
+    server = HTTPServer((args.host, args.port), ScreenRequestHandler)
+    server.service = service
+    server.config = config
+    print(f"Screen service listening on http://{args.host}:{args.port} (GET /status, POST /screen, /dip, /backtest, /reload)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if service['working_set'] is not None:
+            service['working_set']['con'].close()
+
+if __name__ == '__main__':
+    main()
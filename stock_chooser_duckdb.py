@@ -1,244 +1,160 @@
-import duckdb
-import pandas as pd
-from packaging import version
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime
 import time # Import time module for timing
 import configparser
-
-# 计算工作日间隔
-def calculate_workday_diff(dates):
-    dates = dates.values
-    return pd.Series([float('inf')] + [len(pd.date_range(start=dates[i-1], end=dates[i], freq='B')) - 1 for i in range(1, len(dates))])
+import argparse
+import codecs
+import os
+import shutil
+from stock_db_utils import (attach_screen_state, connect_analysis_db, enable_query_profiling, last_query_profile,
+                            new_query_profile, partition_predicate, record_profile_phase, write_profile_report)
+from stock_window_engine import PRICE_COLUMNS, breakout_candidate_frame, load_price_arrays
+from price_cube import PRICE_CUBE_DIR, cube_data_checksum, cube_price_arrays, open_price_cube
+from result_cache import cache_entry, lookup_entry, open_result_cache, store_entry
 
 # 筛选函数：筛选结果后N个交易日内筛选出的日期不作为筛选结果。
-def filter_records(group):
-    # 创建 ConfigParser 对象
-    config = configparser.ConfigParser()
-    config.read('./config.conf')
-    range_days_of_cond_1_2=config['settings']['range_days_of_cond_1_2']         # 使用条件1.2时，其后N个交易日设定值
-    range_days_of_cond_1_2=int(range_days_of_cond_1_2)
-
-    if len(group) <= 1:
-        return group
-    group = group.copy()
-    group['workday_diff'] = calculate_workday_diff(group['trade_date'])
-    keep = [True] * len(group)  # 初始化保留标志
-    last_kept_idx = 0  # 记录最后保留的记录索引
-
-    # 从第二条记录开始检查
-    for i in range(1, len(group)):
-        # 计算当前记录与最后保留记录的间隔
-        workday_diff = len(pd.date_range(start=group.iloc[last_kept_idx]['trade_date'], end=group.iloc[i]['trade_date'], freq='B')) - 1
-        if workday_diff <= range_days_of_cond_1_2:
-            # 如果间隔≤20，删除最后保留的记录和当前记录
-            keep[last_kept_idx] = False
-            keep[i] = False
-        else:
-            # 保留当前记录，更新最后保留的索引
-            last_kept_idx = i
+# results_df 需按 股票代码、交易日期 升序排列，一次处理全部股票，不再逐组 apply。
+def filter_records(results_df, range_days_of_cond_1_2):
+    if results_df.empty:
+        return results_df
+    codes = results_df['股票代码'].values
+    group_start = np.r_[True, codes[1:] != codes[:-1]]
+    group_id = np.cumsum(group_start)
+    trading_days = results_df['交易日序号'].values.astype(np.int64)
+    # 股票序号放在高位，使不同股票的交易日序号互不重叠，整体仍然有序
+    group_offset = group_id.astype(np.int64) * (1 << 32)
+    # 与记录 i 间隔超过 N 个交易日的第一条记录：同一股票内没有时，指向下一只股票的第一条记录
+    next_idx = np.searchsorted(group_offset + trading_days, group_offset + trading_days + range_days_of_cond_1_2, side='right')
 
-    # 确保第一条记录保留
-    keep[0] = True
-    return group[keep].drop(columns='workday_diff')
+    # 从每只股票的第一条记录开始，依次跳到间隔超过 N 个交易日的下一条记录，这些记录是比较的基准
+    is_anchor = np.zeros(len(results_df), dtype=bool)
+    next_list = next_idx.tolist()
+    i = 0
+    while i < len(next_list):
+        is_anchor[i] = True
+        i = next_list[i]
+    # 基准之间的记录与前一基准的间隔 ≤ N，全部删除；基准之后紧跟着这样的记录时，基准本身也删除
+    row_idx = np.arange(len(results_df))
+    keep = is_anchor & (next_idx == row_idx + 1)
+    # 确保每只股票的第一条记录保留
+    keep |= group_start
+    return results_df[keep]
 
 # 筛选函数：次高收盘价为前一个交易日收盘价的不作为筛选结果。
-def mark_records(group):
-    group = group.copy()
-    # 初始化标记列，0 表示保留，1 表示删除
-    group['delete_flag'] = 0
-
-    pd_version = pd.__version__
-    if version.parse(pd_version) < version.parse("2.1.0"):
-        # 手动加回股票代码
-        group['股票代码'] = group.name
-
-    if len(group) <= 1:
-        return group
-
-    # 计算相邻记录的工作日间隔和价格差异
-    dates = group['交易日期'].values
-    prices = group['前复权_收盘价'].values
-    for i in range(1, len(group)):
-        # 计算工作日间隔（忽略周末）
-        workday_diff = len(pd.date_range(start=dates[i-1], end=dates[i], freq='B')) - 1
-        # 如果间隔为1个工作日且后一条记录的 前复权_收盘价 大于前一条
-        if workday_diff == 1 and prices[i] > prices[i-1]:
-            group.iloc[i, group.columns.get_loc('delete_flag')] = 1
-    return group
-
-def apply_mark_records(results_df):
-    """
-    自动适配 pandas 版本，避免 groupby.apply 的 DeprecationWarning 或 TypeError
-    """
-    pd_version = pd.__version__
-
-    if version.parse(pd_version) >= version.parse("2.1.0"):
-        # ✅ pandas 2.1+：在 apply 里传 include_groups
-        results_df = results_df.groupby('股票代码', group_keys=False).apply(
-            mark_records, include_groups=True
-        )
-    else:
-        # ✅ pandas 旧版本
-        results_df = results_df.groupby('股票代码', group_keys=False).apply(
-            mark_records
-        ).reset_index(drop=True)
-
+# results_df 需按 股票代码、交易日期 升序排列，一次比较全部相邻记录。
+def mark_records(results_df):
+    results_df = results_df.copy()
+    codes = results_df['股票代码'].values
+    prices = results_df['前复权_收盘价'].values
+    trading_days = results_df['交易日序号'].values
+    same_stock = np.r_[False, codes[1:] == codes[:-1]]
+    # 相邻记录的交易日间隔（按交易日历，周末和节假日都不计入）
+    trading_day_diff = np.r_[0, trading_days[1:] - trading_days[:-1]]
+    # 如果间隔为1个交易日且后一条记录的 前复权_收盘价 大于前一条，0 表示保留，1 表示删除
+    results_df['delete_flag'] = (same_stock & (trading_day_diff == 1) & (prices > np.r_[np.nan, prices[:-1]])).astype(int)
     return results_df
 
-# 从库中筛选符合条件的记录，处理后导出到结果csv文件。
-def optimize_and_query_stock_data_duckdb():
-    """
-    Connects to DuckDB, creates/ensures stock_data table exists (for testing),
-    and queries stocks satisfying specific conditions using DuckDB.
-    """
+# 解析参数扫描配置 sweep：每组参数为 N_主板振幅_创业板科创板振幅_条件2涨幅，例如 40_25_35_0.05，多组之间用逗号分隔
+def parse_sweep_combinations(sweep):
+    combinations = []
+    for item in sweep.split(','):
+        item = item.strip()
+        if item:
+            history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2 = item.split('_')
+            combinations.append((history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2))
+    return combinations
 
-    # 创建 ConfigParser 对象
-    config = configparser.ConfigParser()
-
-    # 读取 .conf 文件
-    config.read('./config.conf')
-    earliest_time_limit=config['settings']['earliest_time_limit']                                   # 交易日期的最早时限，该日前的交易数据，不会被纳入选择
-    cond1_and_cond3=config['settings']['cond1_and_cond3']                                           # 条件1和条件3的配置项。
-    cond2=config['settings']['cond2']                                                               # 条件2：前N个交易日内有涨幅（大于等于5%）的K线
-    apply_cond2_or_not=config['settings']['apply_cond2_or_not']                                     # 是否启用条件2：yes, 启用; no: 不启用。
-    apply_cond5_or_not=config['settings']['apply_cond5_or_not']                                     # 是否启用条件5：yes, 启用; no: 不启用。
-    # history_trading_days=config['settings']['history_trading_days']                               # 条件1：历史交易日选择范围。40: 40个交易日，60: 60个交易日，80: 80个交易日
-    # main_board_amplitude_threshold=config['settings']['main_board_amplitude_threshold']           # 条件3：主板振幅。25: 25%, 30: 30%, 35: 35%
-    # non_main_board_amplitude_threshold=config['settings']['non_main_board_amplitude_threshold']   # 条件3：创业板和科创板主板振幅。35: 35%， 40: 40%。
-    history_trading_days=cond1_and_cond3.split('_')[0]
-    main_board_amplitude_threshold=cond1_and_cond3.split('_')[1]
-    non_main_board_amplitude_threshold=cond1_and_cond3.split('_')[2]
-    max_market_capitalization=config['settings']['max_market_capitalization']                       # 最大流通市值，单位亿。
-    min_market_capitalization=config['settings']['min_market_capitalization']                       # 最小流通市值，单位亿。
-    net_profit_growth_rate=config['settings']['net_profit_growth_rate']                             # 净利润增长率。-20: -20%。
-    total_revenue_growth_rate=config['settings']['total_revenue_growth_rate']                       # 营业总收入增长率。-20: -20%。
-    use_cond_1_1_or_cond_1_2=config['settings']['use_cond_1_1_or_cond_1_2']                         # 使用条件1.1还是1.2进行筛选：1.1，使用条件1.1; 1.2, 使用条件1.2。
-    range_days_of_cond_1_2=config['settings']['range_days_of_cond_1_2']                             # 使用条件1.2时，其后N个交易日设定值
+# 筛选宏 breakout_screen_n{N} 的参数，调用时按名称绑定，不再把配置值拼接进 SQL
+SCREEN_PARAMETERS = [
+    'earliest_time_limit',
+    'main_board_amplitude_threshold',
+    'non_main_board_amplitude_threshold',
+    'cond2',
+    'apply_cond2_or_not',
+    'min_market_capitalization',
+    'max_market_capitalization',
+    'apply_cond5_or_not',
+    'net_profit_growth_rate',
+    'total_revenue_growth_rate',
+]
 
-    cond2_sql_where_clause = ''
-    if apply_cond2_or_not == 'yes':
-        cond2_sql_where_clause = 'AND has_gain_5_percent = 1'
-    if apply_cond2_or_not == 'no':
-        cond2_sql_where_clause = '-- AND has_gain_5_percent = 1'
+# 一组参数组合 (N, 主板振幅, 创业板科创板振幅, 条件2涨幅) 及 config.conf [settings] 中其余条件对应的筛选宏参数
+def build_screen_parameters(settings, earliest_date, combination):
+    history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2 = combination
+    return {
+        'earliest_time_limit': earliest_date,
+        'main_board_amplitude_threshold': float(main_board_amplitude_threshold),
+        'non_main_board_amplitude_threshold': float(non_main_board_amplitude_threshold),
+        'cond2': float(cond2),
+        'apply_cond2_or_not': settings['apply_cond2_or_not'],
+        'min_market_capitalization': float(settings['min_market_capitalization']),
+        'max_market_capitalization': float(settings['max_market_capitalization']),
+        'apply_cond5_or_not': settings['apply_cond5_or_not'],
+        'net_profit_growth_rate': float(settings['net_profit_growth_rate']),
+        'total_revenue_growth_rate': float(settings['total_revenue_growth_rate']),
+    }
 
-    cond5_sql_where_clause = ''
-    if apply_cond5_or_not == 'yes':
-        cond5_sql_where_clause = f'AND net_profit_yoy >= {net_profit_growth_rate} AND revenue_yoy >= {total_revenue_growth_rate}'
-    if apply_cond5_or_not == 'no':
-        cond5_sql_where_clause = f''
+# 在连接上创建临时表宏（TABLE MACRO），宏体只在首次创建或定义变化时解析一次；
+# created_macros 记录该连接上已创建的宏及其定义，同一进程内重复筛选直接调用
+def ensure_macro(con, created_macros, macro_name, parameters, body_sql):
+    if created_macros.get(macro_name) != (parameters, body_sql):
+        con.execute(f"CREATE OR REPLACE TEMP MACRO {macro_name}({', '.join(parameters)}) AS TABLE {body_sql}")
+        created_macros[macro_name] = (parameters, body_sql)
+    return macro_name
 
-    # Connect to DuckDB database file
-    # Ensure 'stock_data.duckdb' exists and contains data,
-    # or uncomment the data generation part below for testing.
-    con = duckdb.connect(database='stock_data.duckdb', read_only=False)
-    print("连接到数据库: stock_data.duckdb")
-            
-    # 查询库中的数据条数
-    result = con.execute("SELECT COUNT(*) FROM stock_data;").fetchone()
-    print(f"数据库中有{result[0]}条记录。")
-
-    # Main Query SQL (optimized for DuckDB)
-    # The SQL is mostly the same as DuckDB handles window functions efficiently.
-    query_sql = f"""
+# 一次扫描计算所有参数组合用到的 N 日窗口指标（每个 N 一组列，共用同一次按 stock_code, trade_date 的排序），
+# 只保留至少满足一个 N 的条件0、条件1的记录，条件2~5 在 breakout_screen_n{N} 中按绑定的参数筛选。
+# N 是 ROWS BETWEEN 中的常量，只能写进 SQL，因此每组 N 对应一个宏定义。
+# 只输出 first_screen_date 及之后的记录；增量筛选时从 incremental_bars 读取
+def breakout_windows_sql(config, earliest_time_limit, history_trading_days_list, incremental=False):
+    if incremental:
+        bars_sql = "SELECT * FROM incremental_bars"
+    else:
+        bars_sql = f"SELECT * FROM adjusted_stock_data WHERE {partition_predicate(config, earliest_time_limit)}"
+    window_columns = []
+    window_definitions = []
+    candidate_conditions = []
+    for history_trading_days in history_trading_days_list:
+        window_columns.append(f"""
+            -- ✅ {history_trading_days}个交易日内（不含当日）的最高收盘价, 使用的是复权后的收盘价
+            MAX(t.adj_close_price) OVER w{history_trading_days} AS max_close_{history_trading_days}_days,
+            -- ✅ {history_trading_days}个交易日窗口内（不含当日）的最高价（用于振幅计算）, 使用的是复权后的最高价
+            MAX(t.adj_high_price) OVER w{history_trading_days} AS max_high_{history_trading_days}_days,
+            -- ✅ {history_trading_days}个交易日窗口内（不含当日）的最低价（用于振幅计算）, 使用的是复权后的最低价
+            MIN(t.adj_low_price) OVER w{history_trading_days} AS min_low_{history_trading_days}_days,
+            -- ✅ {history_trading_days}个交易日内（不含当日）的第一个交易日的开盘价，用作振幅分母。使用的是复权后的开盘价。
+            FIRST_VALUE(t.adj_open_price) OVER w{history_trading_days} AS open_price_of_first_day_of_{history_trading_days}_days,
+            -- ✅ {history_trading_days}个交易日内（不含当日）的最大单日涨幅，条件2比较其是否 ≥ cond2
+            MAX((t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0)) OVER w{history_trading_days} AS max_gain_{history_trading_days}_days,""")
+        window_definitions.append(f"""
+        w{history_trading_days} AS (
+            PARTITION BY t.stock_code
+            ORDER BY t.trade_date
+            ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
+        )""")
+        # 📌 条件0：窗口内至少有N个交易日数据；📌 条件1：当日收盘价大于前N个交易日的最高收盘价的101%
+        candidate_conditions.append(f"(sw.rn > {history_trading_days} AND sw.adj_close_price > (sw.max_close_{history_trading_days}_days * 1.01))")
+    return f"""
     -- 📝 计算符合条件的股票交易日窗口
-    WITH DeduplicatedStockData AS (
-        -- ✅ 去掉 stock_data 中完全重复的行
-        SELECT DISTINCT stock_code, stock_name, trade_date, open_price, close_price, high_price, low_price, prev_close_price, market_cap, total_market_cap, industry_level1, industry_level2, industry_level3 FROM stock_data
-    ),
-    StockWithRiseFall AS (
-        -- ✅ 计算复权涨跌幅，公式: 复权涨跌幅 = 收盘价 / 前收盘价 - 1
-        SELECT *,
-            (close_price / NULLIF(prev_close_price, 0)) - 1 AS rise_fall
-        FROM DeduplicatedStockData
-    ),
-    AdjustmentFactorComputed AS (
-        -- ✅ 计算复权因子, 公式: 复权因子 = (1 + 复权涨跌幅).cumprod()
-        SELECT *,
-            EXP(SUM(LN(1 + rise_fall)) OVER (PARTITION BY stock_code ORDER BY trade_date)) AS adjustment_factor
-        FROM StockWithRiseFall
-    ),
-    LastRecordComputed AS (
-        -- ✅ 获取每个 stock_code 的最后一条记录的收盘价和复权因子
-        SELECT 
-            t.stock_code,
-            t.close_price AS last_close_price,
-            t.adjustment_factor AS last_adjustment_factor
-        FROM (
-            SELECT 
-                stock_code,
-                close_price,
-                adjustment_factor,
-                ROW_NUMBER() OVER (PARTITION BY stock_code ORDER BY trade_date DESC) AS rn
-            FROM AdjustmentFactorComputed
-        ) t
-        WHERE t.rn = 1
-    ),
-    AdjustedStockData AS (
-        SELECT 
-            a.*,
-            -- ✅ 计算前复权收盘价, 公式: 前复权收盘价 = 复权因子 * (最后一条数据的收盘价 / 最后一条数据的复权因子)
-            a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0)) AS adj_close_price,
-            -- ✅ 前复权其他价格
-            (a.open_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_open_price,
-            (a.high_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_high_price,
-            (a.low_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_low_price,
-            (a.prev_close_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_prev_close_price
-        FROM AdjustmentFactorComputed a
-        LEFT JOIN LastRecordComputed l ON a.stock_code = l.stock_code
+    WITH AdjustedStockData AS (
+        -- ✅ 前复权价格来自共享视图 adjusted_stock_data：导入程序把除权除息日写入 corporate_actions 表，
+        --    前复权价格 = 价格 * 该日之后所有除权事件复权因子的乘积（ASOF 连接），无需逐行计算 EXP(SUM(LN()))
+        -- 🔧 使用 Parquet 数据集时按板块和年份分区裁剪，只读取需要的文件
+        {bars_sql}
     ),
     StockWindows AS (
         SELECT
             t.stock_code,
             t.trade_date,
             t.stock_name,
-            t.close_price,
-            t.high_price,
-            t.low_price,
-            t.open_price,
             t.adj_close_price,
-            t.adj_high_price,
-            t.adj_low_price,
-            t.adj_open_price,
             t.industry_level1,
             t.industry_level2,
             t.industry_level3,
             -- ✅ 流通市值换算成“亿”
             (t.market_cap / 100000000) AS market_cap_of_100_million,
             -- 
-            (t.total_market_cap / 100000000) AS total_market_cap_of_100_million,
-            -- ✅ N个交易日内（不含当日）的最高收盘价, 使用的是复权后的收盘价
-            MAX(t.adj_close_price) OVER (
-                PARTITION BY t.stock_code
-                ORDER BY t.trade_date
-                ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
-            ) AS max_close_n_days,
-            -- ✅ N个交易日窗口内（不含当日）的最高价（用于振幅计算）, 使用的是复权后的最高价
-            MAX(t.adj_high_price) OVER (
-                PARTITION BY t.stock_code
-                ORDER BY t.trade_date
-                ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
-            ) AS max_high_n_days,
-            -- ✅ N个交易日窗口内（不含当日）的最低价（用于振幅计算）, 使用的是复权后的最低价
-            MIN(t.adj_low_price) OVER (
-                PARTITION BY t.stock_code
-                ORDER BY t.trade_date
-                ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
-            ) AS min_low_n_days,
-            -- ✅ N个交易日内（不含当日）的第一个交易日的开盘价，用作振幅分母。使用的是复权后的开盘价。
-            FIRST_VALUE(t.adj_open_price) OVER (
-                PARTITION BY t.stock_code
-                ORDER BY t.trade_date
-                ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
-            ) AS open_price_of_first_day_of_n_days,
-            -- ✅ N个交易日内是否存在单日涨幅 ≥ 5%
-            MAX(CASE
-                WHEN (t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0) >= {cond2} THEN 1
-                ELSE 0
-            END) OVER (
-                PARTITION BY t.stock_code
-                ORDER BY t.trade_date
-                ROWS BETWEEN {history_trading_days} PRECEDING AND 1 PRECEDING
-            ) AS has_gain_5_percent,
+            (t.total_market_cap / 100000000) AS total_market_cap_of_100_million,{''.join(window_columns)}
             -- ✅ 行号：确保窗口至少包含N个交易日
             ROW_NUMBER() OVER (
                 PARTITION BY t.stock_code
@@ -247,129 +163,191 @@ def optimize_and_query_stock_data_duckdb():
         FROM
             AdjustedStockData t
         WHERE
-            -- ✅ 排除北交所股票
-            t.stock_code NOT LIKE 'bj%' AND
+            -- ✅ 排除北交所股票（security_master 中 exchange = 'bj'）
+            t.stock_code IN (SELECT stock_code FROM security_master WHERE exchange <> 'bj') AND
             -- ✅ 排除2022年1月1号之前的交易数据
-            t.trade_date >= '{earliest_time_limit}'
-    ),
-    FilteredStockData AS (
+            t.trade_date >= earliest_time_limit
+        WINDOW{','.join(window_definitions)}
+    )
+    SELECT * FROM StockWindows sw
+    WHERE sw.trade_date >= first_screen_date
+    AND ({' OR '.join(candidate_conditions)})
+    """
+
+# --profile 时把各算子的耗时归到 SQL 中命名的 CTE：DuckDB 会把 CTE 内联进查询计划，
+# 按算子名称和 extra_info（扫描的表、连接条件、过滤条件、投影列）匹配，按顺序取第一个匹配的 CTE
+WINDOWS_CTE_MARKERS = {
+    '输出(候选记录)': [r'rn > \d+', r'max_close_\d+_days \* 1\.01'],
+    'StockWindows': [r'^WINDOW', r'SEMI', r'exchange', r'"Table": "security_master"'],
+    'AdjustedStockData': [r'ASOF_JOIN', r'"Table": "(stock_data|corporate_actions|incremental_bars)"', r'PARQUET'],
+}
+SCREEN_CTE_MARKERS = {
+    'FilteredStockDataWithFinanceData': [r'"Conditions": \["stock_code = stock_code", "trade_date = trade_date"\]'],
+    'NetProfitAndRevenueYoy': [r'ASOF_JOIN', r'fundamentals_quarterly', r'stock_finance_hot'],
+    'FilteredStockData': [r'breakout_candidates', r'security_master', r'trading_calendar', r'max_close'],
+    '输出(排序)': [r'股票代码', r'UNION', r'ORDER_BY'],
+}
+
+# 价格立方体（price_cube.py 生成，导入程序导入后刷新）覆盖 earliest_time_limit 起的全部交易日、包含最新交易日和全部股票，
+# 且生成后K线没有变化（重新导入、除权除息重新复权都会改变 cube_data_checksum）时返回它，否则返回 None
+def open_fresh_price_cube(con, config, earliest_date, stock_codes):
+    cube = open_price_cube(config['settings'].get('price_cube_dir', PRICE_CUBE_DIR))
+    if cube is None:
+        return None
+    newest_trade_date = con.execute("SELECT MAX(trade_date) FROM trading_calendar").fetchone()[0]
+    if cube['since'] > earliest_date or cube['last_trade_date'] != newest_trade_date \
+            or any(stock_code not in cube['stock_rows'] for stock_code in stock_codes):
+        print("价格立方体未覆盖 earliest_time_limit 起的最新数据，从数据库读取K线。")
+        return None
+    if cube['data_checksum'] != cube_data_checksum(con, cube['since']):
+        print("价格立方体生成后K线或复权因子有变化，从数据库读取K线（运行导入程序或 price_cube.py 重新生成）。")
+        return None
+    return cube
+
+# NumPy 引擎：读取一次前复权K线，按股票连续存放在数组中，用 O(n) 的滑动窗口计算各 N 的窗口指标，
+# 得到与 breakout_windows 宏相同的候选记录（rn <= N 的记录该 N 的窗口列为 NULL，条件0已把它们排除）。
+# 股票名称、行业和市值只对候选记录从 stock_data（增量筛选时为 incremental_bars）关联读取
+def create_breakout_candidates_numpy(con, config, earliest_date, first_screen_date, history_trading_days_list, incremental, table_name):
+    start_time = time.time()
+    if incremental:
+        bars_sql = "SELECT * FROM incremental_bars"
+        details_sql = "SELECT * FROM incremental_bars"
+    else:
+        bars_sql = f"SELECT * FROM adjusted_stock_data WHERE {partition_predicate(config, str(earliest_date))}"
+        details_sql = f"SELECT * FROM stock_data WHERE {partition_predicate(config, str(earliest_date))} AND trade_date >= $first_screen_date"
+    # ✅ 排除北交所股票；stock_index 为股票代码排序后的序号，数组按 stock_index、trade_date 排列
+    stock_index_sql = "SELECT stock_code, (ROW_NUMBER() OVER (ORDER BY stock_code) - 1)::INTEGER AS stock_index FROM security_master WHERE exchange <> 'bj'"
+    stock_codes = [row[0] for row in con.execute(f"SELECT stock_code FROM ({stock_index_sql}) ORDER BY stock_index").fetchall()]
+    # 完整筛选时优先从内存映射的价格立方体读取K线（多个进程共享操作系统页缓存），增量筛选只读取 incremental_bars
+    cube = None if incremental else open_fresh_price_cube(con, config, earliest_date, stock_codes)
+    if cube is not None:
+        arrays = cube_price_arrays(cube, stock_codes, earliest_date)
+    else:
+        arrays = load_price_arrays(con, f"""
+            SELECT s.stock_index, b.trade_date, {', '.join('b.' + column for column in PRICE_COLUMNS)}
+            FROM ({bars_sql}) b
+            JOIN ({stock_index_sql}) s ON s.stock_code = b.stock_code
+            WHERE b.trade_date >= $earliest_time_limit
+            ORDER BY s.stock_index, b.trade_date
+        """, {'earliest_time_limit': earliest_date})
+    load_time = time.time()
+    candidates_df = breakout_candidate_frame(arrays, stock_codes, history_trading_days_list, first_screen_date)
+    compute_time = time.time()
+
+    window_columns = [column for column in candidates_df.columns if column not in ('stock_code', 'trade_date', 'adj_close_price', 'rn')]
+    con.register('breakout_window_rows', candidates_df)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {table_name} AS
+        SELECT
+            d.stock_code,
+            d.trade_date,
+            d.stock_name,
+            w.adj_close_price,
+            d.industry_level1,
+            d.industry_level2,
+            d.industry_level3,
+            (d.market_cap / 100000000) AS market_cap_of_100_million,
+            (d.total_market_cap / 100000000) AS total_market_cap_of_100_million,
+            {', '.join('w.' + column for column in window_columns)},
+            w.rn
+        FROM breakout_window_rows w
+        -- 候选记录为空时 DataFrame 的列没有类型，关联时显式转换
+        JOIN ({details_sql}) d ON d.stock_code = CAST(w.stock_code AS VARCHAR) AND d.trade_date = CAST(w.trade_date AS DATE)
+    """, {} if incremental else {'first_screen_date': first_screen_date})
+    con.unregister('breakout_window_rows')
+    end_time = time.time()
+    print(f"NumPy 引擎: 从{'价格立方体' if cube is not None else '数据库'}读取 {len(arrays['trade_date'])} 条K线 {load_time - start_time:.2f}秒, "
+          f"窗口计算 {compute_time - load_time:.2f}秒, 关联 {len(candidates_df)} 条候选记录 {end_time - compute_time:.2f}秒.")
+
+# 用 screen_engine 指定的引擎计算窗口指标，候选记录存入临时表 table_name：
+#   duckdb: breakout_windows 宏（窗口函数）；numpy: create_breakout_candidates_numpy
+def create_breakout_candidates(con, created_macros, config, screen_engine, earliest_date, first_screen_date,
+                               history_trading_days_list, incremental, table_name='breakout_candidates'):
+    if screen_engine == 'numpy':
+        create_breakout_candidates_numpy(con, config, earliest_date, first_screen_date, history_trading_days_list, incremental, table_name)
+        return
+    windows_macro = ensure_macro(con, created_macros, 'breakout_windows_incremental' if incremental else 'breakout_windows',
+                                 ['earliest_time_limit', 'first_screen_date'],
+                                 breakout_windows_sql(config, str(earliest_date), history_trading_days_list, incremental))
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {table_name} AS SELECT * FROM {windows_macro}($earliest_time_limit, $first_screen_date)",
+                {'earliest_time_limit': earliest_date, 'first_screen_date': first_screen_date})
+
+# 按一组参数从 breakout_candidates 中筛选的宏体：条件2~5 的阈值、最早日期都是宏参数（见 SCREEN_PARAMETERS）。
+# finance_lookup_date 是 ASOF 连接的列名，和 N 一样写进 SQL
+def breakout_screen_sql(history_trading_days, finance_lookup_date):
+    return f"""
+    WITH FilteredStockData AS (
         SELECT
             sw.stock_code,
             sw.stock_name,
             sw.trade_date,
+            -- ✅ 交易日序号（来自 trading_calendar），用于条件1.1和1.2按交易日计算间隔
+            tc.trading_day,
             sw.adj_close_price,
-            sw.max_close_n_days,
+            sw.max_close_{history_trading_days}_days AS max_close_n_days,
             sw.market_cap_of_100_million,
             sw.total_market_cap_of_100_million,
             sw.industry_level1,
             sw.industry_level2,
             sw.industry_level3
         FROM
-            StockWindows AS sw
+            breakout_candidates AS sw
+        -- ✅ 条件3的振幅阈值按 security_master 中的板块分类
+        JOIN security_master sm ON sm.stock_code = sw.stock_code
+        LEFT JOIN trading_calendar tc ON tc.trade_date = sw.trade_date
         WHERE
             -- 📌 条件0：窗口内至少有N个交易日数据
             sw.rn > {history_trading_days}
             -- 📌 条件1：当日收盘价大于前N个交易日的最高收盘价的101%
-            AND sw.adj_close_price > (sw.max_close_n_days * 1.01)
+            AND sw.adj_close_price > (sw.max_close_{history_trading_days}_days * 1.01)
             -- 📌 条件2：前N个交易日内有涨幅（大于等于5%）的K线
-            {cond2_sql_where_clause}
+            AND (apply_cond2_or_not <> 'yes' OR sw.max_gain_{history_trading_days}_days >= cond2)
             -- 📌 条件3：前N个交易日的股票价格振幅度，上证和深证股票小于等于25%(30%, 35%)，创业板和科创板股票小于等于35%(40%, 40%)
             AND (
-                -- ✅ 根据股票代码板块（前缀）确定振幅阈值
                 CASE
-                    WHEN sw.open_price_of_first_day_of_n_days > 0
-                    THEN (sw.max_high_n_days - sw.min_low_n_days) * 1.0 / sw.open_price_of_first_day_of_n_days * 100
+                    WHEN sw.open_price_of_first_day_of_{history_trading_days}_days > 0
+                    THEN (sw.max_high_{history_trading_days}_days - sw.min_low_{history_trading_days}_days) * 1.0 / sw.open_price_of_first_day_of_{history_trading_days}_days * 100
                     ELSE 999999 -- 避免除零错误
                 END
             ) <= (
-                CASE
-                    -- ✅ 创业板（以300，301，302开头）或科创板（以688开头），小于等于35%(40%, 40%)
-                    WHEN sw.stock_code LIKE 'sz300%' OR sw.stock_code LIKE 'sz301%' OR sw.stock_code LIKE 'sz302%' OR sw.stock_code LIKE 'sh688%' THEN {non_main_board_amplitude_threshold}
-                    -- ✅ 上证主板（以600，601，603，605开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sh600%' OR sw.stock_code LIKE 'sh601%' OR sw.stock_code LIKE 'sh603%' OR sw.stock_code LIKE 'sh605%' THEN {main_board_amplitude_threshold}
-                    -- ✅ 深证主板（以000，001，002，003开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sz000%' OR sw.stock_code LIKE 'sz001%' OR sw.stock_code LIKE 'sz002%' OR sw.stock_code LIKE 'sz003%' THEN {main_board_amplitude_threshold}
+                CASE sm.amplitude_bucket
+                    -- ✅ 创业板（300，301，302）和科创板（688），小于等于35%(40%, 40%)
+                    WHEN 'growth' THEN non_main_board_amplitude_threshold
+                    -- ✅ 上证主板（600，601，603，605）和深证主板（000，001，002，003），小于等于25%(30%, 35%)
+                    WHEN 'main' THEN main_board_amplitude_threshold
                     ELSE 1000
                 END
             )
             -- 📌 条件4：流通市值在30亿至500亿之间
-            AND sw.market_cap_of_100_million BETWEEN {min_market_capitalization} AND {max_market_capitalization}
+            AND sw.market_cap_of_100_million BETWEEN min_market_capitalization AND max_market_capitalization
     ),
-    DeduplicatedFinanceData AS (
-        -- ✅ 去掉 stock_finance_data 中完全重复的行, R_np: 报告净利润(Reported Net Profit), R_operating_total_revenue: 报告营业总收入(Reported Operating Total Revenue)
-        SELECT DISTINCT stock_code, report_date, R_np, R_operating_total_revenue FROM stock_finance_data
-        WHERE
-            -- ✅ 排除北交所股票
-            stock_code NOT LIKE 'bj%'
-            -- ✅ 排除2022年1月1号之前的交易数据
-            AND STRPTIME(report_date, '%Y%m%d') >= STRPTIME('{earliest_time_limit}', '%Y-%m-%d %H:%M:%S')
-    ),
-    LatestFinanceData AS (
-        -- 步骤 1: 为每个 stock_code 和 trade_date 找到最近的 stock_finance_data 记录
+    NetProfitAndRevenueYoy AS (
+        -- ✅ 为每个 stock_code 和 trade_date 找到当时最近的一期财报：按 {finance_lookup_date} 做 ASOF 连接（时间点查询），
+        --    每行只取一条 fundamentals_quarterly 记录，不再做范围连接 + GROUP BY MAX(report_date)
+        --    净利润、营业总收入及其同比增长率已由财务导入程序按去年同一季度算好
         SELECT
             s.stock_code,
             s.trade_date,
-            MAX(f.report_date) AS latest_report_date
+            f.report_date AS latest_report_date,
+            f.R_np AS latest_R_np,
+            f.R_operating_total_revenue AS latest_R_operating_total_revenue,
+            -- ✅ 与原来一样，只和 earliest_time_limit 之后的去年同期财报比较
+            CASE WHEN f.last_year_report_date >= earliest_time_limit THEN f.net_profit_yoy END AS net_profit_yoy,
+            CASE WHEN f.last_year_report_date >= earliest_time_limit THEN f.revenue_yoy END AS revenue_yoy
         FROM FilteredStockData s
-        LEFT JOIN DeduplicatedFinanceData f
+        ASOF LEFT JOIN (
+            SELECT * FROM fundamentals_quarterly
+            WHERE report_date >= earliest_time_limit
+        ) f
             ON s.stock_code = f.stock_code
-            AND STRPTIME(f.report_date, '%Y%m%d') <= s.trade_date
-            AND STRPTIME(f.report_date, '%Y%m%d') >= STRPTIME('{earliest_time_limit}', '%Y-%m-%d %H:%M:%S')
-        GROUP BY s.stock_code, s.trade_date
-    ),
-    FinanceRecords AS (
-        -- 步骤 2 & 3: 获取最近财务记录的详细信息并找到去年同期的财务记录（去年同一季度）
-        SELECT 
-            l.stock_code,
-            l.trade_date,
-            l.latest_report_date,
-            f1.R_np AS latest_R_np,
-            f1.R_operating_total_revenue AS latest_R_operating_total_revenue,
-            CAST(
-                (CAST(SUBSTR(l.latest_report_date, 1, 4) AS INTEGER) - 1) || SUBSTR(l.latest_report_date, 5, 4) AS VARCHAR
-            ) AS last_year_report_date,
-            f2.R_np AS last_year_R_np,
-            f2.R_operating_total_revenue AS last_year_R_operating_total_revenue
-        FROM LatestFinanceData l
-        LEFT JOIN DeduplicatedFinanceData f1
-            ON l.stock_code = f1.stock_code
-            AND f1.report_date = l.latest_report_date
-        LEFT JOIN DeduplicatedFinanceData f2
-            ON l.stock_code = f2.stock_code
-            AND f2.report_date = CAST(
-                (CAST(SUBSTR(l.latest_report_date, 1, 4) AS INTEGER) - 1) || SUBSTR(l.latest_report_date, 5, 4) AS VARCHAR
-            )
-    ),
-    NetProfitAndRevenueYoy AS (
-        -- 步骤 4: 计算同比增长率
-        SELECT 
-            stock_code,
-            trade_date,
-            latest_report_date,
-            latest_R_np,
-            latest_R_operating_total_revenue,
-            last_year_report_date,
-            last_year_R_np,
-            last_year_R_operating_total_revenue,
-            -- 净利润同比增长率
-            CASE 
-                WHEN last_year_R_np IS NOT NULL AND last_year_R_np != 0
-                THEN ROUND((latest_R_np - last_year_R_np) / last_year_R_np * 100, 2)
-                ELSE NULL
-            END AS net_profit_yoy,
-            -- 营业总收入同比增长率
-            CASE 
-                WHEN last_year_R_operating_total_revenue IS NOT NULL AND last_year_R_operating_total_revenue != 0
-                THEN ROUND((latest_R_operating_total_revenue - last_year_R_operating_total_revenue) / last_year_R_operating_total_revenue * 100, 2)
-                ELSE NULL
-            END AS revenue_yoy
-        FROM FinanceRecords
+            AND s.trade_date >= f.{finance_lookup_date}
     ),
     FilteredStockDataWithFinanceData AS (
         SELECT
             s.stock_code,
             s.stock_name,
             s.trade_date,
+            s.trading_day,
             s.adj_close_price,
             s.max_close_n_days,
             s.market_cap_of_100_million,
@@ -398,6 +376,7 @@ def optimize_and_query_stock_data_duckdb():
         stock_code AS 股票代码,
         stock_name AS 股票名称,
         trade_date AS 交易日期,
+        trading_day AS 交易日序号,
         ROUND(adj_close_price, 2) AS 前复权_收盘价,
         ROUND(max_close_n_days, 2) AS 前复权_前{history_trading_days}天最高收盘价,
         ROUND(market_cap_of_100_million, 2) AS "流市值(亿)",
@@ -410,16 +389,17 @@ def optimize_and_query_stock_data_duckdb():
         industry_level2 AS 所属领域2,
         industry_level3 AS 所属领域3
     FROM FilteredStockDataWithFinanceData
-    WHERE '{apply_cond5_or_not}' = 'yes' 
+    WHERE apply_cond5_or_not = 'yes' 
         AND net_profit_yoy IS NOT NULL 
         AND revenue_yoy IS NOT NULL 
         -- 📌 条件5：最近一个财报周期净利润同比增长率和营业总收入同比增长率大于等于-20%
-        {cond5_sql_where_clause}
+        AND net_profit_yoy >= net_profit_growth_rate AND revenue_yoy >= total_revenue_growth_rate
     UNION ALL
     SELECT
         stock_code AS 股票代码,
         stock_name AS 股票名称,
         trade_date AS 交易日期,
+        trading_day AS 交易日序号,
         ROUND(adj_close_price, 2) AS 前复权_收盘价,
         ROUND(max_close_n_days, 2) AS 支撑价,
         -- ROUND(max_close_n_days, 2) AS 前复权_前{history_trading_days}天最高收盘价,
@@ -433,76 +413,560 @@ def optimize_and_query_stock_data_duckdb():
         industry_level2 AS 所属领域2,
         industry_level3 AS 所属领域3
     FROM FilteredStockDataWithFinanceData
-    WHERE '{apply_cond5_or_not}' = 'no'
-    ORDER BY 股票代码, 交易日期;
+    WHERE apply_cond5_or_not = 'no'
+    ORDER BY 股票代码, 交易日期
     """
 
-    # # 调试代码
-    # print(f"SQL: {query_sql}")
-    # return
+# 参数组合的标识，screen_state 中的 screen_runs、screen_hits 按它区分不同参数的筛选结果
+def screen_key(history_trading_days, screen_parameters, finance_lookup_date):
+    return "_".join([str(history_trading_days)] + [str(screen_parameters[name]) for name in SCREEN_PARAMETERS] + [finance_lookup_date])
 
-    print("\n---------- 分析查询计划 (DuckDB) -------")
-    # DuckDB provides 'EXPLAIN' for query plans
-    # query_plan = con.execute("EXPLAIN " + query_sql).fetchall()
-    # print(query_plan)
-    print("--------------------------------------\n")
+# --as-of 的日期必须是 earliest_time_limit 起的交易日，否则关闭连接并提示后退出（退出码 1），不输出异常堆栈
+def check_as_of(con, as_of, earliest_date):
+    message = None
+    if con.execute("SELECT COUNT(*) FROM trading_calendar WHERE trade_date = $as_of", {'as_of': as_of}).fetchone()[0] == 0:
+        message = f"--as-of {as_of} 不是交易日"
+    elif as_of < earliest_date:
+        message = f"--as-of {as_of} 早于 earliest_time_limit {earliest_date}"
+    if message is not None:
+        con.close()
+        raise SystemExit(message)
 
-    print("\n执行筛选...")
-    start_time = time.time()
-    results_df = con.execute(query_sql).fetchdf() # Fetch results directly as a Pandas DataFrame
-    
+# 增量筛选要计算的交易日区间：
+#   as_of: 只筛选该交易日（已由 check_as_of 检查）；
+#   since_last_run: 从这些参数组合上次筛选到的交易日之后，到最新交易日；有参数组合从未筛选过时只筛选最新交易日。
+# 没有新的交易日时返回 None
+def incremental_screen_dates(con, screen_keys, earliest_date, as_of):
+    if as_of is not None:
+        return as_of, as_of
+    newest_trade_date = con.execute("SELECT MAX(trade_date) FROM trading_calendar").fetchone()[0]
+    placeholders = ", ".join(f"$screen_key_{i}" for i in range(len(screen_keys)))
+    last_trade_date, screened_keys = con.execute(
+        f"SELECT MIN(last_trade_date), COUNT(*) FROM screen_state.screen_runs WHERE screen_key IN ({placeholders})",
+        {f"screen_key_{i}": key for i, key in enumerate(screen_keys)}
+    ).fetchone()
+    if screened_keys < len(screen_keys):
+        return newest_trade_date, newest_trade_date
+    if last_trade_date >= newest_trade_date:
+        return None
+    first_trade_date = con.execute(
+        "SELECT MIN(trade_date) FROM trading_calendar WHERE trade_date > $last_trade_date", {'last_trade_date': last_trade_date}
+    ).fetchone()[0]
+    return first_trade_date, newest_trade_date
+
+# 条件1.1、1.2要用到 earliest_time_limit 起的全部筛选结果，增量筛选只有在 screen_state 中这些参数组合的记录从 earliest_time_limit 起、
+# 连续到 first_screen_date 的前一个交易日，且这段K线在记录后没有变化时，才能和完整筛选的结果一致。
+# 返回记录不完整的参数组合：从未筛选过、记录与新交易日之间有缺口、旧版本写入的记录没有起始日期或K线校验值，
+# 或记录之后重新导入修正了这段K线（校验值不同，见 record_screen_checksums）
+def uncovered_screen_keys(con, screen_keys, earliest_date, first_screen_date):
+    previous_trade_date = con.execute(
+        "SELECT MAX(trade_date) FROM trading_calendar WHERE trade_date < $first_screen_date", {'first_screen_date': first_screen_date}
+    ).fetchone()[0]
+    query_parameters = {f"screen_key_{i}": key for i, key in enumerate(screen_keys)}
+    query_parameters['earliest_time_limit'] = earliest_date
+    coverage_sql = f"""
+        SELECT screen_key, first_trade_date, last_trade_date, data_checksum
+        FROM screen_state.screen_runs
+        WHERE screen_key IN ({', '.join('$' + name for name in query_parameters if name.startswith('screen_key_'))})
+        AND first_trade_date <= $earliest_time_limit
+    """
+    # first_screen_date 是 earliest_time_limit 起的第一个交易日时，之前没有需要的记录
+    if previous_trade_date is not None and previous_trade_date >= earliest_date:
+        coverage_sql += " AND last_trade_date >= $previous_trade_date"
+        query_parameters['previous_trade_date'] = previous_trade_date
+    covered_keys = set()
+    checksums = {}
+    for key, first_trade_date, last_trade_date, data_checksum in con.execute(coverage_sql, query_parameters).fetchall():
+        if data_checksum is None:
+            continue
+        if (first_trade_date, last_trade_date) not in checksums:
+            checksums[(first_trade_date, last_trade_date)] = cube_data_checksum(con, first_trade_date, last_trade_date)
+        if checksums[(first_trade_date, last_trade_date)] != data_checksum:
+            print(f"{first_trade_date} ~ {last_trade_date} 的K线在上次筛选后有变化（重新导入或修正了K线）: {key}")
+            continue
+        covered_keys.add(key)
+    return [key for key in screen_keys if key not in covered_keys]
 
-    # 确保 trade_date 是 datetime 格式
-    # results_df['trade_date'] = pd.to_datetime(results_df['trade_date'])
-    # 按 stock_code 和 trade_date 升序排序
-    results_df = results_df.sort_values(['股票代码', '交易日期'], ascending=[True, True]).reset_index(drop=True)
+# 增量筛选只读取计算窗口需要的最近K线，存入临时表 incremental_bars：
+#   所有股票从第一个新交易日之前第 N 个交易日（交易日历）起读取，每支股票约 N + 新交易日数 根K线；
+#   这段日历内K线不足 N 根的股票（停牌、新上市），窗口会延伸到更早，这些股票从 earliest_time_limit 起读取，
+#   因此窗口指标和行号条件与完整筛选完全一致。
+def create_incremental_bars(con, config, earliest_date, first_screen_date, last_screen_date, history_trading_days):
+    window_start_date = con.execute("""
+        SELECT MIN(c.trade_date)
+        FROM trading_calendar c, trading_calendar f
+        WHERE f.trade_date = $first_screen_date AND c.trading_day >= f.trading_day - $history_trading_days
+    """, {'first_screen_date': first_screen_date, 'history_trading_days': history_trading_days}).fetchone()[0]
+    window_start_date = max(window_start_date, earliest_date)
+    lookback_stock_codes = [row[0] for row in con.execute(f"""
+        SELECT stock_code
+        FROM stock_data
+        WHERE {partition_predicate(config, str(window_start_date))}
+        AND trade_date BETWEEN $window_start_date AND $last_screen_date
+        AND stock_code IN (SELECT stock_code FROM security_master WHERE exchange <> 'bj')
+        GROUP BY stock_code
+        HAVING COUNT(*) FILTER (WHERE trade_date < $first_screen_date) < $history_trading_days
+    """, {
+        'window_start_date': window_start_date,
+        'first_screen_date': first_screen_date,
+        'last_screen_date': last_screen_date,
+        'history_trading_days': history_trading_days,
+    }).fetchall()]
+    bars_sql = f"""
+        SELECT * FROM adjusted_stock_data
+        WHERE {partition_predicate(config, str(window_start_date))}
+        AND trade_date BETWEEN $window_start_date AND $last_screen_date
+    """
+    query_parameters = {'window_start_date': window_start_date, 'last_screen_date': last_screen_date}
+    if lookback_stock_codes:
+        stock_code_parameters = {f"stock_code_{i}": stock_code for i, stock_code in enumerate(lookback_stock_codes)}
+        bars_sql += f"""
+        UNION ALL
+        SELECT * FROM adjusted_stock_data
+        WHERE {partition_predicate(config, str(earliest_date), lookback_stock_codes)}
+        AND stock_code IN ({', '.join('$' + name for name in stock_code_parameters)})
+        AND trade_date >= $earliest_time_limit AND trade_date < $window_start_date
+        """
+        query_parameters['earliest_time_limit'] = earliest_date
+        query_parameters.update(stock_code_parameters)
+    con.execute(f"CREATE OR REPLACE TEMP TABLE incremental_bars AS {bars_sql}", query_parameters)
+    print(f"增量筛选读取 {window_start_date} 起的K线，其中 {len(lookback_stock_codes)} 支股票K线不足 {history_trading_days} 根，从 {earliest_date} 起读取。")
 
+# 把临时表 source_table 中条件0~5的筛选结果（条件1.1、1.2处理前）写入 screen_hits，替换该参数组合在这段交易日内原有的记录，
+# 并记录筛选到的最新交易日。
+# covered_from 不为空时，source_table 是从 covered_from（earliest_time_limit）起补齐的全部记录：替换该参数组合原有的全部记录，
+# 连续记录的区间重新记为 covered_from ~ last_screen_date
+def record_screen_hits(con, key, source_table, first_screen_date, last_screen_date, covered_from=None):
+    con.execute("BEGIN TRANSACTION;")
+    if covered_from is None:
+        con.execute("""
+            DELETE FROM screen_state.screen_hits
+            WHERE screen_key = $screen_key AND trade_date BETWEEN $first_screen_date AND $last_screen_date
+        """, {'screen_key': key, 'first_screen_date': first_screen_date, 'last_screen_date': last_screen_date})
+    else:
+        con.execute("DELETE FROM screen_state.screen_hits WHERE screen_key = $screen_key", {'screen_key': key})
+    con.execute(f"INSERT INTO screen_state.screen_hits SELECT $screen_key, * FROM {source_table}", {'screen_key': key})
+    con.execute("""
+        INSERT INTO screen_state.screen_runs (screen_key, first_trade_date, last_trade_date, run_time)
+        VALUES ($screen_key, $covered_from, $last_screen_date, CURRENT_TIMESTAMP)
+        ON CONFLICT (screen_key) DO UPDATE SET
+            first_trade_date = COALESCE(EXCLUDED.first_trade_date, first_trade_date),
+            last_trade_date = CASE WHEN EXCLUDED.first_trade_date IS NULL THEN GREATEST(last_trade_date, EXCLUDED.last_trade_date)
+                                   ELSE EXCLUDED.last_trade_date END,
+            run_time = EXCLUDED.run_time
+    """, {'screen_key': key, 'covered_from': covered_from, 'last_screen_date': last_screen_date})
+    con.execute("COMMIT;")
+
+# 条件1.1、1.2要和之前的筛选结果比较：把 screen_hits 中 screen_increment 里的股票截至 last_screen_date 的全部记录
+# 存入临时表 screen_results（列与筛选结果相同）。
+# 记录之后新增的除权除息事件会改变之前的前复权价格，条件1.1比较的 前复权_收盘价 按当前的 adjusted_stock_data 重新读取，
+# 与完整筛选一致（条件0~5只比较同一股票窗口内价格的比例，复权不改变筛选结果）
+def load_screen_hits(con, key, last_screen_date):
+    con.execute("CREATE OR REPLACE TEMP TABLE screen_results AS SELECT * FROM screen_increment LIMIT 0;")
+    stock_codes = [row[0] for row in con.execute("SELECT DISTINCT 股票代码 FROM screen_increment ORDER BY 股票代码").fetchall()]
+    if not stock_codes:
+        return
+    query_parameters = {f"stock_code_{i}": stock_code for i, stock_code in enumerate(stock_codes)}
+    stock_code_list = ', '.join('$' + name for name in query_parameters)
+    query_parameters.update({'screen_key': key, 'last_screen_date': last_screen_date})
+    con.execute(f"""
+        INSERT INTO screen_results
+        SELECT h.* EXCLUDE (screen_key) REPLACE (ROUND(a.adj_close_price, 2) AS adj_close_price)
+        FROM screen_state.screen_hits h
+        JOIN adjusted_stock_data a ON a.stock_code = h.stock_code AND a.trade_date = h.trade_date
+        WHERE h.screen_key = $screen_key
+        AND h.trade_date <= $last_screen_date
+        AND h.stock_code IN ({stock_code_list})
+        AND a.stock_code IN ({stock_code_list})
+        AND a.trade_date <= $last_screen_date
+    """, query_parameters)
+
+# 记录各参数组合 screen_hits 所依据的K线的校验值（first_trade_date ~ last_trade_date 的 cube_data_checksum），
+# 之后重新导入修正了这段K线时，下次增量筛选从 earliest_time_limit 起重新筛选（见 uncovered_screen_keys）。
+# 使用 Parquet 数据集时 stock_data 是前复权K线，新增除权除息事件也会改变校验值
+def record_screen_checksums(con, screen_keys):
+    placeholders = ", ".join(f"$screen_key_{i}" for i in range(len(screen_keys)))
+    screen_runs = con.execute(
+        f"SELECT screen_key, first_trade_date, last_trade_date FROM screen_state.screen_runs WHERE screen_key IN ({placeholders})",
+        {f"screen_key_{i}": key for i, key in enumerate(screen_keys)}
+    ).fetchall()
+    checksums = {}
+    for key, first_trade_date, last_trade_date in screen_runs:
+        if first_trade_date is None:
+            continue
+        if (first_trade_date, last_trade_date) not in checksums:
+            checksums[(first_trade_date, last_trade_date)] = cube_data_checksum(con, first_trade_date, last_trade_date)
+        con.execute("UPDATE screen_state.screen_runs SET data_checksum = $data_checksum WHERE screen_key = $screen_key",
+                    {'data_checksum': checksums[(first_trade_date, last_trade_date)], 'screen_key': key})
+
+# 条件1.1、1.2 只需要股票代码、交易日序号和收盘价：只读取这三列和 rowid，按 股票代码、交易日期 排序后用 mark_records、filter_records 处理，
+# 保留的记录号存入 kept_screen_rows，结果本身留在 screen_results 中
+def apply_cond_1_1_or_cond_1_2(con, use_cond_1_1_or_cond_1_2, range_days_of_cond_1_2):
+    keys_df = con.execute("""
+        SELECT rowid AS 记录号, 股票代码, 交易日序号, 前复权_收盘价
+        FROM screen_results
+        ORDER BY 股票代码, 交易日期
+    """).fetchdf()
     if use_cond_1_1_or_cond_1_2 == "1.1":
         # 📌 条件1.1: 次高收盘价为前一个交易日收盘价的不作为筛选结果
         # 按 stock_code 分组并添加删除标记
-        results_df = apply_mark_records(results_df)
-        # 📌 确保 delete_flag 存在
-        if 'delete_flag' not in results_df.columns:
-            results_df['delete_flag'] = 0
+        keys_df = mark_records(keys_df)
         # 删除标记为“删除”的记录
-        results_df = results_df[results_df['delete_flag'] == 0].drop(columns='delete_flag').reset_index(drop=True)
+        keys_df = keys_df[keys_df['delete_flag'] == 0]
 
     if use_cond_1_1_or_cond_1_2 == "1.2":
         # 📌 条件1.2: 筛选结果后20个交易日内筛选出的日期不作为筛选结果
-        results_df = results_df.groupby('股票代码', group_keys=False).apply(filter_records).reset_index(drop=True)
+        keys_df = filter_records(keys_df, int(range_days_of_cond_1_2))
+    con.register('kept_screen_rows', keys_df[['记录号']])
+
+# 结果文件格式，config.conf 中 result_formats 的可选值
+RESULT_FORMATS = ['csv', 'parquet']
+
+# 把 output_sql 的结果写入 output_basename.csv / .parquet，由 DuckDB 分批写出，不经过 pandas，结果条数多时内存占用也不变：
+#   csv: 带 BOM 的 UTF-8（Excel 可直接打开），DuckDB 先写出不带 BOM 的文件，再接在 BOM 后面复制过去；
+#   parquet: 保留列类型，按 zstd 压缩。
+def export_screen_results(con, output_sql, query_parameters, output_basename, result_formats):
+    output_filenames = []
+    for result_format in result_formats:
+        output_filename = f"{output_basename}.{result_format}"
+        if result_format == 'parquet':
+            con.execute(f"COPY ({output_sql}) TO '{output_filename}' (FORMAT parquet, COMPRESSION zstd)", query_parameters)
+        else:
+            writing_filename = output_filename + '.writing'
+            con.execute(f"COPY ({output_sql}) TO '{writing_filename}' (FORMAT csv, HEADER)", query_parameters)
+            with open(output_filename, 'wb') as output_file, open(writing_filename, 'rb') as writing_file:
+                output_file.write(codecs.BOM_UTF8)
+                shutil.copyfileobj(writing_file, output_file)
+            os.remove(writing_filename)
+        output_filenames.append(output_filename)
+    return output_filenames
+
+# 从库中筛选符合条件的记录，处理后导出到结果csv文件。
+# as_of / since_last_run 为增量筛选：只计算新交易日，返回各参数组合新增的筛选结果（完整筛选时各组合的值为 None）。
+# profile_path 不为空时开启 DuckDB 性能分析，按阶段和 CTE 汇总的耗时写入该 JSON 文件。
+def optimize_and_query_stock_data_duckdb(as_of=None, since_last_run=False, profile_path=None):
+    """
+    Connects to DuckDB, creates/ensures stock_data table exists (for testing),
+    and queries stocks satisfying specific conditions using DuckDB.
+    """
+
+    # 创建 ConfigParser 对象
+    config = configparser.ConfigParser()
+
+    # 读取 .conf 文件
+    config.read('./config.conf')
+    earliest_time_limit=config['settings']['earliest_time_limit']                                   # 交易日期的最早时限，该日前的交易数据，不会被纳入选择
+    cond1_and_cond3=config['settings']['cond1_and_cond3']                                           # 条件1和条件3的配置项。
+    cond2=config['settings']['cond2']                                                               # 条件2：前N个交易日内有涨幅（大于等于5%）的K线
+    apply_cond2_or_not=config['settings']['apply_cond2_or_not']                                     # 是否启用条件2：yes, 启用; no: 不启用。
+    apply_cond5_or_not=config['settings']['apply_cond5_or_not']                                     # 是否启用条件5：yes, 启用; no: 不启用。
+    # history_trading_days=config['settings']['history_trading_days']                               # 条件1：历史交易日选择范围。40: 40个交易日，60: 60个交易日，80: 80个交易日
+    # main_board_amplitude_threshold=config['settings']['main_board_amplitude_threshold']           # 条件3：主板振幅。25: 25%, 30: 30%, 35: 35%
+    # non_main_board_amplitude_threshold=config['settings']['non_main_board_amplitude_threshold']   # 条件3：创业板和科创板主板振幅。35: 35%， 40: 40%。
+    history_trading_days=cond1_and_cond3.split('_')[0]
+    main_board_amplitude_threshold=cond1_and_cond3.split('_')[1]
+    non_main_board_amplitude_threshold=cond1_and_cond3.split('_')[2]
+    max_market_capitalization=config['settings']['max_market_capitalization']                       # 最大流通市值，单位亿。
+    min_market_capitalization=config['settings']['min_market_capitalization']                       # 最小流通市值，单位亿。
+    net_profit_growth_rate=config['settings']['net_profit_growth_rate']                             # 净利润增长率。-20: -20%。
+    total_revenue_growth_rate=config['settings']['total_revenue_growth_rate']                       # 营业总收入增长率。-20: -20%。
+    use_cond_1_1_or_cond_1_2=config['settings']['use_cond_1_1_or_cond_1_2']                         # 使用条件1.1还是1.2进行筛选：1.1，使用条件1.1; 1.2, 使用条件1.2。
+    range_days_of_cond_1_2=config['settings']['range_days_of_cond_1_2']                             # 使用条件1.2时，其后N个交易日设定值
+    finance_lookup_date=config['settings'].get('finance_lookup_date', 'report_date')                # 条件5取哪一期财报：report_date, 报告期已结束的最近一期; publish_date, 交易日前已发布的最近一期（避免未来数据）
+    if finance_lookup_date not in ('report_date', 'publish_date'):
+        raise ValueError(f"finance_lookup_date 只能是 report_date 或 publish_date, 当前为: {finance_lookup_date}")
+
+    screen_engine=config['settings'].get('screen_engine', 'duckdb')                                 # 窗口计算引擎：duckdb, SQL 窗口函数; numpy, 读入数组后用滑动窗口计算
+    if screen_engine not in ('duckdb', 'numpy'):
+        raise ValueError(f"screen_engine 只能是 duckdb 或 numpy, 当前为: {screen_engine}")
+
+    # 结果文件格式：csv, 带 BOM 的 csv; parquet, Parquet 文件; 多个用逗号分隔
+    result_formats=[result_format.strip() for result_format in config['settings'].get('result_formats', 'csv').split(',') if result_format.strip()]
+    if not result_formats or any(result_format not in RESULT_FORMATS for result_format in result_formats):
+        raise ValueError(f"result_formats 只能是 {', '.join(RESULT_FORMATS)} 中的一个或多个, 当前为: {config['settings'].get('result_formats')}")
+
+    sweep=config['settings'].get('sweep', '').strip()                                               # 参数扫描：多组 N_主板振幅_创业板科创板振幅_条件2涨幅，逗号分隔；为空时只按 cond1_and_cond3 和 cond2 筛选
+    if sweep:
+        combinations = parse_sweep_combinations(sweep)
+    else:
+        combinations = [(history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2)]
+
+    # Connect to DuckDB database file
+    # Ensure 'stock_data.duckdb' exists and contains data,
+    # or uncomment the data generation part below for testing.
+    # 数据源由 config.conf 中的 data_source 决定：duckdb 数据库文件，或导出的 Parquet 数据集
+    con = connect_analysis_db(config)
+    profile = new_query_profile(profile_path)
+    enable_query_profiling(con, profile)
+            
+    # 查询库中的数据条数
+    result = con.execute("SELECT COUNT(*) FROM stock_data;").fetchone()
+    print(f"数据库中有{result[0]}条记录。")
+
+    # 该连接上已创建的筛选宏
+    created_macros = {}
+    earliest_date = datetime.strptime(earliest_time_limit, '%Y-%m-%d %H:%M:%S').date()
+
+    screen_parameters_list = [build_screen_parameters(config['settings'], earliest_date, combination) for combination in combinations]
+    screen_keys = [
+        screen_key(combination[0], screen_parameters, finance_lookup_date)
+        for combination, screen_parameters in zip(combinations, screen_parameters_list)
+    ]
+    history_trading_days_list = list(dict.fromkeys(combination[0] for combination in combinations))
+
+    incremental = as_of is not None or since_last_run
+    # seed: screen_state 中的记录不完整，增量筛选先从 earliest_time_limit 起完整筛选并记录，再只输出新交易日的结果
+    seed = False
+    if as_of is not None:
+        check_as_of(con, as_of, earliest_date)
+    if incremental:
+        # 各参数组合的筛选结果记录在 screen_state.duckdb 中，增量筛选据此确定新交易日并处理条件1.1、1.2；
+        # 完整筛选不打开它，多个完整筛选可以同时运行，工作目录也不需要可写
+        attach_screen_state(con)
+        screen_dates = incremental_screen_dates(con, screen_keys, earliest_date, as_of)
+        if screen_dates is None:
+            print("\n没有新的交易日需要筛选.")
+            write_profile_report(profile, script='stock_chooser_duckdb.py', as_of=as_of,
+                                 since_last_run=since_last_run, screen_engine=screen_engine, combinations=combinations)
+            con.close()
+            return {}
+        first_screen_date, last_screen_date = screen_dates
+        print(f"\n增量筛选交易日: {first_screen_date} ~ {last_screen_date}")
+        seed = bool(uncovered_screen_keys(con, screen_keys, earliest_date, first_screen_date))
+        if seed:
+            print(f"screen_state.duckdb 中没有 {earliest_date} 起连续的筛选记录，条件1.1、1.2需要之前的筛选结果，先从 {earliest_date} 起完整筛选并记录.")
+    else:
+        first_screen_date = earliest_date
+        last_screen_date = con.execute("SELECT MAX(trade_date) FROM trading_calendar").fetchone()[0]
+    # 窗口计算和条件0~5的筛选从 screen_from_date 起；补齐记录时与完整筛选相同
+    screen_from_date = earliest_date if seed else first_screen_date
+
+    # 完整筛选时，各参数组合条件0~5的筛选结果按参数和数据版本缓存在 result_cache 中（见 config.conf 的 [cache]），
+    # 全部命中时不再做窗口计算；增量筛选只计算新交易日，开启性能分析时要实际执行查询，都不使用缓存
+    cache = open_result_cache(config, con) if not incremental and profile is None else None
+    hits_entries = {
+        key: cache_entry(cache, 'screen_hits', {
+            'screen_key': key,
+            'screen_parameters': screen_parameters,
+            'screen_sql': breakout_screen_sql(combination[0], finance_lookup_date),
+            'first_screen_date': first_screen_date,
+            'last_screen_date': last_screen_date,
+        }, 'parquet')
+        for combination, screen_parameters, key in zip(combinations, screen_parameters_list, screen_keys)
+    }
+    cached_keys = {key for key, entry in hits_entries.items() if lookup_entry(entry)}
+    history_trading_days_list = list(dict.fromkeys(
+        combination[0] for combination, key in zip(combinations, screen_keys) if key not in cached_keys
+    ))
+
+    print("\n执行筛选...")
+    start_time = time.time()
+    if incremental and not seed:
+        create_incremental_bars(con, config, earliest_date, first_screen_date, last_screen_date,
+                                max(int(history_trading_days) for history_trading_days in history_trading_days_list))
+        record_profile_phase(profile, 'sql:incremental_bars', start_time)
+    if history_trading_days_list:
+        windows_start_time = time.time()
+        # 所有参数组合共用一次窗口计算，候选记录存入临时表 breakout_candidates
+        create_breakout_candidates(con, created_macros, config, screen_engine, earliest_date, screen_from_date,
+                                   history_trading_days_list, incremental and not seed)
+        # numpy 引擎最后一条查询是把窗口列和明细列拼成 breakout_candidates，各 CTE 的耗时只对 duckdb 引擎有意义
+        record_profile_phase(profile, f"{'sql' if screen_engine == 'duckdb' else 'numpy'}:breakout_windows", windows_start_time,
+                             [last_query_profile(profile, 'breakout_windows', WINDOWS_CTE_MARKERS if screen_engine == 'duckdb' else {})])
+        end_time = time.time()
+        print(f"窗口计算（{len(combinations) - len(cached_keys)} 组参数, {screen_engine} 引擎）于: {end_time - start_time:.2f}秒内完成.")
+    else:
+        print("全部参数组合的筛选结果都已缓存，跳过窗口计算.")
+
+    increments = {}
+    for combination, screen_parameters, key in zip(combinations, screen_parameters_list, screen_keys):
+        history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2 = combination
+        if sweep:
+            print(f"\n========== 参数组合: {history_trading_days}_{main_board_amplitude_threshold}_{non_main_board_amplitude_threshold}_{cond2} ==========")
+        increments[combination] = screen_combination(
+            con, created_macros, combination, screen_parameters, finance_lookup_date,
+            apply_cond2_or_not, apply_cond5_or_not, use_cond_1_1_or_cond_1_2, range_days_of_cond_1_2, sweep,
+            key, first_screen_date, last_screen_date, incremental, result_formats, profile,
+            hits_entries[key], key in cached_keys, seed, screen_from_date
+        )
+    if incremental:
+        phase_start_time = time.time()
+        record_screen_checksums(con, screen_keys)
+        record_profile_phase(profile, 'sql:screen_checksums', phase_start_time)
+
+    write_profile_report(profile, script='stock_chooser_duckdb.py', as_of=as_of,
+                         since_last_run=since_last_run, screen_engine=screen_engine, combinations=combinations)
+    # Close the database connection
+    con.close()
+    return increments
+
+# 按一组参数从 breakout_candidates 中筛选满足条件0~5的记录，存入临时表 table_name（宏已按 股票代码、交易日期 排序）。
+# 每个 N 一个筛选宏，阈值和日期以参数绑定
+def create_screen_table(con, created_macros, history_trading_days, finance_lookup_date, screen_parameters, table_name):
+    screen_macro = ensure_macro(con, created_macros, f"breakout_screen_n{history_trading_days}_{finance_lookup_date}",
+                                SCREEN_PARAMETERS, breakout_screen_sql(history_trading_days, finance_lookup_date))
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {table_name} AS SELECT * FROM {screen_macro}({', '.join('$' + name for name in SCREEN_PARAMETERS)})",
+                screen_parameters)
+
+# apply_cond_1_1_or_cond_1_2 之后输出的筛选结果：保留的记录中 first_screen_date 及之后的部分
+SCREEN_OUTPUT_SQL = """
+    SELECT * EXCLUDE (交易日序号)
+    FROM screen_results
+    WHERE rowid IN (SELECT 记录号 FROM kept_screen_rows)
+    AND 交易日期 >= $first_screen_date
+    ORDER BY 股票代码, 交易日期
+"""
+
+# 按一组参数从 breakout_candidates 中筛选记录，处理后导出到结果文件；增量筛选时返回新交易日的筛选结果，完整筛选返回 None。
+# hits_entry 为该组参数条件0~5筛选结果的缓存项：hits_cached 为 True 时直接读取，否则筛选后写入（为 None 时不使用缓存）。
+# seed 为 True 时 breakout_candidates 从 screen_from_date（earliest_time_limit）起，全部筛选结果写入 screen_state 后只输出新交易日的部分
+def screen_combination(con, created_macros, combination, screen_parameters, finance_lookup_date,
+                       apply_cond2_or_not, apply_cond5_or_not, use_cond_1_1_or_cond_1_2, range_days_of_cond_1_2, sweep,
+                       key, first_screen_date, last_screen_date, incremental, result_formats, profile=None,
+                       hits_entry=None, hits_cached=False, seed=False, screen_from_date=None):
+    history_trading_days, main_board_amplitude_threshold, non_main_board_amplitude_threshold, cond2 = combination
+
+    # 查询计划及各 CTE 的耗时见 --profile 生成的报告
+    combination_tag = '_'.join(combination)
+    start_time = time.time()
+    phase_start_time = start_time
+    # 结果保留在 DuckDB 临时表中（宏已按 股票代码、交易日期 排序），不再整体读入 pandas 再排序
+    screen_table = 'screen_increment' if incremental and not seed else 'screen_results'
+    # 增量筛选时记录新交易日条件0~5的筛选结果，再加上这些股票之前的筛选结果，一起做条件1.1、1.2的处理；
+    # 完整筛选不读写 screen_state
+    if hits_cached:
+        # Parquet 保留列类型和行的顺序，读回的表与筛选得到的相同
+        con.execute(f"CREATE OR REPLACE TEMP TABLE {screen_table} AS SELECT * FROM read_parquet('{hits_entry['path']}')")
+    else:
+        create_screen_table(con, created_macros, history_trading_days, finance_lookup_date, screen_parameters, screen_table)
+        if hits_entry is not None:
+            con.execute(f"COPY {screen_table} TO '{hits_entry['writing_path']}' (FORMAT parquet, COMPRESSION zstd)")
+            store_entry(hits_entry)
+    record_profile_phase(profile, f"sql:screen[{combination_tag}]", phase_start_time,
+                         [last_query_profile(profile, f"breakout_screen_n{history_trading_days}", SCREEN_CTE_MARKERS)])
+    if incremental:
+        phase_start_time = time.time()
+        if seed:
+            # 从 earliest_time_limit 起的候选记录一直到最新交易日，增量筛选只到 last_screen_date
+            con.execute(f"DELETE FROM {screen_table} WHERE 交易日期 > $last_screen_date", {'last_screen_date': last_screen_date})
+            record_screen_hits(con, key, screen_table, screen_from_date, last_screen_date, covered_from=screen_from_date)
+        else:
+            record_screen_hits(con, key, screen_table, first_screen_date, last_screen_date)
+            load_screen_hits(con, key, last_screen_date)
+        record_profile_phase(profile, f"sql:screen_state[{combination_tag}]", phase_start_time)
+
+    phase_start_time = time.time()
+    apply_cond_1_1_or_cond_1_2(con, use_cond_1_1_or_cond_1_2, range_days_of_cond_1_2)
+    output_sql = SCREEN_OUTPUT_SQL
+    # 增量筛选只输出新交易日的筛选结果
+    output_parameters = {'first_screen_date': first_screen_date}
+    num_results = con.execute(f"SELECT COUNT(*) FROM ({output_sql})", output_parameters).fetchone()[0]
 
     end_time = time.time()
     print(f"筛选于: {end_time - start_time:.2f}秒内完成.")
 
-    if not results_df.empty:
-        num_results = len(results_df)
+    # 增量筛选的结果只有新交易日的记录，读入 DataFrame 返回；完整筛选的结果可能有数百万条，只写入结果文件
+    results_df = con.execute(output_sql, output_parameters).fetchdf() if incremental else None
+    record_profile_phase(profile, f"post_filter[{combination_tag}]", phase_start_time)
+    phase_start_time = time.time()
+    if num_results > 0:
         print(f"\n筛选到 {num_results} 条股票及交易日期数据:")
         # # 如果筛选到的记录数小于50，则直接打印
         # print(results_df.head(50).to_string())
         # new_df = results_df[results_df['股票名称'] == '招商南油'].copy()
         # print(new_df.to_string())
+        if incremental and num_results <= 50:
+            print(results_df.to_string())
         if num_results > 50:
             # 否则导入到查询结果文件choose_result.csv文件中
             print("...")
-            # Export to CSV with UTF-8 BOM encoding
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            # 参数扫描时各组的条件2涨幅可能不同，文件名中带上涨幅
+            cond2_tag = f"{apply_cond2_or_not}_cond2_{cond2}" if sweep else f"{apply_cond2_or_not}_cond2"
             if use_cond_1_1_or_cond_1_2 == '1.2':
-                filter_conditions = f"{history_trading_days}days_{main_board_amplitude_threshold}per_{non_main_board_amplitude_threshold}per_{apply_cond2_or_not}_cond2_cond1.2_{range_days_of_cond_1_2}days_{apply_cond5_or_not}_cond5"
+                filter_conditions = f"{history_trading_days}days_{main_board_amplitude_threshold}per_{non_main_board_amplitude_threshold}per_{cond2_tag}_cond1.2_{range_days_of_cond_1_2}days_{apply_cond5_or_not}_cond5"
             else:
-                filter_conditions = f"{history_trading_days}days_{main_board_amplitude_threshold}per_{non_main_board_amplitude_threshold}per_{apply_cond2_or_not}_cond2_{apply_cond5_or_not}_cond5"
-            output_filename = f"stock_query_results_{timestamp}_cond{use_cond_1_1_or_cond_1_2}_{filter_conditions}.csv"
+                filter_conditions = f"{history_trading_days}days_{main_board_amplitude_threshold}per_{non_main_board_amplitude_threshold}per_{cond2_tag}_{apply_cond5_or_not}_cond5"
+            if incremental:
+                filter_conditions += f"_as_of_{last_screen_date.strftime('%Y%m%d')}"
+            output_basename = f"stock_query_results_{timestamp}_cond{use_cond_1_1_or_cond_1_2}_{filter_conditions}"
             try:
-                results_df.to_csv(output_filename, index=False, encoding='utf-8-sig')
-                print(f"筛选结果 (共 {num_results} 条记录) 已导出到文件 {output_filename}.")
+                output_filenames = export_screen_results(con, output_sql, output_parameters, output_basename, result_formats)
+                print(f"筛选结果 (共 {num_results} 条记录) 已导出到文件 {', '.join(output_filenames)}.")
             except Exception as e:
                 print(f"导出到文件失败，原因: {e}")
         print(f"总记录数: {num_results} 条.")
     else:
         print("\n没有找到符合条件的股票及期交易日期数据.")
+    record_profile_phase(profile, f"export[{combination_tag}]", phase_start_time)
+    con.unregister('kept_screen_rows')
+    return results_df
 
-    # Close the database connection
+# 在完整数据上分别用 duckdb 和 numpy 引擎计算窗口指标，比较两者的候选记录是否一致，并输出各自耗时（取 repeat 次中最快的一次）
+def benchmark_screen_engines(repeat=2):
+    config = configparser.ConfigParser()
+    config.read('./config.conf')
+    earliest_date = datetime.strptime(config['settings']['earliest_time_limit'], '%Y-%m-%d %H:%M:%S').date()
+    sweep = config['settings'].get('sweep', '').strip()
+    if sweep:
+        history_trading_days_list = list(dict.fromkeys(combination[0] for combination in parse_sweep_combinations(sweep)))
+    else:
+        history_trading_days_list = [config['settings']['cond1_and_cond3'].split('_')[0]]
+
+    con = connect_analysis_db(config)
+    created_macros = {}
+    timings = {}
+    for screen_engine in ['duckdb', 'numpy']:
+        for _ in range(repeat):
+            start_time = time.time()
+            create_breakout_candidates(con, created_macros, config, screen_engine, earliest_date, earliest_date,
+                                       history_trading_days_list, False, f"breakout_candidates_{screen_engine}")
+            elapsed = time.time() - start_time
+            timings[screen_engine] = min(timings.get(screen_engine, elapsed), elapsed)
+
+    # rn <= N 的记录不参与该 N 的筛选，只比较 rn > N 的窗口列
+    mismatch_conditions = [
+        f"a.{column} IS DISTINCT FROM b.{column}"
+        for column in ['rn', 'stock_name', 'adj_close_price', 'industry_level1', 'industry_level2', 'industry_level3',
+                       'market_cap_of_100_million', 'total_market_cap_of_100_million']
+    ]
+    for history_trading_days in history_trading_days_list:
+        window_mismatches = " OR ".join(
+            f"a.{column}_{history_trading_days}_days IS DISTINCT FROM b.{column}_{history_trading_days}_days"
+            for column in ['max_close', 'max_high', 'min_low', 'open_price_of_first_day_of', 'max_gain']
+        )
+        mismatch_conditions.append(f"(a.rn > {history_trading_days} AND ({window_mismatches}))")
+    candidate_rows, mismatched_rows = con.execute(f"""
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE a.stock_code IS NULL OR b.stock_code IS NULL OR {' OR '.join(mismatch_conditions)})
+        FROM breakout_candidates_duckdb a
+        FULL JOIN breakout_candidates_numpy b ON a.stock_code = b.stock_code AND a.trade_date = b.trade_date
+    """).fetchone()
     con.close()
 
+    print("\n---------- 窗口计算引擎对比 ----------")
+    print(f"N: {', '.join(history_trading_days_list)}，候选记录 {candidate_rows} 条，不一致 {mismatched_rows} 条")
+    for screen_engine, elapsed in timings.items():
+        print(f"{screen_engine:>6} 引擎: {elapsed:.2f}秒")
+    print(f"numpy 引擎加速: {timings['duckdb'] / max(timings['numpy'], 1e-9):.1f}x")
+    print("--------------------------------------")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="按 config.conf 中的条件筛选突破的股票。")
+    incremental_group = parser.add_mutually_exclusive_group()
+    incremental_group.add_argument('--as-of', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                                   help="增量筛选：只筛选该交易日(YYYY-MM-DD)，结果追加到 screen_state.duckdb。")
+    incremental_group.add_argument('--since-last-run', action='store_true',
+                                   help="增量筛选：只筛选上次筛选之后的新交易日，结果追加到 screen_state.duckdb。")
+    parser.add_argument('--benchmark-engines', action='store_true',
+                        help="在完整数据上对比 duckdb 和 numpy 窗口计算引擎的结果和耗时，不输出筛选结果。")
+    parser.add_argument('--profile', nargs='?', const=f"profile_stock_chooser_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        help="开启 DuckDB 性能分析，把 SQL、后处理、导出各阶段及各 CTE 的耗时写入 JSON 报告（默认 profile_stock_chooser_时间戳.json）。")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    # Call the function to run the optimization and query
-    optimize_and_query_stock_data_duckdb()
+    args = parse_args()
+    if args.benchmark_engines:
+        benchmark_screen_engines()
+    else:
+        # Call the function to run the optimization and query
+        optimize_and_query_stock_data_duckdb(as_of=args.as_of, since_last_run=args.since_last_run, profile_path=args.profile)
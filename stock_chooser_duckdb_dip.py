@@ -5,6 +5,10 @@ from datetime import datetime, timedelta
 import time # Import time module for timing
 from typing import List, Dict, Union
 import configparser
+import argparse
+from stock_db_utils import (connect_analysis_db, enable_query_profiling, last_query_profile, new_query_profile,
+                            partition_predicate, record_profile_phase, write_profile_report)
+from result_cache import cached_frame, frame_fingerprint, open_result_cache
 
 # 定义时间窗口和回踩条件
 HISTORY_DAYS = 40  # 支撑价向前看的天数
@@ -12,6 +16,16 @@ FUTURE_DAYS = 40   # 回踩日向后看的天数
 VOLATILITY_LIMIT = 0.05  # 回踩日波动性限制（C条件）
 SUPPORT_PRICE_TOLERANCE = 0.995 # 回踩日最低价要包含支持价的比例（A条件）
 
+# --profile 时把各算子的耗时归到查询中命名的 CTE（DuckDB 会内联 CTE，按算子名称和 extra_info 匹配，取第一个匹配的 CTE）
+NEXT_N_DAYS_CTE_MARKERS = {
+    '输出(排序)': [r'ORDER_BY', r'adj_support_price'],
+    'LimitedRangeStockData': [r'DELIM', r'RIGHT_SEMI', r'DUMMY_SCAN', r'HASH_GROUP_BY', r'trading_day \+',
+                              r'"Conditions": "trade_date = max_close_n_days_date"', r'trading_calendar'],
+    'FilteredStockData': [r'amplitude_bucket', r'max_close_n_days \* 1\.01', r'rn > \d+'],
+    'StockWindows': [r'^WINDOW', r'SEMI', r'exchange', r'"Table": "security_master"'],
+    'AdjustedStockData': [r'ASOF_JOIN', r'"Table": "(stock_data|corporate_actions)"', r'PARQUET', r'MARK', r'COLUMN_DATA_SCAN'],
+}
+
 # 加载需要做回测运算的xlsx文件
 def load_df_from_excel_file(file_path):
     df = None
@@ -53,17 +67,20 @@ def load_target_df(excel_file_path: str):
     return stock_data_df
 
 # 从库中找出复权计算过的数据。
-def get_next_N_days_data(stock_data_list, max_holding_days):
+# profile 为 new_query_profile 返回的性能分析记录，不为 None 时记录该查询各 CTE 的耗时；
+# con 为已打开的连接（如 screen_service.py 常驻内存的数据）时直接查询、不关闭，config 为 None 时读取 config.conf
+def get_next_N_days_data(stock_data_list, max_holding_days, profile=None, con=None, config=None):
     """
     Connects to DuckDB, creates/ensures stock_data table exists (for testing),
     and queries stocks satisfying specific conditions using DuckDB.
     """
 
-    # 创建 ConfigParser 对象
-    config = configparser.ConfigParser()
+    if config is None:
+        # 创建 ConfigParser 对象
+        config = configparser.ConfigParser()
 
-    # 读取 .conf 文件
-    config.read('./config.conf')
+        # 读取 .conf 文件
+        config.read('./config.conf')
     earliest_time_limit=config['settings']['earliest_time_limit']                                   # 交易日期的最早时限，该日前的交易数据，不会被纳入选择
     cond1_and_cond3=config['settings']['cond1_and_cond3']                                           # 条件1和条件3的配置项。
     cond2=config['settings']['cond2']                                                               # 条件2：前N个交易日内有涨幅（大于等于5%）的K线
@@ -82,12 +99,6 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     use_cond_1_1_or_cond_1_2=config['settings']['use_cond_1_1_or_cond_1_2']                         # 使用条件1.1还是1.2进行筛选：1.1，使用条件1.1; 1.2, 使用条件1.2。
     range_days_of_cond_1_2=config['settings']['range_days_of_cond_1_2']                             # 使用条件1.2时，其后N个交易日设定值
 
-    cond2_sql_where_clause = ''
-    if apply_cond2_or_not == 'yes':
-        cond2_sql_where_clause = 'AND has_gain_5_percent = 1'
-    if apply_cond2_or_not == 'no':
-        cond2_sql_where_clause = '-- AND has_gain_5_percent = 1'
-
     cond5_sql_where_clause = ''
     if apply_cond5_or_not == 'yes':
         cond5_sql_where_clause = f'AND net_profit_yoy >= {net_profit_growth_rate} AND revenue_yoy >= {total_revenue_growth_rate}'
@@ -97,66 +108,41 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     # Connect to DuckDB database file
     # Ensure 'stock_data.duckdb' exists and contains data,
     # or uncomment the data generation part below for testing.
-    con = duckdb.connect(database='stock_data.duckdb', read_only=False)
-    print("连接到数据库: stock_data.duckdb")
+    # 数据源由 config.conf 中的 data_source 决定：duckdb 数据库文件，或导出的 Parquet 数据集
+    close_connection = con is None
+    if close_connection:
+        con = connect_analysis_db(config)
+    enable_query_profiling(con, profile)
     
-    stock_code_list = ", ".join(f"'{item['stock_code']}'" for item in stock_data_list)
+    stock_codes = [item['stock_code'] for item in stock_data_list]
     days_limit = 41 if max_holding_days is None else (int(max_holding_days) + 1)
 
+    # 配置值以参数绑定，不再拼接进 SQL；N 是 ROWS BETWEEN 中的常量，仍写在 SQL 里
+    query_parameters = {
+        'earliest_time_limit': datetime.strptime(earliest_time_limit, '%Y-%m-%d %H:%M:%S').date(),
+        'main_board_amplitude_threshold': float(main_board_amplitude_threshold),
+        'non_main_board_amplitude_threshold': float(non_main_board_amplitude_threshold),
+        'cond2': float(cond2),
+        'apply_cond2_or_not': apply_cond2_or_not,
+        'min_market_capitalization': float(min_market_capitalization),
+        'max_market_capitalization': float(max_market_capitalization),
+        'days_limit': days_limit,
+    }
+    # 每支股票一个参数：IN 列表的每一项仍是常量，DuckDB 能按 stock_code 跳过无关的数据块（绑定整个列表则不能）
+    stock_code_parameters = {f"stock_code_{i}": stock_code for i, stock_code in enumerate(stock_codes)}
+    query_parameters.update(stock_code_parameters)
+
     # Main Query SQL (optimized for DuckDB)
     # The SQL is mostly the same as DuckDB handles window functions efficiently.
     query_sql = f"""
     -- 📝 计算符合条件的股票交易日窗口
-    WITH DeduplicatedStockData AS (
-        -- ✅ 去掉 stock_data 中完全重复的行
-        SELECT DISTINCT stock_code, stock_name, trade_date, open_price, close_price, high_price, low_price, prev_close_price, market_cap, total_market_cap, industry_level1, industry_level2, industry_level3 
-        FROM stock_data
-        -- 🔧 限定 stock_code 范围，只查询给定股票列表
-        WHERE stock_code IN (
-            -- ⚠️ 这里的 stock_code_list 可以是 Python 格式 ['AAPL','TSM'] 转换成 SQL 字符串 'AAPL','TSM'
-            {stock_code_list}
-        )
-    ),
-    StockWithRiseFall AS (
-        -- ✅ 计算复权涨跌幅，公式: 复权涨跌幅 = 收盘价 / 前收盘价 - 1
-        SELECT *,
-            (close_price / NULLIF(prev_close_price, 0)) - 1 AS rise_fall
-        FROM DeduplicatedStockData
-    ),
-    AdjustmentFactorComputed AS (
-        -- ✅ 计算复权因子, 公式: 复权因子 = (1 + 复权涨跌幅).cumprod()
-        SELECT *,
-            EXP(SUM(LN(1 + rise_fall)) OVER (PARTITION BY stock_code ORDER BY trade_date)) AS adjustment_factor
-        FROM StockWithRiseFall
-    ),
-    LastRecordComputed AS (
-        -- ✅ 获取每个 stock_code 的最后一条记录的收盘价和复权因子
-        SELECT 
-            t.stock_code,
-            t.close_price AS last_close_price,
-            t.adjustment_factor AS last_adjustment_factor
-        FROM (
-            SELECT 
-                stock_code,
-                close_price,
-                adjustment_factor,
-                ROW_NUMBER() OVER (PARTITION BY stock_code ORDER BY trade_date DESC) AS rn
-            FROM AdjustmentFactorComputed
-        ) t
-        WHERE t.rn = 1
-    ),
-    AdjustedStockData AS (
-        SELECT 
-            a.*,
-            -- ✅ 计算前复权收盘价, 公式: 前复权收盘价 = 复权因子 * (最后一条数据的收盘价 / 最后一条数据的复权因子)
-            a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0)) AS adj_close_price,
-            -- ✅ 前复权其他价格
-            (a.open_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_open_price,
-            (a.high_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_high_price,
-            (a.low_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_low_price,
-            (a.prev_close_price / NULLIF(a.close_price, 0)) * (a.adjustment_factor * (l.last_close_price / NULLIF(l.last_adjustment_factor, 0))) AS adj_prev_close_price
-        FROM AdjustmentFactorComputed a
-        LEFT JOIN LastRecordComputed l ON a.stock_code = l.stock_code
+    WITH AdjustedStockData AS (
+        -- ✅ 前复权价格来自共享视图 adjusted_stock_data：导入程序把除权除息日写入 corporate_actions 表，
+        --    前复权价格 = 价格 * 该日之后所有除权事件复权因子的乘积（ASOF 连接），无需逐行计算 EXP(SUM(LN()))
+        SELECT * FROM adjusted_stock_data
+        -- 🔧 限定 stock_code 范围，只查询给定股票列表；使用 Parquet 数据集时按板块和年份分区裁剪
+        WHERE {partition_predicate(config, earliest_time_limit, stock_codes)}
+        AND stock_code IN ({', '.join('$' + name for name in stock_code_parameters)})
     ),
     StockWindows AS (
         SELECT
@@ -210,7 +196,7 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
             ) AS open_price_of_first_day_of_n_days,
             -- ✅ N个交易日内是否存在单日涨幅 ≥ 5%
             MAX(CASE
-                WHEN (t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0) >= {cond2} THEN 1
+                WHEN (t.adj_close_price - t.adj_prev_close_price) / NULLIF(t.adj_prev_close_price, 0) >= $cond2 THEN 1
                 ELSE 0
             END) OVER (
                 PARTITION BY t.stock_code
@@ -225,10 +211,10 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
         FROM
             AdjustedStockData t
         WHERE
-            -- ✅ 排除北交所股票
-            t.stock_code NOT LIKE 'bj%' AND
+            -- ✅ 排除北交所股票（security_master 中 exchange = 'bj'）
+            t.stock_code IN (SELECT stock_code FROM security_master WHERE exchange <> 'bj') AND
             -- ✅ 排除2022年1月1号之前的交易数据
-            t.trade_date >= '{earliest_time_limit}'
+            t.trade_date >= $earliest_time_limit
     ),
     FilteredStockData AS (
         SELECT
@@ -248,44 +234,46 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
             sw.industry_level3
         FROM
             StockWindows AS sw
+        -- ✅ 条件3的振幅阈值按 security_master 中的板块分类
+        JOIN security_master sm ON sm.stock_code = sw.stock_code
         WHERE
             -- 📌 条件0：窗口内至少有N个交易日数据
             sw.rn > {history_trading_days}
             -- 📌 条件1：当日收盘价大于前N个交易日的最高收盘价的101%
             AND sw.adj_close_price > (sw.max_close_n_days * 1.01)
             -- 📌 条件2：前N个交易日内有涨幅（大于等于5%）的K线
-            {cond2_sql_where_clause}
+            AND ($apply_cond2_or_not <> 'yes' OR sw.has_gain_5_percent = 1)
             -- 📌 条件3：前N个交易日的股票价格振幅度，上证和深证股票小于等于25%(30%, 35%)，创业板和科创板股票小于等于35%(40%, 40%)
             AND (
-                -- ✅ 根据股票代码板块（前缀）确定振幅阈值
                 CASE
                     WHEN sw.open_price_of_first_day_of_n_days > 0
                     THEN (sw.max_high_n_days - sw.min_low_n_days) * 1.0 / sw.open_price_of_first_day_of_n_days * 100
                     ELSE 999999 -- 避免除零错误
                 END
             ) <= (
-                CASE
-                    -- ✅ 创业板（以300，301，302开头）或科创板（以688开头），小于等于35%(40%, 40%)
-                    WHEN sw.stock_code LIKE 'sz300%' OR sw.stock_code LIKE 'sz301%' OR sw.stock_code LIKE 'sz302%' OR sw.stock_code LIKE 'sh688%' THEN {non_main_board_amplitude_threshold}
-                    -- ✅ 上证主板（以600，601，603，605开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sh600%' OR sw.stock_code LIKE 'sh601%' OR sw.stock_code LIKE 'sh603%' OR sw.stock_code LIKE 'sh605%' THEN {main_board_amplitude_threshold}
-                    -- ✅ 深证主板（以000，001，002，003开头）小于等于25%(30%, 35%)
-                    WHEN sw.stock_code LIKE 'sz000%' OR sw.stock_code LIKE 'sz001%' OR sw.stock_code LIKE 'sz002%' OR sw.stock_code LIKE 'sz003%' THEN {main_board_amplitude_threshold}
+                CASE sm.amplitude_bucket
+                    -- ✅ 创业板（300，301，302）和科创板（688），小于等于35%(40%, 40%)
+                    WHEN 'growth' THEN $non_main_board_amplitude_threshold
+                    -- ✅ 上证主板（600，601，603，605）和深证主板（000，001，002，003），小于等于25%(30%, 35%)
+                    WHEN 'main' THEN $main_board_amplitude_threshold
                     ELSE 1000
                 END
             )
             -- 📌 条件4：流通市值在30亿至500亿之间
-            AND sw.market_cap_of_100_million BETWEEN {min_market_capitalization} AND {max_market_capitalization}
+            AND sw.market_cap_of_100_million BETWEEN $min_market_capitalization AND $max_market_capitalization
     ),
     LimitedRangeStockData AS (
-        -- 🔧 限定范围：每支股票从其 max_close_n_days_date 起，往后取 {days_limit} 个交易日数据
-        SELECT *
+        -- 🔧 限定范围：每支股票从其 max_close_n_days_date 起，往后取 days_limit 个交易日数据
+        --    按 trading_calendar 中的交易日序号比较（N 个交易日后 = 序号 + N，节假日不计入），而不是 DATE_ADD 的自然日
+        SELECT w.*
         FROM StockWindows w
+        JOIN trading_calendar wc ON wc.trade_date = w.trade_date
         WHERE EXISTS (
             SELECT 1
             FROM FilteredStockData f
+            JOIN trading_calendar fc ON fc.trade_date = f.max_close_n_days_date
             WHERE f.stock_code = w.stock_code
-            AND w.trade_date BETWEEN f.max_close_n_days_date AND DATE_ADD(f.max_close_n_days_date, INTERVAL {days_limit} DAY)
+            AND wc.trading_day BETWEEN fc.trading_day AND fc.trading_day + $days_limit
         )
     )
     -- ✅ 最终输出
@@ -306,10 +294,18 @@ def get_next_N_days_data(stock_data_list, max_holding_days):
     """
     
     # 获取查询结果
-    results_df = con.execute(query_sql).fetchdf()
+    # 查询结果按 SQL、参数和数据版本缓存在 result_cache 中（见 config.conf 的 [cache]）；
+    # 开启性能分析，或由调用方提供连接（常驻服务，数据已在内存中）时不使用缓存
+    cache = open_result_cache(config, con) if close_connection and profile is None else None
+    start_time = time.time()
+    results_df = cached_frame(cache, 'next_n_days_data', {'sql': query_sql, 'parameters': query_parameters},
+                              lambda: con.execute(query_sql, query_parameters).fetchdf())
+    record_profile_phase(profile, 'sql:next_n_days_data', start_time,
+                         [last_query_profile(profile, 'next_n_days_data', NEXT_N_DAYS_CTE_MARKERS)])
     
     # 关闭连接
-    con.close()
+    if close_connection:
+        con.close()
 
     #返回查询结果
     return results_df
@@ -329,6 +325,11 @@ def find_support_and_dip_dates(
     
     # 确保 trade_date 是日期类型
     limited_adjusted_df['trade_date'] = pd.to_datetime(limited_adjusted_df['trade_date'])
+    # 按股票一次拆分并按交易日期排序，每个目标按代码直接取出，不再对整张表做布尔筛选
+    stock_frames = {
+        code: stock_group.sort_values('trade_date').reset_index(drop=True)
+        for code, stock_group in limited_adjusted_df.groupby('stock_code', sort=False)
+    }
 
     for target in targets:
         stock_code = target['stock_code']
@@ -342,7 +343,9 @@ def find_support_and_dip_dates(
             continue
 
         # 1. 筛选目标股票数据
-        stock_df = limited_adjusted_df[limited_adjusted_df['stock_code'] == stock_code].sort_values('trade_date').reset_index(drop=True)
+        stock_df = stock_frames.get(stock_code)
+        if stock_df is None:
+            continue
         
         # 2. 确定突破日和支撑价
         breakthrough_row = stock_df[stock_df['trade_date'] == breakthrough_date_dt]
@@ -425,7 +428,15 @@ def find_support_and_dip_dates(
     return pd.DataFrame(results)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="在 Table.xlsx 中的突破股票里查找支撑价和回踩日。")
+    parser.add_argument('--profile', nargs='?', const=f"profile_dip_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        help="开启 DuckDB 性能分析，把查询、回踩查找、导出各阶段及各 CTE 的耗时写入 JSON 报告（默认 profile_dip_时间戳.json）。")
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
+    profile = new_query_profile(args.profile)
     # 获取数据
     target_df = load_target_df("Table.xlsx")
     target_df['breakthrough_date'] = pd.to_datetime(target_df['breakthrough_date'])
@@ -436,10 +447,22 @@ if __name__ == '__main__':
 
     # 2. 计算前复权数据
     MAX_HOLDING_DAYS = 40
-    limited_df = get_next_N_days_data(stock_data_list, MAX_HOLDING_DAYS)
+    config = configparser.ConfigParser()
+    config.read('./config.conf')
+    limited_df = get_next_N_days_data(stock_data_list, MAX_HOLDING_DAYS, profile, config=config)
 
     # 3. 查找支撑价和回踩日
-    final_results = find_support_and_dip_dates(limited_df, stock_data_list)
+    phase_start_time = time.time()
+    # 回踩查找的结果按输入K线的内容、目标和回踩条件缓存；开启性能分析时不使用缓存
+    cache = open_result_cache(config) if profile is None else None
+    dip_parameters = {
+        'next_n_days_data': frame_fingerprint(limited_df),
+        'targets': stock_data_list,
+        'conditions': [HISTORY_DAYS, FUTURE_DAYS, VOLATILITY_LIMIT, SUPPORT_PRICE_TOLERANCE],
+    }
+    final_results = cached_frame(cache, 'dip_results', dip_parameters,
+                                 lambda: find_support_and_dip_dates(limited_df, stock_data_list))
+    record_profile_phase(profile, 'post_filter:support_and_dip_dates', phase_start_time)
     
     # 4. 输出结果
     # print("\n--- 最终结果 ---")
@@ -449,6 +472,7 @@ if __name__ == '__main__':
     print(f"筛选于: {end_time - start_time:.2f}秒内完成.")
 
     # 5. 导出到 Excel 文件
+    phase_start_time = time.time()
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     excel_file_name = f'回踩筛选结果_{timestamp}.xlsx'
     
@@ -468,4 +492,6 @@ if __name__ == '__main__':
         index=False # 不导出 pandas 的行索引
     )
     
-    print(f"\n✅ 结果已成功导出到文件: {excel_file_name}")
\ No newline at end of file
+    print(f"\n✅ 结果已成功导出到文件: {excel_file_name}")
+    record_profile_phase(profile, 'export:excel', phase_start_time)
+    write_profile_report(profile, script='stock_chooser_duckdb_dip.py', targets=len(target_df), max_holding_days=MAX_HOLDING_DAYS)
\ No newline at end of file
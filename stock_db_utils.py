@@ -0,0 +1,566 @@
+import duckdb
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime
+
+MANIFEST_TABLE = 'import_manifest'
+STOCK_DB_PATH = 'stock_data.duckdb'
+# State of the incremental screener, kept apart from stock_data.duckdb
+SCREEN_STATE_DB_PATH = 'screen_state.duckdb'
+
+# Tables the screener, the backtest and the dip finder read besides the daily bars
+ANALYSIS_TABLES = ['trading_calendar', 'security_master', 'stock_finance_hot', 'fundamentals_quarterly']
+# The importer that creates each of the ANALYSIS_TABLES
+ANALYSIS_TABLE_IMPORTERS = {
+    'trading_calendar': 'import_stock_data_to_duckdb.py',
+    'security_master': 'import_stock_data_to_duckdb.py',
+    'stock_finance_hot': 'import_stock_finance_data_to_duckdb.py',
+    'fundamentals_quarterly': 'import_stock_finance_data_to_duckdb.py',
+}
+
+# Board of a stock derived from its code prefix, used as a partition key of the Parquet dataset
+BOARD_SQL = """CASE
+        WHEN stock_code LIKE 'sh688%' OR stock_code LIKE 'sh689%' THEN 'sh688'
+        WHEN stock_code LIKE 'sh60%' THEN 'sh60x'
+        WHEN stock_code LIKE 'sz00%' THEN 'sz00x'
+        WHEN stock_code LIKE 'sz30%' THEN 'sz30x'
+        WHEN stock_code LIKE 'bj%' THEN 'bj'
+        ELSE 'other'
+    END"""
+
+def ensure_manifest_table(con):
+    """
+    Creates the import manifest table if it does not exist.
+    The manifest records every source file that has been imported into a table,
+    so later runs can skip files that have not changed.
+
+    Args:
+        con: An open, writable DuckDB connection.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            table_name VARCHAR,
+            source_path VARCHAR,
+            file_size BIGINT,
+            file_mtime DOUBLE,
+            content_hash VARCHAR,
+            row_count BIGINT,
+            imported_at TIMESTAMP,
+            PRIMARY KEY (table_name, source_path)
+        );
+    """)
+
+def file_content_hash(file_path, chunk_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file without loading it into memory at once.
+
+    Args:
+        file_path (str): The path to the file.
+        chunk_size (int): Number of bytes read per step.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def select_changed_files(con, table_name, file_paths):
+    """
+    Compares source files against the manifest and returns the ones that need importing.
+    Files whose size and mtime match the manifest are skipped without reading them.
+    Files whose size or mtime changed are hashed; if the hash still matches, only the
+    manifest entry is refreshed and the file is skipped.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        table_name (str): The table the files are imported into.
+        file_paths (list): Paths of all candidate source files.
+
+    Returns:
+        list: Dictionaries with source_path, file_size, file_mtime and content_hash
+              for every new or changed file, in the order of file_paths.
+    """
+    ensure_manifest_table(con)
+    known = {
+        row[0]: row[1:]
+        for row in con.execute(
+            f"SELECT source_path, file_size, file_mtime, content_hash FROM {MANIFEST_TABLE} WHERE table_name = ?",
+            [table_name]
+        ).fetchall()
+    }
+
+    changed = []
+    touched = []
+    for file_path in file_paths:
+        source_path = os.path.abspath(file_path)
+        stat = os.stat(source_path)
+        entry = {
+            'source_path': source_path,
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'content_hash': None,
+        }
+        previous = known.get(source_path)
+        if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+            continue
+        entry['content_hash'] = file_content_hash(source_path)
+        if previous is not None and previous[2] == entry['content_hash']:
+            touched.append(entry)
+            continue
+        changed.append(entry)
+
+    for entry in touched:
+        con.execute(
+            f"UPDATE {MANIFEST_TABLE} SET file_size = ?, file_mtime = ? WHERE table_name = ? AND source_path = ?",
+            [entry['file_size'], entry['file_mtime'], table_name, entry['source_path']]
+        )
+
+    print(f"Manifest check for '{table_name}': {len(changed)} new or changed, "
+          f"{len(file_paths) - len(changed)} unchanged ({len(touched)} only touched).")
+    return changed
+
+def record_manifest(con, table_name, entries, row_counts):
+    """
+    Stores the imported files in the manifest, replacing older entries for the same path.
+
+    Args:
+        con: An open, writable DuckDB connection.
+        table_name (str): The table the files were imported into.
+        entries (list): Entries returned by select_changed_files.
+        row_counts (dict): Number of rows loaded per file, keyed by file base name.
+                           Files missing from row_counts are not recorded.
+    """
+    imported_at = datetime.now()
+    for entry in entries:
+        file_name = os.path.basename(entry['source_path'])
+        if file_name not in row_counts:
+            # Nothing was loaded from this file, leave it out so the next run retries it
+            continue
+        con.execute(
+            f"INSERT OR REPLACE INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                table_name,
+                entry['source_path'],
+                entry['file_size'],
+                entry['file_mtime'],
+                entry['content_hash'],
+                row_counts[file_name],
+                imported_at,
+            ]
+        )
+
+def parallel_load(con, table_name, file_paths, parse_func, executor, queue_size=8):
+    """
+    Parses files in a process pool and appends the results to a DuckDB table from a
+    single writer thread, so parsing scales with cores while only one thread ever
+    writes to the database.
+    At most queue_size parsed frames wait for the writer and at most as many files
+    are being parsed at once, which keeps memory bounded on large directories.
+
+    Args:
+        con: An open, writable DuckDB connection. It must not be used by other
+             threads until this function returns.
+        table_name (str): The table the parsed frames are appended to.
+        file_paths (list): Paths of the files to parse.
+        parse_func: A picklable module-level function taking a file path and
+                    returning a typed DataFrame matching table_name, or None to skip the file.
+        executor: A concurrent.futures.ProcessPoolExecutor.
+        queue_size (int): Maximum number of parsed frames waiting for the writer.
+
+    Returns:
+        int: Number of rows appended.
+    """
+    frames = queue.Queue(maxsize=queue_size)
+    writer_state = {'rows': 0}
+
+    def writer():
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            file_path, frame = item
+            try:
+                con.append(table_name, frame)
+                writer_state['rows'] += len(frame)
+            except Exception as e:
+                print(f"Error appending data from {file_path} to DuckDB: {e}")
+
+    writer_thread = threading.Thread(target=writer, name=f"{table_name}_writer")
+    writer_thread.start()
+    try:
+        pending = {}
+        remaining = iter(file_paths)
+        while True:
+            # Keep a bounded number of files in flight in the pool
+            while len(pending) < queue_size:
+                file_path = next(remaining, None)
+                if file_path is None:
+                    break
+                pending[executor.submit(parse_func, file_path)] = file_path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path = pending.pop(future)
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    print(f"Error parsing {file_path}: {e}")
+                    continue
+                if frame is None or frame.empty:
+                    print(f"Skipped {file_path} due to processing issues or no valid data found.")
+                    continue
+                # Blocks while the writer is behind, which throttles the pool
+                frames.put((file_path, frame))
+    finally:
+        frames.put(None)
+        writer_thread.join()
+    return writer_state['rows']
+
+def stock_board(stock_code):
+    """
+    Returns the board of a stock code, the same value BOARD_SQL computes in SQL.
+    """
+    if stock_code.startswith(('sh688', 'sh689')):
+        return 'sh688'
+    for prefix, board in [('sh60', 'sh60x'), ('sz00', 'sz00x'), ('sz30', 'sz30x'), ('bj', 'bj')]:
+        if stock_code.startswith(prefix):
+            return board
+    return 'other'
+
+def duckdb_settings(config):
+    """
+    Returns the DuckDB options set in the [duckdb] section of config.conf, in the form
+    duckdb.connect takes as config:
+      threads: number of worker threads (default: all cores).
+      memory_limit: memory DuckDB may use before it spills to disk, e.g. 8GB
+                    (default: 80% of the physical memory).
+      temp_directory: directory the spilled intermediate results are written to.
+    Options that are not set are left to DuckDB.
+
+    Args:
+        config: The ConfigParser read from config.conf.
+
+    Returns:
+        dict: Option name to value.
+    """
+    if not config.has_section('duckdb'):
+        return {}
+    section = config['duckdb']
+    options = {}
+    if section.get('threads', '').strip():
+        options['threads'] = section.getint('threads')
+    for option in ['memory_limit', 'temp_directory']:
+        if section.get(option, '').strip():
+            options[option] = section.get(option).strip()
+    return options
+
+def connect_analysis_db(config):
+    """
+    Opens the connection the screener, the backtest and the dip finder query.
+    The data_source setting selects where stock_data, adjusted_stock_data,
+    trading_calendar, security_master, stock_finance_hot and fundamentals_quarterly
+    come from:
+      duckdb (default): the tables and views in stock_data.duckdb, opened read-only
+                        unless read_only = no in the [duckdb] section, so several
+                        analysis jobs can run at once. An import holds the file
+                        exclusively, so it cannot be opened while one is running.
+      parquet: views over the dataset written by export_stock_data_to_parquet.py
+               in parquet_dir, queried from an in-memory DuckDB, which also works
+               while an import is running.
+    The analysis only writes temporary tables and screen_state.duckdb, which is
+    attached separately. threads, memory_limit and temp_directory in the [duckdb]
+    section are applied to either connection (see duckdb_settings).
+
+    Args:
+        config: The ConfigParser holding the [settings] and optional [duckdb] sections.
+
+    Returns:
+        duckdb.DuckDBPyConnection: The open connection.
+    """
+    settings = config['settings']
+    options = duckdb_settings(config)
+    if settings.get('data_source', 'duckdb') != 'parquet':
+        read_only = not config.has_section('duckdb') or config['duckdb'].getboolean('read_only', fallback=True)
+        try:
+            con = duckdb.connect(database=STOCK_DB_PATH, read_only=read_only, config=options)
+        except duckdb.IOException as e:
+            print(f"无法打开数据库 {STOCK_DB_PATH}，导入程序运行时数据库文件被独占锁定，请等待导入完成或设置 data_source=parquet: {e}")
+            raise
+        print(f"连接到数据库: {STOCK_DB_PATH}{'（只读）' if read_only else ''}")
+        require_analysis_tables(con, 'main', STOCK_DB_PATH)
+        return con
+
+    parquet_dir = settings.get('parquet_dir', './stock_parquet')
+    con = duckdb.connect(database=':memory:', config=options)
+    create_parquet_views(con, parquet_dir)
+    print(f"连接到 Parquet 数据集: {parquet_dir}")
+    require_analysis_tables(con, 'main', parquet_dir)
+    return con
+
+def require_analysis_tables(con, schema, source_name):
+    """
+    Exits with a message naming the importer to re-run when one of the ANALYSIS_TABLES
+    is missing, e.g. fundamentals_quarterly in a database imported before the table
+    existed, instead of failing later in the middle of a query with a Catalog Error.
+    The connection is read-only by default, so the tables are not built here.
+
+    Args:
+        con: An open DuckDB connection.
+        schema (str): The schema or attached database holding the tables.
+        source_name (str): The database file or Parquet dataset, for the message.
+    """
+    missing = []
+    for table_name in ANALYSIS_TABLES:
+        try:
+            con.execute(f"SELECT * FROM {schema}.{table_name} LIMIT 0")
+        except duckdb.CatalogException:
+            missing.append(table_name)
+    if not missing:
+        return
+    con.close()
+    importers = list(dict.fromkeys(ANALYSIS_TABLE_IMPORTERS[table_name] for table_name in missing))
+    message = f"{source_name} 中缺少 {', '.join(missing)}，请重新运行 {' 和 '.join(importers)}"
+    if not source_name.endswith('.duckdb'):
+        message += "，再运行 export_stock_data_to_parquet.py 重新导出 Parquet 数据集"
+    raise SystemExit(message + "。")
+
+def create_parquet_views(con, parquet_dir, schema='main'):
+    """
+    Creates adjusted_stock_data, stock_data and the ANALYSIS_TABLES in schema as views
+    over the dataset written by export_stock_data_to_parquet.py in parquet_dir.
+    stock_data is the same as adjusted_stock_data, as in the dataset only the
+    adjusted bars are kept.
+
+    Args:
+        con: An open DuckDB connection.
+        parquet_dir (str): Directory of the dataset.
+        schema (str): An existing schema the views are created in.
+    """
+    bars_glob = os.path.join(parquet_dir, 'adjusted_stock_data', '*', '*', '*.parquet')
+    con.execute(f"""
+        CREATE VIEW {schema}.adjusted_stock_data AS
+        SELECT * FROM read_parquet('{bars_glob}', hive_partitioning = true)
+    """)
+    con.execute(f"CREATE VIEW {schema}.stock_data AS SELECT * FROM {schema}.adjusted_stock_data")
+    for table_name in ANALYSIS_TABLES:
+        # Tables missing from the dataset get no view, see require_analysis_tables
+        if not os.path.isfile(os.path.join(parquet_dir, table_name + '.parquet')):
+            continue
+        con.execute(f"""
+            CREATE VIEW {schema}.{table_name} AS
+            SELECT * FROM read_parquet('{os.path.join(parquet_dir, table_name + '.parquet')}')
+        """)
+
+def partition_predicate(config, earliest_time_limit, stock_codes=None):
+    """
+    Builds a WHERE predicate on the board and year partition columns of the Parquet
+    dataset, so DuckDB only opens the files the query can match.
+    Returns TRUE when the data comes from stock_data.duckdb, which has no partitions.
+
+    Args:
+        config: The ConfigParser holding the [settings] section.
+        earliest_time_limit (str): The earliest trade date the query looks at.
+        stock_codes (list): When given, only the boards of these stocks are read;
+                            otherwise every board except the Beijing exchange.
+
+    Returns:
+        str: A SQL boolean expression.
+    """
+    if config['settings'].get('data_source', 'duckdb') != 'parquet':
+        return 'TRUE'
+    predicates = [f"year >= {int(earliest_time_limit[:4])}"]
+    if stock_codes is None:
+        predicates.append("board <> 'bj'")
+    else:
+        boards = sorted({stock_board(stock_code) for stock_code in stock_codes})
+        predicates.append("board IN (" + ", ".join(f"'{board}'" for board in boards) + ")")
+    return " AND ".join(predicates)
+
+def attach_screen_state(con):
+    """
+    Attaches screen_state.duckdb as the schema screen_state and creates the tables
+    the screener keeps between runs:
+      screen_runs: for each screen_key (one parameter set), the trade dates screen_hits
+                   covers without gaps, first_trade_date to last_trade_date, and
+                   data_checksum, the checksum of the bars in that range the hits were
+                   screened from. first_trade_date and data_checksum are NULL for rows
+                   written before they were recorded.
+      screen_hits: every stock and trade date that met conditions 0-5 for a screen_key,
+                   before the condition 1.1/1.2 post-processing.
+    It is a separate file, so it stays writable while stock_data.duckdb or the Parquet
+    dataset are only read. Only incremental screening attaches it, and DuckDB lets one
+    process at a time write a file, so a second incremental run fails with a hint.
+
+    Args:
+        con: An open DuckDB connection from connect_analysis_db.
+    """
+    try:
+        con.execute(f"ATTACH IF NOT EXISTS '{SCREEN_STATE_DB_PATH}' AS screen_state (READ_WRITE);")
+    except duckdb.IOException as e:
+        print(f"无法打开 {SCREEN_STATE_DB_PATH}，另一个增量筛选（--as-of / --since-last-run）正在运行，请等待它结束后再运行: {e}")
+        raise
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS screen_state.screen_runs (
+            screen_key VARCHAR PRIMARY KEY,
+            last_trade_date DATE,
+            run_time TIMESTAMP,
+            first_trade_date DATE,
+            data_checksum VARCHAR
+        );
+    """)
+    con.execute("ALTER TABLE screen_state.screen_runs ADD COLUMN IF NOT EXISTS first_trade_date DATE;")
+    con.execute("ALTER TABLE screen_state.screen_runs ADD COLUMN IF NOT EXISTS data_checksum VARCHAR;")
+    # Columns in the order the screener outputs them
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS screen_state.screen_hits (
+            screen_key VARCHAR,
+            stock_code VARCHAR,
+            stock_name VARCHAR,
+            trade_date DATE,
+            trading_day INTEGER,
+            adj_close_price DOUBLE,
+            support_price DOUBLE,
+            market_cap_of_100_million DOUBLE,
+            total_market_cap_of_100_million DOUBLE,
+            latest_R_np DOUBLE,
+            latest_R_operating_total_revenue DOUBLE,
+            net_profit_yoy DOUBLE,
+            revenue_yoy DOUBLE,
+            industry_level1 VARCHAR,
+            industry_level2 VARCHAR,
+            industry_level3 VARCHAR,
+            PRIMARY KEY (screen_key, stock_code, trade_date)
+        );
+    """)
+
+def new_query_profile(report_path):
+    """
+    Returns an empty profile for a run that writes its JSON report to report_path, or
+    None when report_path is empty, so callers pass the result around unconditionally.
+    DuckDB overwrites its profiling output after every query, so the output goes to a
+    scratch file next to report_path and is read back after each query of interest.
+    """
+    if not report_path:
+        return None
+    return {'report_path': report_path, 'profile_path': report_path + '.last_query.json', 'phases': []}
+
+def enable_query_profiling(con, profile):
+    """
+    Turns on DuckDB's JSON profiler for con, writing to the scratch file of the profile.
+    Does nothing when profile is None.
+
+    Args:
+        con: An open DuckDB connection.
+        profile (dict): A profile returned by new_query_profile, or None.
+    """
+    if profile is None:
+        return
+    con.execute("PRAGMA enable_profiling = 'json';")
+    con.execute(f"PRAGMA profiling_output = '{profile['profile_path']}';")
+
+def last_query_profile(profile, query_name, cte_markers):
+    """
+    Reads the profiler output of the last query and maps its operators back to the named
+    CTEs of the SQL. DuckDB inlines CTEs, so an operator is labelled with the first CTE in
+    cte_markers whose pattern matches its name and extra info (the scanned table, join
+    conditions, filters and projections); an operator matching no pattern inherits the
+    label of its first labelled child, so projections and joins sitting on top of a CTE
+    count towards it. A CTE referenced twice is profiled twice and summed.
+
+    Args:
+        profile (dict): A profile returned by new_query_profile, or None.
+        query_name (str): Name of the query in the report.
+        cte_markers (dict): CTE name to a list of regular expressions, in matching order.
+
+    Returns:
+        dict: name, latency, rows_returned, cpu_time, the operator_timing, operator count
+              and output rows summed per CTE (operators no pattern reaches under
+              "(unmapped)"), and the operators in plan order. None when profile is None.
+    """
+    if profile is None:
+        return None
+    with open(profile['profile_path'], encoding='utf-8') as profile_file:
+        root = json.load(profile_file)
+
+    operators = []
+
+    def walk(node, depth):
+        entry = {
+            'depth': depth,
+            'operator': node.get('operator_name', ''),
+            'cte': None,
+            'timing': node.get('operator_timing', 0.0),
+            'cardinality': node.get('operator_cardinality', 0),
+            'extra_info': node.get('extra_info', {}),
+        }
+        operators.append(entry)
+        text = entry['operator'] + ' ' + json.dumps(entry['extra_info'], ensure_ascii=False)
+        for cte_name, patterns in cte_markers.items():
+            if any(re.search(pattern, text) for pattern in patterns):
+                entry['cte'] = cte_name
+                break
+        child_ctes = [walk(child, depth + 1) for child in node.get('children', [])]
+        if entry['cte'] is None:
+            entry['cte'] = next((cte_name for cte_name in child_ctes if cte_name), None)
+        return entry['cte']
+
+    for child in root.get('children', []):
+        walk(child, 0)
+
+    ctes = {}
+    for entry in operators:
+        cte_name = entry['cte'] or '(unmapped)'
+        totals = ctes.setdefault(cte_name, {'operator_timing': 0.0, 'operators': 0, 'output_rows': 0})
+        totals['operator_timing'] += entry['timing']
+        totals['operators'] += 1
+        totals['output_rows'] += entry['cardinality']
+    for totals in ctes.values():
+        totals['operator_timing'] = round(totals['operator_timing'], 6)
+    return {
+        'name': query_name,
+        'latency': root.get('latency'),
+        'rows_returned': root.get('rows_returned'),
+        'cpu_time': root.get('cpu_time'),
+        'ctes': ctes,
+        'operators': operators,
+    }
+
+def record_profile_phase(profile, phase_name, start_time, queries=()):
+    """
+    Appends a phase (SQL, post-filter, export, ...) to the profile with its wall time
+    since start_time and the query profiles run in it. Does nothing when profile is None.
+    """
+    if profile is None:
+        return
+    profile['phases'].append({
+        'phase': phase_name,
+        'seconds': round(time.time() - start_time, 6),
+        'queries': [query for query in queries if query is not None],
+    })
+
+def write_profile_report(profile, **context):
+    """
+    Writes the phases of the profile to its report_path as indented JSON, with the keyword
+    arguments (script, parameters, ...) on top, so two runs can be compared with diff.
+    Removes the scratch profiler output. Does nothing when profile is None.
+    """
+    if profile is None:
+        return
+    report = dict(context)
+    report['total_seconds'] = round(sum(phase['seconds'] for phase in profile['phases']), 6)
+    report['phases'] = profile['phases']
+    with open(profile['report_path'], 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2, ensure_ascii=False, default=str)
+    if os.path.isfile(profile['profile_path']):
+        os.remove(profile['profile_path'])
+    print(f"性能分析报告已写入: {profile['report_path']}")
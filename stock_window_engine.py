@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+# Price columns loaded for the breakout window conditions
+PRICE_COLUMNS = ['adj_open_price', 'adj_high_price', 'adj_low_price', 'adj_close_price', 'adj_prev_close_price']
+
+def load_price_arrays(con, query_sql, query_parameters):
+    """
+    Runs a query over the daily bars and loads the result into contiguous NumPy arrays,
+    one row per bar, with the bars of each stock stored next to each other.
+
+    Args:
+        con: An open DuckDB connection.
+        query_sql (str): A query returning stock_index (an integer per stock), trade_date
+                         and the PRICE_COLUMNS, ordered by stock_index and trade_date.
+        query_parameters (dict): Named parameters of query_sql.
+
+    Returns:
+        dict: stock_index, trade_date and the PRICE_COLUMNS as arrays (NULL prices as NaN),
+              and offsets, where the bars of the k-th stock are rows offsets[k]:offsets[k + 1].
+    """
+    columns = con.execute(query_sql, query_parameters).fetchnumpy()
+    arrays = {
+        'stock_index': np.asarray(columns['stock_index']),
+        'trade_date': np.asarray(columns['trade_date']),
+    }
+    for column in PRICE_COLUMNS:
+        # Columns holding NULLs come back as masked arrays
+        arrays[column] = np.ma.filled(np.ma.asarray(columns[column], dtype=np.float64), np.nan)
+    stock_index = arrays['stock_index']
+    starts = np.flatnonzero(np.r_[True, stock_index[1:] != stock_index[:-1]]) if len(stock_index) else np.array([], dtype=np.int64)
+    arrays['offsets'] = np.r_[starts, len(stock_index)].astype(np.int64)
+    return arrays
+
+def row_numbers(offsets):
+    """
+    Returns the 1-based position of every bar within its stock, like
+    ROW_NUMBER() OVER (PARTITION BY stock_code ORDER BY trade_date).
+    """
+    lengths = np.diff(offsets)
+    return np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], lengths) + 1
+
+def sliding_window_extreme(values, window, ufunc):
+    """
+    Computes ufunc (np.fmax or np.fmin) over every run of window consecutive values in
+    O(n), independent of window: the array is cut into blocks of window values and the
+    extreme of values[j:j + window] is combined from the suffix extreme of the block
+    holding j and the prefix extreme of the block holding j + window - 1 (van Herk /
+    Gil-Werman). NaN values are ignored, as MAX and MIN ignore NULLs.
+
+    Returns:
+        numpy.ndarray: len(values) - window + 1 values, the i-th for values[i:i + window].
+    """
+    count = len(values)
+    if count < window:
+        return np.empty(0, dtype=np.float64)
+    padding = (-count) % window
+    blocks = np.r_[values, np.full(padding, np.nan)].reshape(-1, window)
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return ufunc(suffix[:count - window + 1], prefix[window - 1:count])
+
+def previous_window_extreme(values, window, ufunc, valid):
+    """
+    Returns, for every bar, ufunc over the window bars before it (the current bar
+    excluded), like ROWS BETWEEN window PRECEDING AND 1 PRECEDING. Only bars with valid
+    set get a value, the others are NaN; valid must only be set where the window bars
+    all belong to the same stock, since the arrays hold every stock back to back.
+    """
+    result = np.full(len(values), np.nan)
+    extremes = sliding_window_extreme(values, window, ufunc)
+    result[window:] = extremes[:len(values) - window]
+    result[~valid] = np.nan
+    return result
+
+def breakout_window_columns(arrays, history_trading_days, rn):
+    """
+    Computes the window columns the screener compares for one N over the N bars before
+    every bar: max_close_{N}_days, max_high_{N}_days, min_low_{N}_days,
+    open_price_of_first_day_of_{N}_days and max_gain_{N}_days.
+    They are only computed for bars with rn > N (condition 0) and NaN for the others.
+
+    Args:
+        arrays (dict): Arrays returned by load_price_arrays.
+        history_trading_days (int): The window length N.
+        rn (numpy.ndarray): Row numbers returned by row_numbers.
+
+    Returns:
+        dict: Column name to array.
+    """
+    window = int(history_trading_days)
+    valid = rn > window
+    close = arrays['adj_close_price']
+    prev_close = arrays['adj_prev_close_price']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # NULLIF(adj_prev_close_price, 0)
+        gain = np.where(prev_close != 0, (close - prev_close) / prev_close, np.nan)
+    first_open = np.full(len(close), np.nan)
+    first_open[window:] = arrays['adj_open_price'][:len(close) - window]
+    first_open[~valid] = np.nan
+    return {
+        f'max_close_{window}_days': previous_window_extreme(close, window, np.fmax, valid),
+        f'max_high_{window}_days': previous_window_extreme(arrays['adj_high_price'], window, np.fmax, valid),
+        f'min_low_{window}_days': previous_window_extreme(arrays['adj_low_price'], window, np.fmin, valid),
+        f'open_price_of_first_day_of_{window}_days': first_open,
+        f'max_gain_{window}_days': previous_window_extreme(gain, window, np.fmax, valid),
+    }
+
+def breakout_candidate_frame(arrays, stock_codes, history_trading_days_list, first_screen_date):
+    """
+    Computes the window columns of every N and keeps the bars on or after
+    first_screen_date that meet conditions 0 and 1 for at least one N: more than N bars
+    before them and a close above 101% of the highest close of the previous N bars.
+
+    Args:
+        arrays (dict): Arrays returned by load_price_arrays.
+        stock_codes (list): Stock codes indexed by the stock_index of arrays.
+        history_trading_days_list (list): The window lengths N.
+        first_screen_date (datetime.date): The first trade date returned.
+
+    Returns:
+        pandas.DataFrame: stock_code, trade_date, adj_close_price, the window columns of
+                          every N and rn of the candidate bars, ordered by stock and date.
+    """
+    rn = row_numbers(arrays['offsets'])
+    close = arrays['adj_close_price']
+    columns = {}
+    candidate = np.zeros(len(close), dtype=bool)
+    for history_trading_days in history_trading_days_list:
+        window_columns = breakout_window_columns(arrays, history_trading_days, rn)
+        max_close = window_columns[f'max_close_{int(history_trading_days)}_days']
+        with np.errstate(invalid='ignore'):
+            candidate |= (rn > int(history_trading_days)) & (close > max_close * 1.01)
+        columns.update(window_columns)
+    candidate &= arrays['trade_date'] >= np.datetime64(first_screen_date)
+    rows = np.flatnonzero(candidate)
+    frame = pd.DataFrame({
+        'stock_code': np.asarray(stock_codes, dtype=object)[arrays['stock_index'][rows]],
+        'trade_date': arrays['trade_date'][rows],
+        'adj_close_price': close[rows],
+    })
+    for name, values in columns.items():
+        frame[name] = values[rows]
+    frame['rn'] = rn[rows]
+    return frame